@@ -0,0 +1,220 @@
+# encoding: utf-8
+
+"""
+A stand-in for the docker client, for benchmarks without a docker daemon.
+It implements the subset of commands used by simply. Images and containers are records in a state
+file, 'docker exec' runs commands on the host in a directory per container, where absolute paths
+(except system ones like /bin or /dev) are relocated.
+The state is kept in $FAKE_DOCKER_ROOT (default: <tmp>/fake_docker).
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.environ.get('FAKE_DOCKER_ROOT') or os.path.join(tempfile.gettempdir(), 'fake_docker')
+STATE = os.path.join(ROOT, 'state.json')
+# flags of 'docker run' taking a value
+RUN_FLAGS = ('--name', '-p', '-v', '-e', '-w', '-u', '--cpus', '--cpuset-cpus', '--memory', '--pids-limit',
+             '--label', '--network', '--add-host', '--mount', '--tmpfs')
+HOST_PATHS = re.compile(r'(?<![\w.~/-])/(?!(?:bin|sbin|usr|lib|lib64|dev|proc)(?:/|\b))')
+
+
+def new_id(name):
+    return hashlib.sha256(name + os.urandom(8)).hexdigest()
+
+
+@contextmanager
+def state(write=False):
+    """ Yields the state {'images': {name: record}, 'containers': {name: record}}, saved if write
+    """
+    if not os.path.isdir(ROOT):
+        os.makedirs(ROOT)
+    with open(STATE + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+        data = dict(images={}, containers={})
+        if os.path.exists(STATE):
+            with open(STATE) as f:
+                data = json.load(f)
+        yield data
+        if write:
+            with open(STATE + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.rename(STATE + '.tmp', STATE)
+
+
+def add_image(data, name, labels=None):
+    repository, _, tag = name.partition(':')
+    data['images'][repository] = dict(id='sha256:' + new_id(name), tag=tag or 'latest', labels=labels or {})
+
+
+def container_root(name):
+    return os.path.join(ROOT, 'containers', name)
+
+
+def relocate(arg, root):
+    return HOST_PATHS.sub(root + '/', arg)
+
+
+def fail(message, code=1):
+    sys.stderr.write('Error: {}\n'.format(message))
+    return code
+
+
+def cmd_version(args):
+    print('1.12.1-fake')
+
+
+def cmd_images(args):
+    with state() as data:
+        for name, image in sorted(data['images'].items()):
+            print(json.dumps(dict(ID=image['id'][7:19], Repository=name, Tag=image['tag'])))
+
+
+def cmd_ps(args):
+    with state() as data:
+        for name, cont in sorted(data['containers'].items()):
+            if cont['state'] == 'running' or '-a' in args:
+                status = 'Up 1 second' if cont['state'] == 'running' else 'Exited (0) 1 second ago'
+                print(json.dumps(dict(ID=cont['id'][:12], Names=name, Image=cont['image'], Status=status,
+                                      State=cont['state'])))
+
+
+def cmd_pull(args):
+    with state(write=True) as data:
+        add_image(data, args[-1])
+
+
+def cmd_build(args):
+    tag, labels = None, {}
+    for i, arg in enumerate(args):
+        if arg == '-t':
+            tag = args[i + 1]
+        elif arg == '--label':
+            key, _, value = args[i + 1].partition('=')
+            labels[key] = value
+    if args[-1] == '-':
+        sys.stdin.read()
+    elif not os.path.exists(os.path.join(args[-1], 'Dockerfile')):
+        return fail('no Dockerfile in {}'.format(args[-1]))
+    with state(write=True) as data:
+        add_image(data, tag or os.path.basename(args[-1]), labels)
+
+
+def cmd_commit(args):
+    with state(write=True) as data:
+        if args[0] not in data['containers']:
+            return fail('No such container: {}'.format(args[0]))
+        add_image(data, args[1])
+
+
+def cmd_run(args):
+    name, i = None, 0
+    while args[i].startswith('-'):
+        if args[i] in RUN_FLAGS:
+            if args[i] == '--name':
+                name = args[i + 1]
+            i += 1
+        i += 1
+    image = args[i]
+    with state(write=True) as data:
+        if image not in data['images']:
+            add_image(data, image)
+        name = name or 'fake_' + new_id(image)[:8]
+        if name in data['containers']:
+            return fail('Conflict. The container name "/{}" is already in use'.format(name), 125)
+        data['containers'][name] = dict(id=new_id(name), image=image, state='running')
+    if not os.path.isdir(container_root(name)):
+        os.makedirs(container_root(name))
+    print(data['containers'][name]['id'])
+
+
+def cmd_stop(args):
+    with state(write=True) as data:
+        for name in args:
+            if name in data['containers']:
+                data['containers'][name]['state'] = 'exited'
+
+
+def cmd_rm(args):
+    with state(write=True) as data:
+        for name in args:
+            if not name.startswith('-') and data['containers'].pop(name, None):
+                shutil.rmtree(container_root(name), ignore_errors=True)
+
+
+def cmd_rmi(args):
+    with state(write=True) as data:
+        for name in args:
+            data['images'].pop(name.split(':')[0], None)
+
+
+def cmd_inspect(args):
+    template, name = args[1], args[2]
+    with state() as data:
+        record = data['containers'].get(name) or data['images'].get(name.split(':')[0])
+    if not record:
+        return fail('No such object: {}'.format(name))
+    if '.Id' in template:
+        print(record['id'])
+    elif 'IPAddress' in template:
+        print('172.17.0.{}'.format(int(record['id'][:2], 16)))
+    elif 'Labels' in template:
+        label = re.search(r'"([^"]+)"', template).group(1)
+        print(record.get('labels', {}).get(label, '<no value>'))
+
+
+def cmd_logs(args):
+    pass
+
+
+def cmd_cp(args):
+    name, _, dest = args[1].partition(':')
+    root = container_root(name)
+    shutil.copy(args[0], relocate(dest, root))
+
+
+def cmd_exec(args):
+    detach, i = False, 0
+    while args[i].startswith('-'):
+        if args[i] == '-u':
+            i += 2
+            continue
+        # only short flag clusters (-d, -di) detach
+        detach = detach or (not args[i].startswith('--') and 'd' in args[i])
+        i += 1
+    name, command = args[i], args[i + 1:]
+    with state() as data:
+        running = data['containers'].get(name, {}).get('state') == 'running'
+    if not running:
+        return fail('Container {} is not running'.format(name))
+    root = container_root(name)
+    command = command[:1] + [relocate(arg, root) for arg in command[1:]]
+    if detach:
+        subprocess.Popen(command, cwd=root, stdin=open(os.devnull), stdout=open(os.devnull, 'w'),
+                         stderr=subprocess.STDOUT)
+        return 0
+    return subprocess.call(command, cwd=root)
+
+
+def main(argv):
+    # global options of the docker client are ignored
+    while argv and argv[0].startswith('-'):
+        argv = argv[2:]
+    if not argv:
+        return fail('no command')
+    command = globals().get('cmd_' + argv[0])
+    if command is None:
+        return fail('fake docker does not implement "{}"'.format(argv[0]))
+    return command(argv[1:]) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
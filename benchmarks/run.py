@@ -0,0 +1,262 @@
+# encoding: utf-8
+
+"""
+Benchmarks of simply hot paths. By default, they run against a fake docker client (see fake_docker.py),
+so they measure simply's own overhead and work without a docker daemon; use --real for the docker daemon.
+
+    python benchmarks/run.py [-k PATTERN] [--repeat N] [--real] [--save] [--compare COMMIT|FILE]
+
+--save stores results in benchmarks/results/<commit>.json, --compare prints ratios against saved results.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from simply import utils
+from simply.backends import docker
+from simply.platform import factory
+
+RESULTS = os.path.join(HERE, 'results')
+CONTAINER = 'simply_bench'
+IMAGE = 'busybox'
+
+BENCHMARKS = []
+# temporary directories created by benchmarks, removed after the run
+TEMPDIRS = []
+
+
+def benchmark(params=(None,), fake_only=False):
+    """ Registers a benchmark. The decorated function is called with each param, does its setup,
+        then returns the operation to time, or a tuple (operation, bytes processed by operation)
+    """
+    def decorator(func):
+        BENCHMARKS.append((func.__name__, func, params, fake_only))
+        return func
+    return decorator
+
+
+def fake_containers(count):
+    """ Replaces the fake docker containers by count containers, plus the benchmark container
+    """
+    import fake_docker
+    with fake_docker.state(write=True) as data:
+        data['containers'] = dict(('bench_{}'.format(i), dict(id=fake_docker.new_id(str(i)), image=IMAGE,
+                                                              state='running' if i % 2 else 'exited'))
+                                  for i in range(count))
+        data['containers'][CONTAINER] = dict(id=fake_docker.new_id(CONTAINER), image=IMAGE, state='running')
+        for i in range(count):
+            fake_docker.add_image(data, 'image_{}'.format(i))
+
+
+# ======================= BENCHMARKS =======================
+
+@benchmark()
+def exec_latency(param):
+    return lambda: docker.docker_exec('true', CONTAINER, raises=True)
+
+
+@benchmark(params=(10, 100))
+def exec_many(count):
+    return lambda: docker.docker_exec_many(['true'] * count, CONTAINER, raises=True)
+
+
+@benchmark(params=(10, 100, 1000), fake_only=True)
+def get_containers(count):
+    fake_containers(count)
+    return lambda: docker.get_containers(image=IMAGE)
+
+
+@benchmark(params=(10, 100, 1000), fake_only=True)
+def get_images(count):
+    fake_containers(count)
+    return lambda: docker.get_images('image_')
+
+
+@benchmark(params=(1 << 10, 1 << 20, 32 << 20))
+def put_data(size):
+    data = os.urandom(size)
+    return lambda: docker.put_data(data, '/bench_data', CONTAINER), size
+
+
+@benchmark(params=(1 << 10, 1 << 20, 32 << 20))
+def get_data(size):
+    docker.put_data(os.urandom(size), '/bench_data', CONTAINER)
+    return lambda: docker.get_data('/bench_data', CONTAINER), size
+
+
+def make_tree(files, size):
+    source = tempfile.mkdtemp()
+    TEMPDIRS.append(source)
+    for i in range(files):
+        folder = os.path.join(source, 'dir_{}'.format(i % 10))
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        with open(os.path.join(folder, 'file_{}'.format(i)), 'wb') as f:
+            f.write(os.urandom(size))
+    return source
+
+
+@benchmark(params=(10, 100, 1000))
+def put_directory(files):
+    source = make_tree(files, 10000)
+    return lambda: docker.sync_directory(source, '/bench_dir', CONTAINER, force=True), files * 10000
+
+
+@benchmark(params=(10, 100, 1000))
+def put_directory_unchanged(files):
+    source = make_tree(files, 10000)
+    docker.sync_directory(source, '/bench_dir', CONTAINER, force=True)
+    return lambda: docker.sync_directory(source, '/bench_dir', CONTAINER)
+
+
+def make_table(lines):
+    return '\n'.join(['NAME STATUS IMAGE PORTS'] + ['name_{0} Up image_{1} {0}/tcp'.format(i, i % 7)
+                                                     for i in range(lines)])
+
+
+@benchmark(params=(1000, 100000))
+def extract_column(lines):
+    text = make_table(lines)
+    return lambda: utils.extract_column(text, -2, start=1), len(text)
+
+
+@benchmark(params=(1000, 100000))
+def filter_column(lines):
+    text = make_table(lines)
+    return lambda: utils.filter_column(text, 2, start=1, eq='image_3'), len(text)
+
+
+@benchmark(params=(1000, 100000))
+def table_queries(lines):
+    text = make_table(lines)
+
+    def queries():
+        table = utils.Table(text, start=1)
+        table.column(0)
+        table.filter((2, 'eq', 'image_3'), (3, 'endswith', '/tcp')).columns(0, 1)
+        table.column(-1)
+    return queries, len(text)
+
+
+@benchmark()
+def platform_setup(param):
+    conf = utils.ConfAttrDict(backend='docker', frontend='busybox', image=IMAGE, image_spec='.pull',
+                              container='simply_bench_platform')
+    platform = factory(conf)
+
+    def setup():
+        platform.setup('rm_container')
+        platform.reset()
+    return setup
+
+
+# ======================= RUNNER =======================
+
+def use_fake_docker():
+    """ Puts the fake docker client first in PATH, with a fresh state
+    """
+    bindir = tempfile.mkdtemp()
+    os.environ['FAKE_DOCKER_ROOT'] = os.path.join(bindir, 'root')
+    with open(os.path.join(bindir, 'docker'), 'w') as f:
+        f.write('#!/bin/sh\nexec {} {} "$@"\n'.format(sys.executable, os.path.join(HERE, 'fake_docker.py')))
+    os.chmod(os.path.join(bindir, 'docker'), 0o755)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+    sys.path.insert(0, HERE)
+    return bindir
+
+
+def measure(op, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        op()
+        times.append(time.time() - start)
+    times.sort()
+    return dict(min=times[0], median=times[len(times) // 2], repeat=repeat)
+
+
+def run(pattern=None, repeat=5, real=False):
+    results = {}
+    docker.container_delete(CONTAINER)
+    if not docker.docker_run(IMAGE, CONTAINER, cmd='/bin/cat'):
+        raise RuntimeError("Could not run benchmark container")
+    try:
+        for name, func, params, fake_only in BENCHMARKS:
+            if (fake_only and real) or (pattern and not re.search(pattern, name)):
+                continue
+            for param in params:
+                key = name if param is None else '{}[{}]'.format(name, param)
+                op = func(param)
+                op, size = op if isinstance(op, tuple) else (op, None)
+                result = results[key] = measure(op, repeat)
+                if size:
+                    result['mb_s'] = size / result['min'] / 1e6
+                print('{:<36} {:>10.2f} ms {:>10.2f} ms{}'.format(
+                    key, result['min'] * 1e3, result['median'] * 1e3,
+                    ' {:>10.1f} MB/s'.format(result['mb_s']) if size else ''))
+    finally:
+        docker.container_delete(CONTAINER)
+        for path in TEMPDIRS:
+            shutil.rmtree(path, ignore_errors=True)
+    return results
+
+
+def commit_id():
+    sha = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE).strip()
+    dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=HERE)
+    return sha + ('-dirty' if dirty else '')
+
+
+def load(ref):
+    path = ref if os.path.exists(ref) else os.path.join(RESULTS, ref + '.json')
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, reference):
+    print('\ncompared with {} ({} docker):'.format(reference['commit'], reference['docker']))
+    for key, result in sorted(results.items()):
+        ref = reference['results'].get(key)
+        if ref:
+            print('{:<36} {:>8.2f}x'.format(key, result['min'] / ref['min']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-k', dest='pattern', help="run benchmarks whose name matches this regular expression")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of each benchmark (default: 5)")
+    parser.add_argument('--real', action='store_true', help="use the docker daemon instead of the fake docker")
+    parser.add_argument('--save', action='store_true', help="save results in benchmarks/results/<commit>.json")
+    parser.add_argument('--compare', metavar='REF', help="a commit id of saved results, or a results file")
+    args = parser.parse_args(argv)
+    bindir = None if args.real else use_fake_docker()
+    try:
+        print('{:<36} {:>13} {:>13}'.format('benchmark', 'min', 'median'))
+        results = dict(commit=commit_id(), date=time.strftime('%Y-%m-%d %H:%M:%S'),
+                       docker='real' if args.real else 'fake',
+                       results=run(args.pattern, args.repeat, args.real))
+    finally:
+        if bindir:
+            shutil.rmtree(bindir, ignore_errors=True)
+    if args.save:
+        if not os.path.isdir(RESULTS):
+            os.makedirs(RESULTS)
+        with open(os.path.join(RESULTS, results['commit'] + '.json'), 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        compare(results['results'], load(args.compare))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,8 @@
 # encoding: utf-8
 
+from simply import profiling
+from simply.profiling import pytest_configure, pytest_terminal_summary
+
 
 def pytest_addoption(parser):
     parser.addoption('--reset', action='store_true',
@@ -7,5 +10,4 @@ def pytest_addoption(parser):
                           "(default: reuse existing image")
     parser.addoption('--keep-running', action='store_true',
                      help="keep the containers up for debug")
-
-
+    profiling.pytest_addoption(parser)
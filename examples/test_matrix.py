@@ -1,14 +1,19 @@
 # encoding: utf-8
 
 from contextlib import contextmanager
-import time
 
 import pytest
 import requests
 
-from simply.platform import factory
+from simply.platform import factory, platform_matrix
 from simply.utils import ConfAttrDict
 
+MATRIX = [
+    ConfAttrDict(backend='docker', frontend='busybox', image='conda2'),
+    ConfAttrDict(backend='docker', frontend='busybox', image='conda3'),
+    ConfAttrDict(backend='docker', frontend='debian', image='debian8'),
+]
+
 
 @contextmanager
 def platform_setup(conf):
@@ -18,9 +23,18 @@ def platform_setup(conf):
     platform.reset()
 
 
+@pytest.fixture(scope='module')
+def matrix():
+    # all platforms are built and started concurrently
+    with platform_matrix(MATRIX) as pool:
+        yield pool
+
+
 @pytest.mark.parametrize("image", ['conda2', 'conda3', 'debian8'])
-def test_matrix(image):
+def test_matrix(matrix, image):
     print('test on image <{}>'.format(image))
+    with matrix.lease(image) as platform:
+        assert 'Python' in platform.execute('python -V', stdout_only=False).stderr
 
 
 @pytest.mark.parametrize("interprter,http_server", [('python2', 'SimpleHTTPServer'), ('python3', 'http.server')])
@@ -32,7 +46,7 @@ def test_python_server(interprter, http_server):
     )
     with platform_setup(conf) as platform:
         platform.execute("{} -m {} 8000".format(interprter, http_server), daemon=True)
-        time.sleep(0.1)
+        assert platform.wait_port(8000)
         req = requests.get('http://{}:8000'.format(platform.get_container_ip()), timeout=1)
         assert req.status_code == 200
         assert 'Directory listing for' in req.text
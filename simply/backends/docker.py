@@ -1,49 +1,154 @@
 # encoding: utf-8
 
+import atexit
+from collections import namedtuple, OrderedDict
+import cStringIO
+import functools
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
 import os
+import pipes
+import Queue
+import select
+import stat
+from subprocess import Popen, PIPE
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 
-from .. import ROOTDIR, utils
+from .. import ROOTDIR, profiling, utils
 
 
 class DockerBackend(object):
 
     def init_backend(self, conf):
         self.container = conf.get('container') or self.image + '_' + utils.random_id()
-        self.parameters = conf.get('parameters')
+        self.resources = dict((key, conf.get(key)) for key in RESOURCES)
+        self.parameters = ' '.join(filter(None, (resource_parameters(**self.resources), conf.get('parameters')))) or None
         self.image_spec = conf.get('image_spec', '')
+        package_cache = conf.get('package_cache', True)
+        self.package_cache = PACKAGE_CACHE if package_cache is True else package_cache or None
+        self.engine = get_engine(conf.get('transport'), conf.get('docker_socket'))
+        if conf.get('inventory'):
+            use_inventory(events=conf.get('inventory') == 'events')
+        self.pool_size = conf.get('pool_size')
+        self.leased = False
+        self.provisioning = conf.get('provisioning')
+        self.base_image = None
+        self.timeout = conf.get('timeout')
+        self.build_timeout = conf.get('build_timeout')
+        self.cache_from = conf.get('cache_from')
+        self.buildkit = conf.get('buildkit')
+        self.agent = conf.get('agent')
+        self.agent_timeout = conf.get('agent_timeout') or AGENT_TIMEOUT
+        self.agents = {}
         return self
 
     def setup_backend(self):
+        """ Starts the exec agent of the platform user if conf 'agent' is set
+        """
+        if self.agent:
+            self.get_agent(self.user)
+        return self
+
+    def get_agent(self, user=None):
+        """ Gets the exec agent of a user, starts it if needed or if it has exited
+        """
+        if user not in self.agents or not self.agents[user].alive():
+            self.agents[user] = start_agent(self.container, user, self.agent_timeout)
+        return self.agents[user]
+
+    def stop_agents(self):
+        for agent in self.agents.values():
+            agent.close()
+        self.agents = {}
         return self
 
+    @profiling.timed('setup')
     def setup(self, reset=None):
         """
         1- ensures images are created, otherwise, creates them
         2- ensures containers are created and started otherwise creates and/or starts them
+        3- if conf 'provisioning' is set, runs the container from the provisioned image if it exists,
+           otherwise replays the provisioning steps and commits the provisioned image
         """
         self.build_image(reset)
+        return self.setup_container(reset)
+
+    def setup_container(self, reset=None):
+        """ The steps of setup following the image build: runs the container, from the provisioned image
+            if conf 'provisioning' is set and it exists, starts the exec agent and provisions the container
+        :param reset: only 'all_containers' matters, to remove the containers of the provisioned image
+        """
+        if self.provisioning and self.use_provisioned_image():
+            self.reset('all_containers' if reset == 'all_containers' else None)
+            self.run_container()
+            return self.setup_backend()
         self.run_container()
+        self.setup_backend()
+        if self.provisioning:
+            self.provision(self.provisioning)
         return self
 
+    def provisioned_image(self, steps):
+        """ Returns the name of the image derived from the platform image by provisioning steps
+        """
+        key = provisioning_key(self.engine.get_image_id(self.image), steps)
+        return '{}_prov_{}'.format(self.image.replace(':', '_'), key[:16])
+
+    def use_provisioned_image(self):
+        """ Switches the platform image to the provisioned image, if it exists
+        :return: True if the provisioned image exists
+        """
+        image = self.provisioned_image(self.provisioning)
+        if image not in self.engine.get_images(image):
+            return False
+        self.base_image, self.image = self.image, image
+        return True
+
+    def commit_provisioning(self, steps=None):
+        """ Commits the container to the image provisioned by steps
+        :param steps: defaults to the provisioning calls recorded by the frontend
+        :return: the provisioned image name
+        """
+        image = self.provisioned_image(self.provisioning_log if steps is None else steps)
+        print(utils.yellow("Commit provisioned image {}".format(image)))
+        if not docker_commit(self.container, image):
+            raise RuntimeError("Could not commit container {} to {}".format(self.container, image))
+        return image
+
+    @profiling.timed('reset')
     def reset(self, reset='rm_container'):
         """ Resets a platform
         :param reset: 'uproot': remove platform images and any dependant container
                       'rm_image': remove platform images and containers
                       'rm_container': remove and stop platform containers
                       'stop': stop platform containers
+            With a container pool, 'all_containers' is a no op and 'rm_container' returns the
+            leased container to the pool.
         """
         if not reset:
             return self
+        self.stop_agents()
+        if reset != 'stop':
+            forget_container_state(self)
         if reset == 'uproot':
+            close_pool(self.image)
+            self.leased = False
             return self.image_delete(uproot=True)
         if reset == 'all_containers':
-            return self.delete_all_containers()
+            return self if self.pool_size else self.delete_all_containers()
         if reset in ('rm_container', 'rm_image'):
             self.container_delete()
         if reset == 'rm_image':
+            close_pool(self.image)
             self.image_delete()
         return self
 
+    @profiling.timed('build')
     def build_image(self, reset=None):
         """ self.image_spec can be:
             - an empt string: the docker context is set to simply/images/{self.image}
@@ -51,42 +156,75 @@ class DockerBackend(object):
             - an inline Dockerfile (it contains at least one '\n')
             - an absolute path (starting with '/'): the docker context is set to {self.image_spec}/{self.image}
             - an url (starting with 'http'): the docker context is set accordingly (TODO)
+        Built images are labelled with a hash of their context and rebuilt when it changes.
+        Concurrent calls for the same image, from other threads or processes, wait for the first one.
         """
         self.reset(reset)
-        if self.image not in self.get_real_images():
+        with image_lock(self.image):
             if self.image_spec == '.pull':
-                print(utils.yellow("Pull image {}".format(self.image)))
-                docker_pull(self.image)
-            else:
+                if not self.engine.has_image(self.image):
+                    print(utils.yellow("Pull image {}".format(self.image)))
+                    docker_pull(self.image, self.build_timeout)
+            elif not self.engine.has_image(self.image) or self.engine.image_outdated(*self.build_args()):
                 print(utils.yellow("Build image {}".format(self.image)))
-                if '\n' in self.image_spec:
-                    docker_build(self.image_spec, self.image)
-                elif self.image_spec.startswith('/'):
-                    docker_build(os.path.join(self.image_spec, self.image), self.image)
-                else:
-                    docker_build(self.image)
+                docker_build(*self.build_args(), cache_from=self.cache_from, buildkit=self.buildkit,
+                             timeout=self.build_timeout)
         return self
 
+    def build_args(self):
+        """ Returns docker_build arguments for self.image_spec
+        """
+        if '\n' in self.image_spec:
+            return self.image_spec, self.image
+        if self.image_spec.startswith('/'):
+            return os.path.join(self.image_spec, self.image), self.image
+        return self.image, None
+
+    def image_parents(self):
+        """ Returns the images this platform image is built from (none if pulled)
+        """
+        if self.image_spec == '.pull':
+            return []
+        return dockerfile_parents(dockerfile(*self.build_args()))
+
     def get_real_images(self):
-        return get_images(self.image)
+        return self.engine.get_images(self.image)
 
     def image_exist(self):
         return [self.image] == self.get_real_images()
 
+    @profiling.timed('run')
     def run_container(self, reset=None):
+        """ Runs the platform container, or leases a running one if conf 'pool_size' is set
+        """
         self.reset(reset)
-        if self.container in self.get_real_containers():
+        if self.pool_size:
+            if not self.leased:
+                self.container = get_pool(self.image, self.pool_size, self.run_parameters()).lease()
+                self.leased = True
+            return self
+        if self.engine.has_container(self.container, all=False):
             return self
         # an existing (but stopped) container is deleted before being ran again
         self.container_delete()
-        docker_run(self.image, self.container, self.parameters)
+        forget_container_state(self)
+        docker_run(self.image, self.container, self.run_parameters(), timeout=self.timeout)
         return self
 
+    def run_parameters(self):
+        """ Returns the 'docker run' parameters: conf 'parameters', resources and the frontend package caches
+        """
+        caches = self.cache_parameters() if self.package_cache and hasattr(self, 'cache_parameters') else None
+        return ' '.join(filter(None, (self.parameters, caches))) or None
+
     def get_real_containers(self, all=False):
-        return get_containers(self.container, all=all)
+        return self.engine.get_containers(self.container, all=all)
 
     def get_container_ip(self):
-        return get_container_ip(self.container)
+        return self.engine.get_container_ip(self.container)
+
+    def get_logs(self):
+        return container_logs(self.container)
 
     def image_delete(self, uproot=False):
         func = image_delete_and_containers if uproot else image_delete
@@ -96,27 +234,542 @@ class DockerBackend(object):
         return self
 
     def container_delete(self):
+        if self.leased:
+            get_pool(self.image, self.pool_size, self.run_parameters()).release(self.container)
+            self.leased = False
+            return self
         for container in self.get_real_containers(True):
             print(utils.yellow("Delete container {}".format(container)))
-            container_delete(container)
+            self.engine.container_delete(container)
         return self
 
     def delete_all_containers(self):
-        container_stop(image=self.image)
-        container_delete(image=self.image)
+        self.engine.container_stop(image=self.image)
+        self.engine.container_delete(image=self.image)
         return self
 
-    def execute(self, cmd, **kwargs):
-        return docker_exec(cmd, self.container, self.user, **kwargs)
+    @profiling.timed('execute')
+    def execute(self, cmd, user=None, **kwargs):
+        """ Executes a command, through the exec agent if conf 'agent' is set (except daemon commands
+            and commands with a timeout). The timeout defaults to conf 'timeout'.
+            Agent commands are limited to conf 'agent_timeout' seconds (default AGENT_TIMEOUT).
+        """
+        user = user or self.user
+        if self.timeout and not kwargs.get('daemon'):
+            kwargs.setdefault('timeout', self.timeout)
+        if self.agent and not kwargs.get('daemon') and not kwargs.get('timeout'):
+            kwargs.pop('shell', None)
+            return exec_output(self.get_agent(user).execute(cmd), cmd, self.container, **kwargs)
+        return self.engine.docker_exec(cmd, self.container, user, **kwargs)
+
+    def aexecute(self, cmd, user=None, **kwargs):
+        """ Asynchronous flavour of execute(), always through the docker client
+        :return: a utils.Future
+        """
+        return adocker_exec(cmd, self.container, user or self.user, **kwargs)
+
+    @utils.coroutine
+    def asetup(self):
+        """ Asynchronous flavour of setup(), without reset, pool, provisioning or agent:
+            ensures the image exists and the container runs
+        :return: a utils.Future
+        """
+        images = yield aget_images(self.image)
+        if self.image not in images:
+            print(utils.yellow("{} image {}".format('Pull' if self.image_spec == '.pull' else 'Build', self.image)))
+            done = yield (adocker_pull(self.image) if self.image_spec == '.pull' else
+                          adocker_build(*self.build_args(), cache_from=self.cache_from,
+                                        buildkit=self.buildkit))
+            if not done:
+                raise RuntimeError("Could not create image {}".format(self.image))
+        running = yield aget_containers(self.container, all=False)
+        if self.container not in running:
+            # an existing (but stopped) container is deleted before being ran again
+            yield utils.async_command('docker rm -f {}'.format(self.container))
+            inventory.invalidate('containers')
+            forget_container_state(self)
+            if not (yield adocker_run(self.image, self.container, self.run_parameters())):
+                raise RuntimeError("Could not run container {}".format(self.container))
+        raise utils.Return(self)
+
+    @profiling.timed('execute')
+    def execute_many(self, cmds, user=None, raises=False):
+        """ Executes a sequence of commands in a single exec, see docker_exec_many
+        """
+        user = user or self.user
+        if self.agent and not self.timeout:
+            return self.get_agent(user).execute_many(cmds, raises)
+        return self.engine.docker_exec_many(cmds, self.container, user, raises, self.timeout)
 
     def path_exists(self, path):
-        return path_exists(path, self.container)
+        if self.agent:
+            return self.execute('test -e {}'.format(path), status_only=True)
+        return self.engine.path_exists(path, self.container)
+
+    def sync_directory(self, source, dest, force=False):
+        return self.engine.sync_directory(source, dest, self.container, force)
+
+    def get_files(self, paths):
+        return self.engine.get_files(paths, self.container)
+
+    def get_directory(self, path):
+        return self.engine.get_directory(path, self.container)
 
 this_class = DockerBackend
 
 
+def forget_container_state(platform):
+    """ Tells the frontend of a platform that its container is deleted or re-created
+    """
+    if hasattr(platform, 'forget_container_state'):
+        platform.forget_container_state()
+
+
+class ContainerPool(object):
+    """
+    A pool of pre-started containers of an image.
+    A returned container is discarded and replaced in the background, unless it is declared clean,
+    so that leasing a container does not wait for a container start-up.
+    """
+
+    def __init__(self, image, size=2, parameters=None, cmd=None):
+        self.image = image
+        self.size = size
+        self.parameters = parameters
+        self.cmd = cmd
+        self.ready = Queue.Queue()
+        self.threads = []
+        for _ in xrange(size):
+            self.spawn(self.start)
+
+    def spawn(self, func, *args):
+        thread = threading.Thread(target=func, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads = [t for t in self.threads if t.is_alive()] + [thread]
+
+    def start(self):
+        container = '{}_pool_{}'.format(self.image.replace('/', '_').replace(':', '_'), utils.random_id())
+        # a failed start is queued as None, so that lease() raises instead of waiting forever
+        self.ready.put(container if docker_run(self.image, container, self.parameters, self.cmd) else None)
+
+    def replace(self, container):
+        container_delete(container)
+        self.start()
+
+    def lease(self, timeout=None):
+        """ Gets a running container from the pool, waits until one is ready
+        :return: the container name
+        """
+        container = self.ready.get(timeout=timeout)
+        if container is None:
+            self.spawn(self.start)
+            raise RuntimeError("Could not start a container from image {}".format(self.image))
+        return container
+
+    def release(self, container, clean=False):
+        """ Returns a leased container to the pool
+        :param clean: if True, the container is reused as is, otherwise, it is deleted and replaced
+               by a fresh one in the background
+        """
+        if clean:
+            self.ready.put(container)
+        else:
+            self.spawn(self.replace, container)
+
+    def snapshot(self, container, image=None):
+        """ Commits a leased container into an image, from which the pool starts its containers from now on.
+            Ready containers of the former image are replaced in the background.
+        :return: the snapshot image name
+        """
+        image = image or '{}_snapshot_{}'.format(self.image.split(':')[0], utils.random_id())
+        if not docker_commit(container, image):
+            raise RuntimeError("Could not commit container {} to {}".format(container, image))
+        self.image = image
+        while True:
+            try:
+                self.release(self.ready.get_nowait())
+            except Queue.Empty:
+                break
+        return image
+
+    def close(self):
+        """ Waits for pending starts and deletes ready containers
+        """
+        for thread in self.threads:
+            thread.join()
+        containers = []
+        while True:
+            try:
+                containers.append(self.ready.get_nowait())
+            except Queue.Empty:
+                break
+        containers = [c for c in containers if c]
+        if containers:
+            container_delete(*containers)
+
+
+class BuildScheduler(object):
+    """
+    Runs image builds concurrently, each one after the builds of the images it is built from.
+    """
+
+    def __init__(self, workers=4):
+        """
+        :param workers: maximum number of concurrent builds
+        """
+        self.workers = workers
+        self.jobs = []
+
+    def add(self, image, build, parents=()):
+        """ Adds a build
+        :param image: the name of the built image
+        :param build: a callable doing the build, it fails by raising or returning False
+        :param parents: names of images it is built from. Those not added to the scheduler are ignored
+        """
+        self.jobs.append((image, build, list(parents)))
+        return self
+
+    def add_platform(self, platform, reset=None):
+        """ Adds the build (or pull) of a platform image, see DockerBackend.build_image
+        """
+        return self.add(platform.image, lambda: platform.build_image(reset), platform.image_parents())
+
+    def dependencies(self):
+        """ Returns, for each job index, the set of indexes of the jobs it depends on.
+            Raises a RuntimeError on cyclic dependencies.
+        """
+        deps = [set(j for j, job in enumerate(self.jobs) if job[0] in parents and job[0] != image)
+                for image, build, parents in self.jobs]
+        done, todo = set(), set(xrange(len(self.jobs)))
+        while todo:
+            ready = set(i for i in todo if deps[i] <= done)
+            if not ready:
+                raise RuntimeError("Cyclic image dependencies: {}".format(
+                    ', '.join(sorted(self.jobs[i][0] for i in todo))))
+            done |= ready
+            todo -= ready
+        return deps
+
+    def run(self):
+        """ Runs all builds. Builds depending on a failed one are not run.
+            Raises a RuntimeError listing failed images if any.
+        """
+        deps = self.dependencies()
+        if not deps:
+            return self
+        results = Queue.Queue()
+
+        def job(i):
+            try:
+                error = 'build failed' if self.jobs[i][1]() is False else None
+            except Exception as e:
+                error = e
+            results.put((i, error))
+
+        pool = ThreadPool(min(self.workers, len(deps)))
+        done, failed, started = set(), {}, set()
+        try:
+            while True:
+                for i, dep in enumerate(deps):
+                    if i not in started and dep <= done:
+                        started.add(i)
+                        pool.apply_async(job, (i,))
+                if len(done) + len(failed) == len(started):
+                    break
+                i, error = results.get()
+                if error is None:
+                    done.add(i)
+                    continue
+                failed[i] = error
+                # descendants of a failed build are failed too
+                while True:
+                    skipped = set(j for j, dep in enumerate(deps) if j not in started and dep & set(failed))
+                    if not skipped:
+                        break
+                    for j in skipped:
+                        started.add(j)
+                        failed[j] = 'parent image failed'
+        finally:
+            pool.close()
+            pool.join()
+        if failed:
+            raise RuntimeError("Could not build images: {}".format(
+                ', '.join('{} ({})'.format(self.jobs[i][0], error) for i, error in sorted(failed.items()))))
+        return self
+
+
+def build_images(images=None, workers=4, cache_from=None, buildkit=False):
+    """ Builds (if needed) images of simply/images concurrently, in dependency order
+    :param images: a list of images names, all images if None
+    """
+    root = os.path.join(ROOTDIR, 'images')
+    scheduler = BuildScheduler(workers)
+    for image in images or sorted(os.listdir(root)):
+        scheduler.add(image, functools.partial(ensure_image, image, cache_from=cache_from, buildkit=buildkit),
+                      dockerfile_parents(dockerfile(image)))
+    return scheduler.run()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(image, size=2, parameters=None):
+    """ Gets the container pool of an image, creates it if needed
+    """
+    with _pools_lock:
+        pool = _pools.get((image, parameters))
+        if pool is None:
+            pool = _pools[image, parameters] = ContainerPool(image, size, parameters)
+        return pool
+
+
+def close_pool(image=None):
+    """ Closes pools of an image, or all pools if image is None
+    """
+    with _pools_lock:
+        for key in [k for k in _pools if image is None or k[0] == image]:
+            _pools.pop(key).close()
+
+atexit.register(close_pool)
+
+
+def get_engine(transport=None, socket_path=None):
+    """ Returns the module implementing docker operations for a transport
+    :param transport: 'cli' (default) spawns the docker client for each operation,
+           'api' talks to the Engine API over the docker UNIX socket
+    :param socket_path: optional docker socket path, for the 'api' transport
+    """
+    if not transport or transport == 'cli':
+        return sys.modules[__name__]
+    if transport == 'api':
+        from . import docker_api
+        if socket_path:
+            docker_api.configure(socket_path)
+        return docker_api
+    raise ValueError("Unknown docker transport: {}".format(transport))
+
+
 def docker_version():
-    return utils.extract_column(utils.filter_column(utils.Command('docker version').stdout, 0, eq='Version:'), 1)[0]
+    return utils.Command("docker version --format '{{ .Server.Version }}'").stdout.strip()
+
+
+# container events changing the output of 'docker ps'
+CONTAINER_EVENTS = {'create', 'start', 'restart', 'die', 'kill', 'stop', 'destroy', 'rename', 'pause', 'unpause'}
+
+ImageRecord = namedtuple('ImageRecord', 'id repository tag')
+ContainerRecord = namedtuple('ContainerRecord', 'id name image status state')
+
+
+class Listing(object):
+    """ A list of records, with indexes by field built on first use
+    """
+    __slots__ = ('records', 'indexes')
+
+    def __init__(self, records):
+        self.records = records
+        self.indexes = {}
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def index(self, field):
+        """ Returns a dict field value -> list of records
+        """
+        if field not in self.indexes:
+            index = {}
+            for record in self.records:
+                index.setdefault(getattr(record, field), []).append(record)
+            self.indexes[field] = index
+        return self.indexes[field]
+
+    def select(self, **criteria):
+        """ Returns the records matching all criteria field=value
+        """
+        if not criteria:
+            return list(self.records)
+        field, value = criteria.popitem()
+        return [r for r in self.index(field).get(value, ())
+                if all(getattr(r, f) == v for f, v in criteria.iteritems())]
+
+
+def container_state(status):
+    """ Gets a container state (running, exited, ...) from its 'docker ps' status
+    """
+    if status.startswith('Up'):
+        return 'paused' if '(Paused)' in status else 'running'
+    return {'Removal': 'removing'}.get(status.split(' ')[0], status.split(' ')[0].lower())
+
+
+def parse_images(output):
+    """ Parses the output of 'docker images --format "{{json .}}"'
+    :return: a Listing of ImageRecord
+    """
+    records = []
+    for line in output.splitlines():
+        if line.strip():
+            image = json.loads(line)
+            records.append(ImageRecord(image['ID'], image['Repository'], image['Tag']))
+    return Listing(records)
+
+
+def parse_containers(output):
+    """ Parses the output of 'docker ps -a --format "{{json .}}"'
+    :return: a Listing of ContainerRecord
+    """
+    records = []
+    for line in output.splitlines():
+        if line.strip():
+            cont = json.loads(line)
+            records.append(ContainerRecord(cont['ID'], cont['Names'].split(',')[0], cont['Image'], cont['Status'],
+                                           cont.get('State') or container_state(cont['Status'])))
+    return Listing(records)
+
+
+IMAGES_CMD = "docker images --format '{{json .}}'"
+CONTAINERS_CMD = "docker ps -a --format '{{json .}}'"
+
+
+class Inventory(object):
+    """
+    An in-process cache of docker images and containers listings, with O(1) lookups.
+    It is invalidated by the mutating functions of this module and, optionally, by 'docker events'.
+    Disabled by default, as it does not see changes made by other processes, unless watching events.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.watcher = None
+        self._images = None
+        self._containers = None
+
+    def invalidate(self, *kinds):
+        """ Drops cached images and/or containers (both if kinds is empty)
+        """
+        with self.lock:
+            if not kinds or 'images' in kinds:
+                self._images = None
+            if not kinds or 'containers' in kinds:
+                self._containers = None
+
+    def images(self):
+        """ Returns a Listing of ImageRecord
+        """
+        with self.lock:
+            if self._images is None:
+                self._images = parse_images(utils.Command(IMAGES_CMD).stdout)
+            return self._images
+
+    def containers(self):
+        """ Returns a Listing of ContainerRecord, for all containers
+        """
+        with self.lock:
+            if self._containers is None:
+                self._containers = parse_containers(utils.Command(CONTAINERS_CMD).stdout)
+            return self._containers
+
+    def watch(self):
+        """ Invalidates the cache on each docker event, from a background 'docker events' process
+        """
+        if self.watcher is None:
+            with open(os.devnull, 'w') as devnull:
+                self.watcher = Popen('docker events', shell=True, stdout=PIPE, stderr=devnull)
+            thread = threading.Thread(target=self.read_events, args=(self.watcher,))
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def read_events(self, watcher):
+        # event lines look like: '<time> container|image <action> <id> (attributes)'
+        for line in iter(watcher.stdout.readline, ''):
+            elts = line.split()
+            if len(elts) < 3:
+                continue
+            if elts[1] == 'image' or elts[2] == 'commit':
+                self.invalidate('images')
+            elif elts[1] == 'container' and elts[2] in CONTAINER_EVENTS:
+                self.invalidate('containers')
+
+    def unwatch(self):
+        if self.watcher is not None:
+            self.watcher.terminate()
+            self.watcher.wait()
+            self.watcher = None
+
+inventory = Inventory()
+atexit.register(inventory.unwatch)
+
+
+def use_inventory(enabled=True, events=False):
+    """ Enables or disables the inventory cache for the listing functions of this module
+    :param events: if True, the inventory is also invalidated by 'docker events'
+    """
+    inventory.enabled = enabled
+    inventory.invalidate()
+    if enabled and events:
+        inventory.watch()
+    elif not enabled:
+        inventory.unwatch()
+
+
+def invalidates(*kinds):
+    """ Decorator of functions mutating docker images and/or containers, invalidates the inventory
+        after the call, or when the returned future is done.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            if isinstance(result, utils.Future):
+                result.add_done_callback(lambda this: inventory.invalidate(*kinds))
+            else:
+                inventory.invalidate(*kinds)
+            return result
+        return wrapper
+    return decorator
+
+
+def list_images():
+    """ Returns a Listing of ImageRecord (id, repository, tag)
+    """
+    return inventory.images() if inventory.enabled else parse_images(utils.Command(IMAGES_CMD).stdout)
+
+
+def list_containers():
+    """ Returns a Listing of ContainerRecord (id, name, image, status, state) of all containers
+    """
+    return inventory.containers() if inventory.enabled else parse_containers(utils.Command(CONTAINERS_CMD).stdout)
+
+
+def query_images(**criteria):
+    """ Returns the images matching all criteria, eg query_images(repository='busybox', tag='latest')
+    :return: a list of ImageRecord
+    """
+    return list_images().select(**criteria)
+
+
+def query_containers(**criteria):
+    """ Returns the containers matching all criteria, eg query_containers(image='busybox', state='running')
+    :return: a list of ContainerRecord
+    """
+    return list_containers().select(**criteria)
+
+
+def has_image(image):
+    return image in list_images().index('repository')
+
+
+def has_container(container, all=True):
+    return any(all or r.state == 'running' for r in list_containers().index('name').get(container, ()))
+
+
+def get_image_id(image):
+    return utils.Command("docker inspect --format '{{ .Id }}' %s" % image).stdout.strip()
 
 
 def get_images(filter=None):
@@ -124,13 +777,20 @@ def get_images(filter=None):
     :param filter: if string, get images names containing it, if python container, get images in this set.
     :return: a list of images names
     """
-    images = utils.Command('docker images').stdout_column(0, 1)
+    return image_names(list_images(), filter)
+
+
+def image_names(listing, filter=None):
+    return filter_names([r.repository for r in listing], filter)
+
+
+def filter_names(names, filter=None):
     if filter:
         if isinstance(filter, basestring):
-            return [x for x in images if filter in x]
+            return [x for x in names if filter in x]
         else:
-            return [x for x in images if x in filter]
-    return images
+            return [x for x in names if x in filter]
+    return names
 
 
 def get_containers(filter=None, image=None, all=True):
@@ -141,19 +801,37 @@ def get_containers(filter=None, image=None, all=True):
     :param all: if False, get only running containers, else get all containers.
     :return: a list of containers names
     """
-    docker_cmd = 'docker ps -a' if all else 'docker ps'
-    if image:
-        return utils.extract_column(utils.filter_column(utils.Command(docker_cmd).stdout, 1, eq=image), -1)
-    else:
-        containers = utils.Command(docker_cmd).stdout_column(-1, 1)
-        if filter:
-            if isinstance(filter, basestring):
-                return [x for x in containers if filter in x]
-            else:
-                return [x for x in containers if x in filter]
-        return containers
+    return container_names(list_containers(), filter, image, all)
+
 
+def container_names(listing, filter=None, image=None, all=True):
+    records = listing.index('image').get(image, ()) if image else listing
+    names = [r.name for r in records if all or r.state == 'running']
+    return names if image else filter_names(names, filter)
 
+
+def aget_images(filter=None):
+    """ Asynchronous flavour of get_images()
+    :return: a utils.Future
+    """
+    return utils.async_command(IMAGES_CMD).then(lambda dock: image_names(parse_images(dock.stdout), filter))
+
+
+def aget_containers(filter=None, image=None, all=True):
+    """ Asynchronous flavour of get_containers()
+    :return: a utils.Future
+    """
+    return utils.async_command(CONTAINERS_CMD).\
+        then(lambda dock: container_names(parse_containers(dock.stdout), filter, image, all))
+
+
+def provisioning_key(image_id, steps):
+    """ Hashes provisioning steps together with the id of the image they are applied to
+    """
+    return hashlib.sha1(json.dumps([image_id, steps], sort_keys=True)).hexdigest()
+
+
+@invalidates('containers')
 def container_stop(*container, **kwargs):
     image = kwargs.get('image')
     ret = True
@@ -162,6 +840,7 @@ def container_stop(*container, **kwargs):
     return ret
 
 
+@invalidates('containers')
 def container_delete(*container, **kwargs):
     image = kwargs.get('image')
     ret = container_stop(image=image, *container)
@@ -170,6 +849,7 @@ def container_delete(*container, **kwargs):
     return ret
 
 
+@invalidates('images')
 def image_delete(*image):
     ret = True
     for im in image:
@@ -185,36 +865,178 @@ def image_delete_and_containers(image):
     return image_delete(image)
 
 
-def docker_pull(image):
-    return not utils.command('docker pull {}'.format(image))
+@invalidates('images')
+def docker_pull(image, timeout=None):
+    return not utils.command('docker pull {}'.format(image), timeout=timeout)
+
 
+# label of built images holding the hash of their build context
+CONTEXT_LABEL = 'simply.context'
 
-def docker_build(image, tag=None):
+
+@invalidates('images')
+def docker_build(image, tag=None, cache_from=None, buildkit=False, timeout=None):
     """ Wrapper around docker build command
     see https://docs.docker.com/engine/reference/commandline/build/
     :param image: name of the image. Can be an absolute path to a Dockerfile or an URL
            Can be an inline Dockerfile (contains \n).
     :param tag: target name of the image
+    :param cache_from: an image name or a list of image names to reuse layers from
+    :param buildkit: if True, build with BuildKit (enables RUN --mount=type=cache in Dockerfiles)
+    :param timeout: optional timeout in seconds, after which the build is killed
     :return: True if successfull
     """
+    cmd, datain = build_command(image, tag, cache_from, buildkit)
+    if datain:
+        return not utils.command_input(cmd, datain, timeout=timeout)
+    print(utils.yellow(cmd))
+    return not utils.Command(cmd, show='Build: ', timeout=timeout).returncode
+
+
+def build_command(image, tag=None, cache_from=None, buildkit=False):
+    """ see docker_build
+    :return: a tuple (docker command, inline Dockerfile or None)
+    """
+    options = '-t {}'.format(tag or image)
+    context = context_hash(image, tag)
+    if context:
+        options += ' --label {}={}'.format(CONTEXT_LABEL, context)
+    if isinstance(cache_from, basestring):
+        cache_from = [cache_from]
+    for cache in cache_from or ():
+        options += ' --cache-from {}'.format(cache)
+    if buildkit:
+        # inline cache metadata makes the built image usable by --cache-from
+        options = '--build-arg BUILDKIT_INLINE_CACHE=1 ' + options
+    docker_cmd = '{}docker build {}'.format('DOCKER_BUILDKIT=1 ' if buildkit else '', options)
+    if '\n' in image:
+        return docker_cmd + ' -', image
+    return docker_cmd + ' ' + build_context(image, tag), None
+
+
+def dockerfile(image, tag=None):
+    """ Returns the Dockerfile of docker_build arguments, or '' if not found
+    """
+    if '\n' in image:
+        return image
+    path = os.path.join(build_context(image, tag), 'Dockerfile')
+    if not os.path.exists(path):
+        return ''
+    with open(path) as f:
+        return f.read()
+
+
+def dockerfile_parents(text):
+    """ Returns the images named in the FROM instructions of a Dockerfile, except build stages.
+        A ':latest' tag is removed.
+    """
+    parents, stages = [], set()
+    for line in text.splitlines():
+        words = [word for word in line.split() if not word.startswith('--')]
+        if len(words) < 2 or words[0].upper() != 'FROM':
+            continue
+        image = words[1][:-len(':latest')] if words[1].endswith(':latest') else words[1]
+        if image not in stages and image != 'scratch' and image not in parents:
+            parents.append(image)
+        if len(words) == 4 and words[2].upper() == 'AS':
+            stages.add(words[3])
+    return parents
+
+
+def build_context(image, tag=None):
+    """ Returns the build context directory of an image, see docker_build
+    """
+    if os.path.isabs(image):
+        if not tag:
+            raise RuntimeError("Absolute path build requires a tag")
+        return image
+    return os.path.join(ROOTDIR, 'images', image)
+
+
+def context_hash(image, tag=None):
+    """ Returns a hash of the content of an image build context (or inline Dockerfile),
+        or None if there is no local context directory
+    """
     if '\n' in image:
         if not tag:
             raise RuntimeError("Inline build requires a tag")
-        cmd = 'docker build -t {} -'.format(tag)
-        return not utils.command_input(cmd, image)
-    else:
-        if os.path.isabs(image):
-            if not tag:
-                raise RuntimeError("Absolute path build requires a tag")
-            path = image
-        else:
-            path = os.path.join(ROOTDIR, 'images', image)
-        cmd = 'docker build -t {} {}'.format(tag or image, path)
-        print(utils.yellow(cmd))
-        return not utils.Command(cmd, show='Build: ').returncode
+        return hashlib.sha1(image).hexdigest()
+    context = build_context(image, tag)
+    if not os.path.isdir(context):
+        return None
+    manifest = directory_manifest(context)
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True)).hexdigest()
+
+
+def image_lock(image):
+    """ A lock on an image, shared with other threads and processes, see utils.named_lock
+    """
+    return utils.named_lock('image_' + image)
+
+
+def ensure_image(image, tag=None, cache_from=None, buildkit=False, timeout=None):
+    """ Builds an image if it does not exist or is outdated, see docker_build
+    :return: True if the image is up to date
+    """
+    with image_lock(tag or image):
+        if has_image(tag or image) and not image_outdated(image, tag):
+            return True
+        return docker_build(image, tag, cache_from, buildkit, timeout)
+
+
+def get_image_label(image, label):
+    """ Returns the value of an image label, or '' if the image or the label does not exist
+    """
+    value = utils.Command("docker inspect --format '{{ index .Config.Labels \"%s\" }}' %s" % (label, image)).stdout
+    return '' if value.strip() == '<no value>' else value.strip()
+
+
+def image_outdated(image, tag=None):
+    """ Returns True if the image built with these docker_build arguments does not match its context.
+        Without a local context to compare with, an existing image is current
+    """
+    context = context_hash(image, tag)
+    return context is not None and get_image_label(tag or image, CONTEXT_LABEL) != context
+
+
+# default host directory of package caches (conf 'package_cache'), see UnixFrontend.cache_parameters
+PACKAGE_CACHE = os.path.join(tempfile.gettempdir(), 'simply_cache')
 
+# resource conf keys of a platform, and their 'docker run' flags
+RESOURCES = OrderedDict((
+    ('cpus', '--cpus'),
+    ('cpuset', '--cpuset-cpus'),
+    ('memory', '--memory'),
+    ('pids_limit', '--pids-limit'),
+))
+
+
+def resource_parameters(**resources):
+    """ Translates resource limits into 'docker run' flags, see also simply.planner
+    :param cpus: number of cpus, eg 1.5
+    :param cpuset: cpus the container is pinned to, eg '0-3', '0,2' or a list of cpu ids
+    :param memory: memory limit, in bytes or with a unit suffix (b, k, m, g), eg '512m'
+    :param pids_limit: maximum number of processes in the container
+    """
+    flags = []
+    for key, flag in RESOURCES.iteritems():
+        value = resources.get(key)
+        if value is None:
+            continue
+        if key == 'cpuset' and not isinstance(value, basestring):
+            value = ','.join(str(cpu) for cpu in value)
+        flags.append('{} {}'.format(flag, value))
+    return ' '.join(flags)
 
-def docker_run(image, container=None, parameters=None, cmd=None):
+
+@invalidates('containers')
+def docker_run(image, container=None, parameters=None, cmd=None, timeout=None):
+    docker_cmd = run_command(image, container, parameters, cmd)
+    print(utils.yellow(docker_cmd))
+    return not utils.command(docker_cmd, timeout=timeout)
+
+
+def run_command(image, container=None, parameters=None, cmd=None):
     docker_cmd = 'docker run -di'
     if container:
         docker_cmd += ' --name {0}'.format(container)
@@ -223,14 +1045,38 @@ def docker_run(image, container=None, parameters=None, cmd=None):
     docker_cmd += ' ' + image
     if cmd:
         docker_cmd += ' ' + cmd
-    print(utils.yellow(docker_cmd))
-    return not utils.command(docker_cmd)
+    return docker_cmd
 
 
+@invalidates('images')
+def adocker_pull(image):
+    return utils.async_command('docker pull {}'.format(image)).then(lambda dock: not dock.returncode)
+
+
+@invalidates('images')
+def adocker_build(image, tag=None, cache_from=None, buildkit=False):
+    return utils.async_command(*build_command(image, tag, cache_from, buildkit)).\
+        then(lambda dock: not dock.returncode)
+
+
+@invalidates('containers')
+def adocker_run(image, container=None, parameters=None, cmd=None):
+    return utils.async_command(run_command(image, container, parameters, cmd)).\
+        then(lambda dock: not dock.returncode)
+
+
+@invalidates('images')
 def docker_commit(container, image):
     return not utils.command('docker commit {} {}'.format(container, image))
 
 
+def container_logs(container):
+    """ Returns the output (stdout and stderr) of a container main process
+    """
+    dock = utils.Command('docker logs {}'.format(container))
+    return dock.stdout + dock.stderr
+
+
 def get_container_ip(container, raises=True):
     docker_cmd = utils.Command("docker inspect --format '{{ .NetworkSettings.IPAddress }}' %s" % container)
     if raises and docker_cmd.stderr:
@@ -238,26 +1084,61 @@ def get_container_ip(container, raises=True):
     return docker_cmd.stdout.strip()
 
 
-def docker_exec(cmd, container, user=None, shell=False, daemon=False, raises=False, status_only=False, stdout_only=True):
+def docker_exec(cmd, container, user=None, shell=False, daemon=False, raises=False, status_only=False, stdout_only=True,
+                timeout=None):
     """ Executes a command on a running container via 'docker exec'
     :param cmd: the command to execute
     :param container: the target container
     :param shell: if True, execute in a /bin/sh shell
     :param user: an optional user (defaults to root)
+    :param daemon: if True, the command runs in background and an ExecHandle is returned to cancel it
     :param raises: if True, will raise a RuntimeError exception if command fails (return code != 0)
     :param status_only: If True, will return True if command succeeds, False if it fails
     :param stdout_only: If True, will return stdout as a string (default=True)
+    :param timeout: optional timeout in seconds, after which the command is killed, in the container too
     :return: a subprocess.Popen object, or a string if stdout_only=True, or a boolean if status_only=True
     """
+    if not (timeout or daemon):
+        docker_cmd = exec_command(cmd, container, user, shell)
+        return exec_output(utils.Command(docker_cmd), docker_cmd, container, raises, status_only, stdout_only)
+    pidfile = exec_pidfile()
+    script = watched_script(cmd, pidfile, shell, daemon)
+    docker_cmd = exec_command('/bin/sh -c {}'.format(pipes.quote(script)), container, user, daemon=daemon)
+    dock = utils.Command(docker_cmd, timeout=timeout)
+    if dock.timed_out:
+        kill_exec(container, pidfile)
+    if daemon and not dock.returncode:
+        wait_pidfile(container, pidfile, cmd)
+    ret = exec_output(dock, docker_cmd, container, raises, status_only, stdout_only, timeout)
+    return ExecHandle(container, pidfile) if daemon and not status_only else ret
+
+
+def exec_command(cmd, container, user=None, shell=False, daemon=False):
     if shell:
         cmd = '/bin/sh -c "{}"'.format(cmd)
-    docker_cmd = 'docker exec -{}i {} {} {}'.\
+    return 'docker exec -{}i {} {} {}'.\
         format('d' if daemon else '', '-u {}'.format(user) if user else '', container, cmd)
-    dock = utils.Command(docker_cmd)
+
+
+def adocker_exec(cmd, container, user=None, shell=False, daemon=False, raises=False, status_only=False,
+                 stdout_only=True):
+    """ Asynchronous flavour of docker_exec()
+    :return: a utils.Future
+    """
+    docker_cmd = exec_command(cmd, container, user, shell, daemon)
+    return utils.async_command(docker_cmd).\
+        then(lambda dock: exec_output(dock, docker_cmd, container, raises, status_only, stdout_only))
+
+
+def exec_output(dock, cmd, container, raises=False, status_only=False, stdout_only=True, timeout=None):
+    """ Formats the result of an executed command, see docker_exec
+    """
+    if raises and getattr(dock, 'timed_out', False):
+        raise RuntimeError("Timeout ({}s) while executing <{}> on {}".format(timeout, cmd, container))
     if raises and dock.returncode:
         raise RuntimeError(
             "Error while executing <{}> on {}: [{}]".
-                format(docker_cmd, container, dock.stderr.strip() or dock.returncode))
+                format(cmd, container, dock.stderr.strip() or dock.returncode))
     if status_only:
         return not dock.returncode
     if stdout_only:
@@ -265,8 +1146,270 @@ def docker_exec(cmd, container, user=None, shell=False, daemon=False, raises=Fal
     return dock
 
 
+# in-container pid files of commands that can be killed, see watched_script
+EXEC_PIDFILE = '/tmp/.simply_exec_{}.pid'
+# kills the process tree of a pid file, children first, fails if the pid file is missing or empty
+KILL_SCRIPT = 'kill_tree() { for c in $(cat /proc/$1/task/*/children 2>/dev/null); do kill_tree $c; done; ' \
+              'kill -9 $1 2>/dev/null; }; pid=$(cat %s 2>/dev/null); rm -f %s; [ -n "$pid" ] && kill_tree $pid'
+# waits up to 5 seconds for a pid file
+PIDFILE_WAIT_SCRIPT = 'i=0; until [ -e {} ]; do [ $i -ge 500 ] && exit 1; i=$((i + 1)); ' \
+                      'sleep 0.01 2>/dev/null || {{ i=$((i + 99)); sleep 1; }}; done'
+
+
+def exec_pidfile():
+    return EXEC_PIDFILE.format(utils.random_id(16))
+
+
+def watched_script(cmd, pidfile, shell=False, daemon=False):
+    """ Wraps a command in a shell script that records its pid in pidfile while it runs, see kill_exec
+    :param daemon: if True, the pid file is emptied instead of removed when the command ends,
+           so that wait_pidfile returns even for a command that ends at once; kill_exec removes it
+    """
+    if shell:
+        cmd = '/bin/sh -c {}'.format(pipes.quote(cmd))
+    return 'echo $$ >{0}\n{1}\nrc=$?\n{2} {0}\nexit $rc'.format(pidfile, cmd, ':>' if daemon else 'rm -f')
+
+
+def wait_pidfile(container, pidfile, cmd, execute=None):
+    """ Waits for the pid file of a command started with watched_script in a detached exec,
+        which returns before the command has started
+    :param execute: the docker_exec function to use
+    """
+    if not (execute or docker_exec)('/bin/sh -c {}'.format(pipes.quote(PIDFILE_WAIT_SCRIPT.format(pidfile))),
+                                    container, status_only=True):
+        raise RuntimeError("Command <{}> did not start on {}".format(cmd, container))
+
+
+def kill_exec(container, pidfile, execute=None):
+    """ Kills a command started with watched_script, and its children
+    :param execute: the docker_exec function to use
+    """
+    return (execute or docker_exec)('/bin/sh -c {}'.format(pipes.quote(KILL_SCRIPT % (pidfile, pidfile))),
+                                    container, status_only=True)
+
+
+class ExecHandle(object):
+    """ A command started in background by docker_exec(daemon=True)
+    """
+    def __init__(self, container, pidfile, execute=None):
+        self.container = container
+        self.pidfile = pidfile
+        self.execute = execute or docker_exec
+
+    def running(self):
+        return self.execute('/bin/sh -c {}'.format(pipes.quote('kill -0 $(cat {})'.format(self.pidfile))),
+                            self.container, status_only=True)
+
+    def cancel(self):
+        """ Kills the command and its children
+        """
+        return kill_exec(self.container, self.pidfile, self.execute)
+
+
+class ExecResult(object):
+    """ Mimics the attributes of utils.Command
+    """
+    def __init__(self, stdout='', stderr='', returncode=0):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = returncode
+
+
+def batch_script(cmds):
+    """ Builds a shell script that runs commands in sequence, then prints for each command
+        a header line '<returncode> <stdout length> <stderr length>' followed by its stdout and stderr
+    """
+    lines = ['d=$(mktemp -d 2>/dev/null || echo /tmp/.simply_batch_$$) && mkdir -p $d || exit 1']
+    for i, cmd in enumerate(cmds):
+        lines.append('(\n{}\n) </dev/null >$d/{i}.out 2>$d/{i}.err; echo $? >$d/{i}.rc'.format(cmd, i=i))
+    lines.append('for i in {}; do'.format(' '.join(str(i) for i in xrange(len(cmds)))))
+    lines.append('  echo $(cat $d/$i.rc) $(wc -c <$d/$i.out) $(wc -c <$d/$i.err)')
+    lines.append('  cat $d/$i.out $d/$i.err')
+    lines.append('done')
+    lines.append('rm -rf $d')
+    return '\n'.join(lines) + '\n'
+
+
+def parse_batch(output, count):
+    """ Parses the output of a batch script
+    :return: a list of ExecResult
+    """
+    results, pos = [], 0
+    for _ in xrange(count):
+        end = output.index('\n', pos)
+        returncode, out_len, err_len = (int(x) for x in output[pos:end].split())
+        start, pos = end + 1, end + 1 + out_len + err_len
+        results.append(ExecResult(output[start:start + out_len], output[start + out_len:pos], returncode))
+    return results
+
+
+def check_batch(cmds, container, dock, raises):
+    if dock.returncode:
+        raise RuntimeError("Error while executing batch on {}: [{}]".format(container, dock.stderr.strip()))
+    results = parse_batch(dock.stdout, len(cmds))
+    if raises:
+        for cmd, res in zip(cmds, results):
+            if res.returncode:
+                raise RuntimeError(
+                    "Error while executing <{}> on {}: [{}]".format(cmd, container, res.stderr.strip() or res.returncode))
+    return results
+
+
+def docker_exec_many(cmds, container, user=None, raises=False, timeout=None):
+    """ Executes a sequence of shell commands on a running container in a single 'docker exec'
+    :param cmds: a list of commands, ran in sequence even if some fail
+    :param raises: if True, will raise a RuntimeError exception if any command fails
+    :param timeout: optional timeout in seconds for the whole sequence, see docker_exec
+    :return: a list of objects with stdout, stderr and returncode attributes, one per command
+    """
+    if not cmds:
+        return []
+    dock = docker_exec('/bin/sh -c {}'.format(pipes.quote(batch_script(cmds))), container, user, stdout_only=False,
+                       raises=timeout is not None, timeout=timeout)
+    return check_batch(cmds, container, dock, raises)
+
+
+# maximum duration of a command ran by an exec agent, in seconds
+AGENT_TIMEOUT = 3600
+
+
+class ExecAgent(object):
+    """
+    A shell kept running in a container behind a single 'docker exec -i' channel.
+    Commands are written to its stdin, each response is framed on its stdout as:
+    stdout, then a line '<token> <returncode> <stderr length>', then stderr.
+    An agent that exits or times out is dead, see alive.
+    """
+
+    def __init__(self, args, container=None, user=None, timeout=None):
+        """
+        :param args: the command line running the agent shell, see start_agent
+        :param timeout: maximum duration of a command in seconds, default AGENT_TIMEOUT
+        """
+        self.container = container
+        self.user = user
+        self.timeout = timeout or AGENT_TIMEOUT
+        self.lock = threading.Lock()
+        self.buffer = ''
+        self.dead = False
+        with open(os.devnull, 'w') as devnull:
+            self.p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=devnull)
+        self.write('e=$(mktemp 2>/dev/null || echo /tmp/.simply_agent_$$)\n')
+
+    def alive(self):
+        return not self.dead and self.p.poll() is None
+
+    def write(self, data):
+        try:
+            self.p.stdin.write(data)
+            self.p.stdin.flush()
+        except IOError:
+            self.dead = True
+            raise RuntimeError("Agent on container {} has exited".format(self.container))
+
+    def read_until(self, size=None, marker=None, deadline=None):
+        """ Reads the channel until the buffer holds size bytes or the marker, consumes and returns them
+        :param deadline: a time.time() after which the agent is killed and a RuntimeError raised
+        """
+        fd = self.p.stdout.fileno()
+        while True:
+            if marker:
+                pos = self.buffer.find(marker)
+                end = pos + len(marker) if pos >= 0 else None
+            else:
+                end = size if len(self.buffer) >= size else None
+            if end is not None:
+                data, self.buffer = self.buffer[:end], self.buffer[end:]
+                return data
+            if deadline is not None and not select.select([fd], [], [], max(0, deadline - time.time()))[0]:
+                # the channel is out of sync with a pending response, the agent can't be reused
+                self.kill()
+                raise RuntimeError("Timeout ({}s) of agent on container {}".format(self.timeout, self.container))
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                self.dead = True
+                raise RuntimeError("Agent on container {} has exited".format(self.container))
+            self.buffer += chunk
+
+    def execute(self, cmd):
+        """ Runs a shell command through the agent. The command is evaluated in a subshell,
+            so that a syntax error or an exit does not end the agent
+        :return: an ExecResult
+        """
+        token = 'SIMPLY_{}'.format(utils.random_id(16))
+        deadline = time.time() + self.timeout
+        with self.lock:
+            if not self.alive():
+                raise RuntimeError("Agent on container {} has exited".format(self.container))
+            self.write('(eval {}) </dev/null 2>$e; echo "\n{} $? $(wc -c <$e)"; cat $e\n'.
+                       format(pipes.quote(cmd), token))
+            stdout = self.read_until(marker='\n{} '.format(token), deadline=deadline)[:-len(token) - 2]
+            returncode, err_len = (int(x) for x in self.read_until(marker='\n', deadline=deadline).split())
+            stderr = self.read_until(err_len, deadline=deadline)
+        return ExecResult(stdout, stderr, returncode)
+
+    def execute_many(self, cmds, raises=False):
+        if not cmds:
+            return []
+        return check_batch(cmds, self.container, self.execute(batch_script(cmds)), raises)
+
+    def kill(self):
+        self.dead = True
+        if self.p.poll() is None:
+            self.p.kill()
+            self.p.wait()
+
+    def close(self):
+        if not self.alive():
+            return self.kill()
+        self.write('rm -f $e; exit\n')
+        self.p.stdin.close()
+        self.p.wait()
+
+
+def start_agent(container, user=None, timeout=None):
+    """ Starts an ExecAgent on a running container
+    """
+    args = ['docker', 'exec', '-i'] + (['-u', user] if user else []) + [container, '/bin/sh']
+    return ExecAgent(args, container, user, timeout)
+
+
 def get_data(source, container):
-    return docker_exec('cat {}'.format(source), container, raises=True)
+    """ Gets the content of a container file as a string, see get_stream for large files
+    """
+    buf = cStringIO.StringIO()
+    get_stream(source, container, buf)
+    return buf.getvalue()
+
+
+def get_stream(source, container, fileobj, chunk_size=utils.CHUNK_SIZE):
+    """ Copies a container file to a file-like object, by chunks
+    :return: a utils.TransferStats
+    """
+    return utils.stream_from_command('docker exec -i {} cat {}'.format(container, source), fileobj, chunk_size)
+
+
+def iter_data(source, container, chunk_size=utils.CHUNK_SIZE):
+    """ Iterates over the content of a container file, by chunks
+    """
+    return utils.iter_command('docker exec -i {} cat {}'.format(container, source), chunk_size)
+
+
+def get_files(paths, container):
+    """ Gets many container files or directories in a single tar stream
+    :param paths: a list of absolute paths
+    :return: a utils.TarStore {absolute path: content} of the regular files found under paths
+    """
+    docker_cmd = 'docker exec {} tar cf - -C / {}'.format(
+        container, ' '.join(pipes.quote(path.lstrip('/') or '.') for path in paths))
+    return utils.tar_from_command(docker_cmd, prefix='/')
+
+
+def get_directory(path, container):
+    """ Gets a container directory in a single tar stream
+    :return: a utils.TarStore {relative path: content} of the regular files of the directory
+    """
+    return utils.tar_from_command('docker exec {} tar cf - -C {} .'.format(container, pipes.quote(path)))
 
 
 def put_file(source, dest, container):
@@ -280,20 +1423,124 @@ def path_exists(path, container):
 
 def put_data(data, dest, container, append=False):
     """ Copy data to a file with optional append.
-    :param data: string of data or object with read() method
+    :param data: string of data, object with read() method or iterable of strings
     :param dest: file path on target container. The directory must exist
     :param container: container name
     :param append: if True, the data is appended to the file, otherwise, the file is created or overwritten
     """
-    if append and not path_exists(dest, container):
-        docker_exec('touch {}'.format(dest), container)
+    return not put_stream(data, dest, container, append).returncode
+
+
+def put_stream(data, dest, container, append=False, chunk_size=utils.CHUNK_SIZE):
+    """ Copies data to a container file by chunks, see put_data.
+        Raises a RuntimeError if the copy fails.
+    :return: a utils.TransferStats
+    """
     docker_cmd = 'docker exec -i {} /bin/sh -c "cat {} {}"'.format(container, '>>' if append else '>', dest)
-    return not utils.command_input(docker_cmd, data.read() if hasattr(data, 'read') else data, raises=True)
+    return utils.stream_to_command(docker_cmd, data, chunk_size, raises=True)
+
+
+# where sync manifests are kept in containers, one per synced directory
+SYNC_MANIFESTS = '/tmp/.simply_sync'
+# local file hashes, by path, reused while (mtime, size) is unchanged
+_file_hashes = {}
+
+
+def file_hash(path):
+    """ Returns the sha1 of a local file, or 'link:<target>' for a symbolic link
+    """
+    if os.path.islink(path):
+        return 'link:' + os.readlink(path)
+    st = os.stat(path)
+    key = st.st_mtime, st.st_size
+    cached = _file_hashes.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in utils.iter_chunks(f):
+            sha.update(chunk)
+    _file_hashes[path] = key, sha.hexdigest()
+    return sha.hexdigest()
+
+
+def directory_manifest(source):
+    """ Hashes the files of a local directory, dotfiles included. Directories, so that empty ones are
+        synced too, have the hash 'dir'. Symbolic links to directories are not followed
+    :return: a dict {relative path: [hash, mode]}
+    """
+    manifest = {}
+    for root, dirs, files in os.walk(source):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            mode = stat.S_IMODE(os.lstat(path).st_mode)
+            is_dir = os.path.isdir(path) and not os.path.islink(path)
+            manifest[os.path.relpath(path, source)] = ['dir' if is_dir else file_hash(path), mode]
+    return manifest
+
+
+def sync_removals(local, remote, changed):
+    """ Returns the paths to remove before copying changed entries: removed ones, and those
+        turned from a directory into a file or a link, or the reverse
+    """
+    retyped = [path for path in changed
+               if path in remote and (remote[path][0] == 'dir') != (local[path][0] == 'dir')]
+    return sorted(set(remote) - set(local) | set(retyped))
+
+
+def sync_manifest_path(dest):
+    return '{}/{}.json'.format(SYNC_MANIFESTS, hashlib.sha1(dest).hexdigest())
+
+
+def get_sync_manifest(dest, container):
+    """ Returns the manifest of the last sync of a container directory, or {} if none
+    """
+    data = docker_exec('cat {}'.format(sync_manifest_path(dest)), container)
+    return json.loads(data) if data else {}
+
+
+def sync_directory(source, dest, container, force=False):
+    """ Copies a local directory to a container, dotfiles, empty directories and symbolic links included,
+        transferring only files added or changed since the last sync and deleting files removed since then.
+        A manifest of the synced files is kept in the container, so recreating the container
+        triggers a full copy. Files modified in the container are not detected, use force.
+    :param source: local directory path
+    :param dest: absolute directory path on target container, created if needed
+    :param force: if True, ignore the manifest and copy all files
+    :return: a utils.TransferStats, with lists of relative paths as attributes 'changed' and 'removed'
+    """
+    dest = os.path.normpath(os.path.join('/', dest))
+    local = directory_manifest(source)
+    remote = {} if force else get_sync_manifest(dest, container)
+    changed = sorted(path for path, entry in local.iteritems() if remote.get(path) != entry)
+    removed = sorted(set(remote) - set(local))
+    if changed or removed or not remote:
+        script = 'mkdir -p {0} && cd {0}'.format(pipes.quote(dest))
+        removals = sync_removals(local, remote, changed)
+        if removals:
+            script += ' && rm -rf -- ' + ' '.join(pipes.quote(path) for path in removals)
+        script += ' && tar xf - -C /'
+        manifest_path = sync_manifest_path(dest)
+
+        def write_tar(fileobj):
+            # uncompressed stream: changes are usually small and compression costs more than it saves
+            tar = tarfile.open(fileobj=fileobj, mode='w|')
+            for path in changed:
+                tar.add(os.path.join(source, path), arcname=os.path.join(dest, path).lstrip('/'), recursive=False)
+            data = json.dumps(local)
+            info = tarfile.TarInfo(manifest_path.lstrip('/'))
+            info.size = len(data)
+            tar.addfile(info, cStringIO.StringIO(data))
+            tar.close()
+        docker_cmd = 'docker exec -i {} /bin/sh -c {}'.format(container, pipes.quote(script))
+        stats = utils.stream_to_command(docker_cmd, write_tar, raises=True)
+    else:
+        stats = utils.TransferStats()
+    stats.changed, stats.removed = changed, removed
+    return stats
 
 
 def put_directory(source, dest, container):
-    docker_exec('mkdir -p {}'.format(dest), container, raises=True)
-    with utils.cd(source):
-        ret = utils.command('tar zc * | docker exec -i {} tar zx -C {}'.format(container, dest))
-        if ret:
-            raise RuntimeError("Error while copying {} to {}:{}".format(source, container, dest))
+    """ Copies a local directory to a container, see sync_directory
+    """
+    return sync_directory(source, dest, container)
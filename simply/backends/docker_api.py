@@ -0,0 +1,328 @@
+# encoding: utf-8
+
+"""
+Docker Engine API transport: talks to the docker daemon over its UNIX socket with one
+keep-alive HTTP connection per thread, instead of spawning the docker client for each call.
+Functions have the same signatures as their counterparts in simply.backends.docker.
+Operations not implemented here fall back on the docker client, including file transfers
+which are streamed through it.
+"""
+
+import httplib
+import json
+import os
+import shlex
+import socket
+import struct
+import threading
+import urllib
+
+from .docker import (docker_pull, docker_build, docker_run, docker_commit, image_delete,
+                     image_delete_and_containers, put_file, put_data, put_stream, put_directory,
+                     sync_directory, get_data, get_stream, iter_data, get_files, get_directory,
+                     CONTEXT_LABEL, context_hash, ExecResult, ExecHandle, exec_pidfile, watched_script, kill_exec,
+                     wait_pidfile, batch_script, check_batch, exec_output, invalidates,
+                     ImageRecord, ContainerRecord, Listing, container_state, image_names, container_names)
+
+DOCKER_SOCKET = '/var/run/docker.sock'
+# commands containing any of these are passed to /bin/sh -c instead of being split
+SHELL_CHARS = '|&;<>()$`*?'
+
+
+def get_socket_path():
+    host = os.environ.get('DOCKER_HOST', '')
+    if host.startswith('unix://'):
+        return host[len('unix://'):]
+    return DOCKER_SOCKET
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """ An HTTP connection over a UNIX socket
+    """
+    def __init__(self, path, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class EngineClient(object):
+    """ A minimal Docker Engine API client. Each thread gets its own persistent connection.
+    """
+    def __init__(self, path=None):
+        self.path = path or get_socket_path()
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = UnixHTTPConnection(self.path)
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def request(self, method, url, body=None, query=None, timeout=None):
+        """ Sends a request and reads the whole response
+        :param timeout: optional timeout in seconds for the whole request, socket.timeout is raised when it expires,
+               even if the response keeps streaming
+        :return: a tuple (status, data)
+        """
+        if query:
+            url += '?' + urllib.urlencode(query)
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        conn = self.connection()
+        conn.timeout = timeout
+        expired, socks = [], []
+
+        def expire():
+            # a socket timeout only bounds each read: shutting the socket down ends a streaming response.
+            # When the response closes the connection, the connection closes its socket object but the response
+            # keeps reading the underlying socket, hence socks
+            expired.append(True)
+            for sock in socks:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except (AttributeError, socket.error):
+                    pass
+
+        def send():
+            conn.request(method, url, body, headers)
+            socks.append(conn.sock._sock)
+            return conn.getresponse()
+        timer = threading.Timer(timeout, expire) if timeout else None
+        try:
+            if timer:
+                timer.daemon = True
+                timer.start()
+            if conn.sock:
+                conn.sock.settimeout(timeout)
+            try:
+                try:
+                    response = send()
+                except socket.timeout:
+                    raise
+                except (socket.error, httplib.HTTPException):
+                    if expired:
+                        raise
+                    # the daemon may have closed an idle keep-alive connection: retry once on a fresh one
+                    conn.close()
+                    response = send()
+                data = response.read()
+            except (socket.error, httplib.HTTPException):
+                if expired:
+                    raise socket.timeout('timed out')
+                raise
+            if expired:
+                raise socket.timeout('timed out')
+            return response.status, data
+        except socket.timeout:
+            # the response is incomplete, the connection can not be reused
+            conn.close()
+            raise
+        finally:
+            if timer:
+                timer.cancel()
+            conn.timeout = None
+            if conn.sock:
+                conn.sock.settimeout(None)
+
+    def json(self, method, url, body=None, query=None, allowed=()):
+        status, data = self.request(method, url, body, query)
+        if status >= 400 and status not in allowed:
+            raise RuntimeError("Engine API error {} on {} {}: {}".format(status, method, url, data.strip()))
+        return status, json.loads(data) if data else None
+
+
+_client = None
+
+
+def configure(path=None):
+    """ Sets the docker socket used by this module (default: $DOCKER_HOST or /var/run/docker.sock)
+    """
+    global _client
+    if _client is not None:
+        _client.close()
+    _client = EngineClient(path)
+    return _client
+
+
+def get_client():
+    return _client or configure()
+
+
+def demux(data):
+    """ Splits a multiplexed exec stream into stdout and stderr
+    """
+    out, err = [], []
+    pos = 0
+    while pos + 8 <= len(data):
+        stream, size = struct.unpack('>BxxxL', data[pos:pos + 8])
+        pos += 8
+        (err if stream == 2 else out).append(data[pos:pos + size])
+        pos += size
+    return ''.join(out), ''.join(err)
+
+
+def docker_version():
+    return get_client().json('GET', '/version')[1]['Version']
+
+
+def get_image_id(image):
+    status, info = get_client().json('GET', '/images/{}/json'.format(image), allowed=(404,))
+    return '' if status == 404 else info['Id']
+
+
+def get_image_label(image, label):
+    status, info = get_client().json('GET', '/images/{}/json'.format(image), allowed=(404,))
+    return '' if status == 404 else (info['Config'].get('Labels') or {}).get(label, '')
+
+
+def image_outdated(image, tag=None):
+    context = context_hash(image, tag)
+    return context is not None and get_image_label(tag or image, CONTEXT_LABEL) != context
+
+
+def list_images():
+    """ Returns a Listing of ImageRecord (id, repository, tag), one per repository tag
+    """
+    records = []
+    for image in get_client().json('GET', '/images/json')[1]:
+        for repo_tag in image.get('RepoTags') or ['<none>:<none>']:
+            repository, tag = repo_tag.rsplit(':', 1)
+            records.append(ImageRecord(image['Id'], repository, tag))
+    return Listing(records)
+
+
+def list_containers():
+    """ Returns a Listing of ContainerRecord (id, name, image, status, state) of all containers
+    """
+    return Listing([ContainerRecord(cont['Id'], cont['Names'][0].lstrip('/'), cont['Image'], cont['Status'],
+                                    cont.get('State') or container_state(cont['Status']))
+                    for cont in get_client().json('GET', '/containers/json', query=dict(all=1))[1]])
+
+
+def query_images(**criteria):
+    return list_images().select(**criteria)
+
+
+def query_containers(**criteria):
+    return list_containers().select(**criteria)
+
+
+def has_image(image):
+    return image in list_images().index('repository')
+
+
+def has_container(container, all=True):
+    return any(all or r.state == 'running' for r in list_containers().index('name').get(container, ()))
+
+
+def get_images(filter=None):
+    """ Get images names, with optional filter on name.
+    :param filter: if string, get images names containing it, if python container, get images in this set.
+    :return: a list of images names
+    """
+    return image_names(list_images(), filter)
+
+
+def get_containers(filter=None, image=None, all=True):
+    """ Get containers names, with optional filter on name.
+    :param filter: if string, get containers names containing it, if python container (list, set, ...),
+           get containers in this set.
+    :param image: if string, get containers from this image (ignore filter).
+    :param all: if False, get only running containers, else get all containers.
+    :return: a list of containers names
+    """
+    return container_names(list_containers(), filter, image, all)
+
+
+@invalidates('containers')
+def container_stop(*container, **kwargs):
+    image = kwargs.get('image')
+    ret = True
+    for cont in get_containers(image=image) if image else container:
+        # 304: container already stopped
+        ret &= get_client().request('POST', '/containers/{}/stop'.format(cont))[0] in (204, 304)
+    return ret
+
+
+@invalidates('containers')
+def container_delete(*container, **kwargs):
+    image = kwargs.get('image')
+    ret = container_stop(image=image, *container)
+    for cont in get_containers(image=image, all=True) if image else container:
+        ret &= get_client().request('DELETE', '/containers/{}'.format(cont))[0] == 204
+    return ret
+
+
+def get_container_ip(container, raises=True):
+    status, info = get_client().json('GET', '/containers/{}/json'.format(container), allowed=(404,))
+    if status == 404:
+        if raises:
+            raise RuntimeError("Container {} is not running".format(container))
+        return ''
+    return info['NetworkSettings']['IPAddress']
+
+
+def docker_exec(cmd, container, user=None, shell=False, daemon=False, raises=False, status_only=False, stdout_only=True,
+                timeout=None):
+    """ Executes a command on a running container via the Engine API
+    see simply.backends.docker.docker_exec for parameters
+    """
+    pidfile = None
+    if timeout or daemon:
+        pidfile = exec_pidfile()
+        args = ['/bin/sh', '-c', watched_script(cmd, pidfile, shell, daemon)]
+    elif shell or any(c in cmd for c in SHELL_CHARS):
+        args = ['/bin/sh', '-c', cmd]
+    else:
+        args = shlex.split(cmd)
+    config = dict(Cmd=args, AttachStdout=not daemon, AttachStderr=not daemon)
+    if user:
+        config['User'] = user
+    client = get_client()
+    exec_id = client.json('POST', '/containers/{}/exec'.format(container), config)[1]['Id']
+    dock = ExecResult()
+    try:
+        status, data = client.request('POST', '/exec/{}/start'.format(exec_id), dict(Detach=daemon, Tty=False),
+                                      timeout=timeout)
+    except socket.timeout:
+        kill_exec(container, pidfile, docker_exec)
+        dock.timed_out, dock.returncode = True, -1
+        return exec_output(dock, cmd, container, raises, status_only, stdout_only, timeout)
+    if status >= 400:
+        raise RuntimeError("Engine API error {} while executing <{}> on {}".format(status, cmd, container))
+    if daemon:
+        wait_pidfile(container, pidfile, cmd, docker_exec)
+    else:
+        dock.stdout, dock.stderr = demux(data)
+        dock.returncode = client.json('GET', '/exec/{}/json'.format(exec_id))[1]['ExitCode']
+    ret = exec_output(dock, cmd, container, raises, status_only, stdout_only)
+    return ExecHandle(container, pidfile, docker_exec) if daemon and not status_only else ret
+
+
+def docker_exec_many(cmds, container, user=None, raises=False, timeout=None):
+    """ Executes a sequence of shell commands in a single exec
+    see simply.backends.docker.docker_exec_many for parameters
+    """
+    if not cmds:
+        return []
+    dock = docker_exec(batch_script(cmds), container, user, shell=True, stdout_only=False,
+                       raises=timeout is not None, timeout=timeout)
+    return check_batch(cmds, container, dock, raises)
+
+
+def path_exists(path, container):
+    return docker_exec('test -e {}'.format(path), container, status_only=True)
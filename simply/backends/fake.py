@@ -0,0 +1,77 @@
+# encoding: utf-8
+
+"""
+Fake backend: a local backend (see local.py) whose commands are not executed but recorded,
+and answered from canned responses. It allows to test the commands issued by frontends.
+"""
+
+import re
+
+from .. import profiling, utils
+from .docker import ExecResult, exec_output
+from .local import LocalBackend
+
+
+class FakeBackend(LocalBackend):
+
+    def init_backend(self, conf):
+        """ conf 'responses' is an optional list of tuples (pattern, stdout, returncode, stderr), see respond
+        """
+        LocalBackend.init_backend(self, conf)
+        self.commands = []
+        self.responses = []
+        for response in conf.get('responses') or ():
+            self.respond(*response)
+        return self
+
+    def respond(self, pattern, stdout='', returncode=0, stderr=''):
+        """ Adds a canned response to the commands matching a regular expression.
+            The latest added response matching a command is used, commands without response succeed silently
+        """
+        self.responses.insert(0, (re.compile(pattern), ExecResult(stdout, stderr, returncode)))
+        return self
+
+    def response(self, cmd):
+        for regex, result in self.responses:
+            if regex.search(cmd):
+                return result
+        return ExecResult()
+
+    def executed(self, pattern=None):
+        """ Returns the recorded commands, or those matching a regular expression
+        """
+        return [cmd for cmd, user in self.commands if pattern is None or re.search(pattern, cmd)]
+
+    @profiling.timed('execute')
+    def execute(self, cmd, user=None, shell=False, daemon=False, raises=False, status_only=False, stdout_only=True,
+                timeout=None):
+        self.commands.append((cmd, user or self.user))
+        if daemon:
+            return FakeHandle()
+        return exec_output(self.response(cmd), cmd, self.container, raises, status_only, stdout_only)
+
+    def aexecute(self, cmd, user=None, raises=False, status_only=False, stdout_only=True, **kwargs):
+        future = utils.Future()
+        future.set_result(self.execute(cmd, user, raises=raises, status_only=status_only, stdout_only=stdout_only))
+        return future
+
+    @profiling.timed('execute')
+    def execute_many(self, cmds, user=None, raises=False):
+        results = []
+        for cmd in cmds:
+            self.commands.append((cmd, user or self.user))
+            results.append(self.response(cmd))
+            if raises and results[-1].returncode:
+                exec_output(results[-1], cmd, self.container, raises=True)
+        return results
+
+
+class FakeHandle(object):
+
+    def running(self):
+        return False
+
+    def cancel(self):
+        return True
+
+this_class = FakeBackend
@@ -0,0 +1,238 @@
+# encoding: utf-8
+
+"""
+Local backend: the 'container' of a platform is a directory on the host, and its commands are
+subprocesses ran in this directory (also their $HOME). There is no image and no isolation: commands
+run on the host as the current user. It allows to exercise frontend logic, provisioning and parallel
+runners in milliseconds, without a docker daemon.
+Paths of file transfers (sync_directory, get_files, ...) are relative to the platform directory,
+even absolute ones, but paths in commands are not translated.
+"""
+
+import json
+import os
+import pipes
+import shutil
+from subprocess import Popen
+import tempfile
+
+from .. import profiling, utils
+from .docker import (batch_script, check_batch, directory_manifest, exec_output, forget_container_state,
+                     provisioning_key, sync_manifest_path, sync_removals)
+
+LOCAL_ROOT = os.path.join(tempfile.gettempdir(), 'simply_local')
+
+
+class LocalBackend(object):
+
+    def init_backend(self, conf):
+        self.container = conf.get('container') or self.image + '_' + utils.random_id()
+        self.image_spec = conf.get('image_spec', '')
+        self.root = conf.get('local_root') or LOCAL_ROOT
+        self.provisioning = conf.get('provisioning')
+        # no volume to mount package caches on
+        self.package_cache = None
+        self.timeout = conf.get('timeout')
+        return self
+
+    @property
+    def workdir(self):
+        return os.path.join(self.root, self.image.replace(':', '_'), self.container)
+
+    def local_path(self, path):
+        return os.path.join(self.workdir, path.lstrip('/'))
+
+    def setup_backend(self):
+        return self
+
+    @profiling.timed('setup')
+    def setup(self, reset=None):
+        """ Creates the platform directory, then replays provisioning steps if conf 'provisioning' is set
+        """
+        self.build_image(reset)
+        return self.setup_container(reset)
+
+    def setup_container(self, reset=None):
+        """ The steps of setup following the image build, see DockerBackend.setup_container
+        """
+        self.run_container()
+        self.setup_backend()
+        if self.provisioning:
+            self.provision(self.provisioning)
+        return self
+
+    def commit_provisioning(self, steps=None):
+        """ Returns the name the provisioned image would have, nothing is committed
+        """
+        key = provisioning_key(self.image, self.provisioning_log if steps is None else steps)
+        return '{}_prov_{}'.format(self.image.replace(':', '_'), key[:16])
+
+    @profiling.timed('reset')
+    def reset(self, reset='rm_container'):
+        """ Resets a platform
+        :param reset: 'uproot', 'rm_image', 'all_containers': remove all directories of the platform image
+                      'rm_container': remove the platform directory
+                      'stop': no op
+        """
+        if reset and reset != 'stop':
+            forget_container_state(self)
+        if reset in ('uproot', 'rm_image', 'all_containers'):
+            self.delete_all_containers()
+        elif reset == 'rm_container':
+            self.container_delete()
+        return self
+
+    @profiling.timed('build')
+    def build_image(self, reset=None):
+        return self.reset(reset)
+
+    def image_parents(self):
+        return []
+
+    def get_real_images(self):
+        return [self.image]
+
+    def image_exist(self):
+        return True
+
+    @profiling.timed('run')
+    def run_container(self, reset=None):
+        self.reset(reset)
+        if not os.path.isdir(self.workdir):
+            forget_container_state(self)
+            os.makedirs(self.workdir)
+        return self
+
+    def get_real_containers(self, all=False):
+        return [self.container] if os.path.isdir(self.workdir) else []
+
+    def get_container_ip(self):
+        return '127.0.0.1'
+
+    def get_logs(self):
+        return ''
+
+    def image_delete(self, uproot=False):
+        return self.delete_all_containers()
+
+    def container_delete(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        return self
+
+    def delete_all_containers(self):
+        shutil.rmtree(os.path.dirname(self.workdir), ignore_errors=True)
+        return self
+
+    def shell_command(self, cmd):
+        """ Returns a host command running cmd in the platform directory
+        """
+        script = 'cd {0} || exit 1\nexport HOME={0}\n{1}'.format(pipes.quote(self.workdir), cmd)
+        return '/bin/sh -c {}'.format(pipes.quote(script))
+
+    @profiling.timed('execute')
+    def execute(self, cmd, user=None, shell=False, daemon=False, raises=False, status_only=False, stdout_only=True,
+                timeout=None):
+        """ Executes a shell command in the platform directory, see docker.docker_exec for parameters.
+            The user is ignored. A daemon command returns a ProcessHandle.
+        """
+        if daemon:
+            # the child keeps its own copies of the descriptors
+            with open(os.devnull, 'r+') as devnull:
+                return ProcessHandle(Popen(self.shell_command(cmd), shell=True, stdin=devnull, stdout=devnull,
+                                           stderr=devnull, preexec_fn=os.setsid))
+        timeout = timeout or self.timeout
+        dock = utils.Command(self.shell_command(cmd), timeout=timeout)
+        return exec_output(dock, cmd, self.container, raises, status_only, stdout_only, timeout)
+
+    def aexecute(self, cmd, user=None, raises=False, status_only=False, stdout_only=True, **kwargs):
+        return utils.async_command(self.shell_command(cmd)).\
+            then(lambda dock: exec_output(dock, cmd, self.container, raises, status_only, stdout_only))
+
+    def asetup(self):
+        future = utils.Future()
+        future.set_result(self.run_container())
+        return future
+
+    @profiling.timed('execute')
+    def execute_many(self, cmds, user=None, raises=False):
+        """ Executes a sequence of commands in a single subprocess, see docker.docker_exec_many
+        """
+        if not cmds:
+            return []
+        dock = utils.Command(self.shell_command(batch_script(cmds)), timeout=self.timeout)
+        return check_batch(cmds, self.container, dock, raises)
+
+    def path_exists(self, path):
+        return os.path.exists(self.local_path(path))
+
+    def sync_directory(self, source, dest, force=False):
+        """ Copies a local directory into the platform directory, see docker.sync_directory
+        """
+        dest = os.path.normpath(os.path.join('/', dest))
+        manifest_path = self.local_path(sync_manifest_path(dest))
+        local = directory_manifest(source)
+        remote = {}
+        if not force and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                remote = json.load(f)
+        changed = sorted(path for path, entry in local.iteritems() if remote.get(path) != entry)
+        removed = sorted(set(remote) - set(local))
+        stats = utils.TransferStats()
+        for path in sync_removals(local, remote, changed):
+            remove_path(self.local_path(os.path.join(dest, path)))
+        for path in changed:
+            target = self.local_path(os.path.join(dest, path))
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            if local[path][0] == 'dir':
+                if not os.path.isdir(target):
+                    os.mkdir(target)
+                os.chmod(target, local[path][1])
+                continue
+            remove_path(target)
+            if os.path.islink(os.path.join(source, path)):
+                os.symlink(os.readlink(os.path.join(source, path)), target)
+            else:
+                shutil.copy2(os.path.join(source, path), target)
+                stats.bytes += os.path.getsize(target)
+        if not os.path.isdir(os.path.dirname(manifest_path)):
+            os.makedirs(os.path.dirname(manifest_path))
+        with open(manifest_path, 'w') as f:
+            json.dump(local, f)
+        stats.changed, stats.removed = changed, removed
+        return stats
+
+    def get_files(self, paths):
+        return utils.tar_from_command('tar cf - -C {} {}'.format(
+            pipes.quote(self.workdir), ' '.join(pipes.quote(path.lstrip('/') or '.') for path in paths)), prefix='/')
+
+    def get_directory(self, path):
+        return utils.tar_from_command('tar cf - -C {} .'.format(pipes.quote(self.local_path(path))))
+
+
+def remove_path(path):
+    """ Removes a file, a link or a directory tree, if it exists
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class ProcessHandle(object):
+    """ A command started in background by LocalBackend.execute(daemon=True)
+    """
+    def __init__(self, p):
+        self.p = p
+
+    def running(self):
+        return self.p.poll() is None
+
+    def cancel(self):
+        """ Kills the command and its children
+        """
+        utils.kill_group(self.p)
+        self.p.wait()
+        return True
+
+this_class = LocalBackend
@@ -1,18 +1,33 @@
 # encoding: utf-8
 
-from .linux import UnixFrontend
+from .. import utils
+from .linux import shell_script, UnixFrontend
 
 
 def get_instance(platform, conf):
     return this_class(platform, conf)
 
 
-class BusyboxFrontend(UnixFrontend):
+OPKG_CONF = '/etc/opkg.conf'
 
-    def install_package(self, *package):
-        self.execute('opkg-install {}'.format(' '.join(package)))
 
-    def get_version(self, app):
-        raise RuntimeError("Method 'get_versio'n is not available")
+class BusyboxFrontend(UnixFrontend):
+    package_caches = (('opkg', '/var/cache/opkg'),)
+
+    def run_package_install(self, packages):
+        """ With package caches, installs hold package_lock: opkg-install updates the index and downloads
+            into the shared cache in the same command, so the installs of containers of the image are serialized
+        """
+        if self.package_installer_init and self.package_cache:
+            # opkg keeps downloaded packages only if a cache directory is configured
+            self.execute(shell_script("grep -q '^option cache' {0} 2>/dev/null || "
+                                      "echo 'option cache /var/cache/opkg' >>{0}".format(OPKG_CONF)))
+        self.package_installer_init = False
+        with self.package_lock():
+            self.execute('opkg-install {}'.format(' '.join(packages)))
+
+    def list_installed_packages(self):
+        # lines are 'name - version', or 'name - version - description'
+        return dict(utils.Table(self.execute('opkg list-installed', user='root'), sep=' - ').columns(0, 1))
 
 this_class = BusyboxFrontend
@@ -1,7 +1,12 @@
 # encoding: utf-8
 
 from .. import utils
-from .linux import UnixFrontend
+from .linux import shell_script, UnixFrontend
+
+# installs packages from the shared archives cache without locking it, see DebianFrontend.apt_get
+APT_NO_LOCKING = '-o Debug::NoLocking=1'
+# the shared package index cache, copied into the container's own index, see DebianFrontend.apt_get
+APT_LISTS_CACHE = '/var/cache/simply_apt_lists'
 
 
 def get_instance(platform, conf):
@@ -9,18 +14,51 @@ def get_instance(platform, conf):
 
 
 class DebianFrontend(UnixFrontend):
+    package_caches = (('apt-archives', '/var/cache/apt/archives'), ('apt-lists', APT_LISTS_CACHE))
 
-    def install_package(self, *package):
+    def run_package_install(self, packages):
         if self.package_installer_init:
-            self.execute('apt-get update && apt-get upgrade -y')
-            self.package_installer_init = False
-        self.execute('apt-get install -y {}'.format(' '.join(package)))
-
-    def get_version(self, app):
-        output = self.execute('apt-cache policy {}'.format(app), user='root')
-        try:
-            return utils.extract_column(utils.filter_column(output, 0, startswith='Install'), 1, sep=':')[0]
-        except IndexError:
-            pass
+            self.init_package_installer()
+        self.apt_get('install -y {}'.format(' '.join(packages)))
+
+    def init_package_installer(self):
+        """ Updates the package index, unless its cache is fresh, and upgrades packages.
+            With package caches, downloaded packages are kept (docker images clean them after each install)
+        """
+        if not self.package_cache:
+            self.execute(shell_script('apt-get update && apt-get upgrade -y'))
+        else:
+            self.apt_get('upgrade -y', init=True)
+        self.package_installer_init = False
+
+    def apt_get(self, args, init=False):
+        """ Runs an apt-get command. With package caches, only the accesses to the caches shared by the containers
+            of the image hold package_lock: the index update and its copy into the container's own index,
+            and the downloads. Packages are then installed outside of it, without apt locks on the archives
+            cache, so that containers install concurrently. As the container reads its own index,
+            an update of the shared one by another container does not change it during the install
+        :param init: if True, updates the shared package index first, unless its cache is fresh, then copies it
+        """
+        if not self.package_cache:
+            return self.execute('apt-get {}'.format(args))
+        with self.package_lock():
+            cmds, update = [], False
+            if init:
+                cmds.append('rm -f /etc/apt/apt.conf.d/docker-clean')
+                # checked under the lock, as the platform holding it before may have just updated the index
+                update = not self.package_index_fresh('apt-lists')
+                if update:
+                    cmds.append('mkdir -p {0}/partial && apt-get -o Dir::State::Lists={0} update'.
+                                format(APT_LISTS_CACHE))
+                cmds.append('cp -a {}/. /var/lib/apt/lists/'.format(APT_LISTS_CACHE))
+            cmds.append('apt-get {} --download-only'.format(args))
+            self.execute(shell_script(' && '.join(cmds)))
+            if update:
+                self.package_index_updated('apt-lists')
+        return self.execute('apt-get {} {}'.format(APT_NO_LOCKING, args))
+
+    def list_installed_packages(self):
+        output = self.execute("dpkg-query -W -f '${Status}\\t${Package}\\t${Version}\\n'", user='root')
+        return dict(utils.Table(output, sep='\t').filter((0, 'endswith', ' installed')).columns(1, 2))
 
 this_class = DebianFrontend
@@ -1,52 +1,408 @@
 # encoding: utf-8
 
+from contextlib import contextmanager
+from collections import namedtuple
+import functools
+import os
+import pipes
+import re
 import time
 
-from .. import utils
+from .. import profiling, utils
+
+
+def provisioning(func):
+    """ Records the calls of a provisioning method, in order, in the platform's provisioning_log,
+        see DockerBackend.commit_provisioning
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self.provisioning_log.append((func.__name__,) + args + ((kwargs,) if kwargs else ()))
+        return func(self, *args, **kwargs)
+    return wrapper
+
+
+def shell_script(script):
+    """ Returns a command running a shell script: execute() passes commands to 'docker exec' unquoted,
+        so that operators (&&, ||, >>, ...) of a bare command would run on the host
+    """
+    return '/bin/sh -c {}'.format(pipes.quote(script))
+
+
+def watcher_script(condition, timeout, interval=0.01, max_interval=0.5):
+    """ Builds a shell script checking a condition with exponential backoff, until it holds or timeout.
+        Fractional sleeps fall back on 1 second sleeps for shells that don't support them,
+        the timeout is then enforced with a 1 second resolution.
+    """
+    intervals, total = [], 0
+    while total < timeout:
+        intervals.append(interval)
+        total += interval
+        interval = min(interval * 2, max_interval)
+    return '\n'.join((
+        'end=$(($(date +%s) + {}))'.format(int(timeout + 0.999) + 1),
+        'for s in {}; do'.format(' '.join('{:g}'.format(i) for i in intervals)),
+        '  ({}) && exit 0'.format(condition),
+        '  [ $(date +%s) -ge $end ] && exit 1',
+        '  sleep $s 2>/dev/null || sleep 1',
+        'done',
+        '({})'.format(condition),
+    ))
+
+
+# lists processes from /proc in a single exec: the shell pid and /etc/passwd, then per process a record
+# (separated by \036) of its stat line, its Uid and VmRSS status lines, and its argv separated by \037
+PROCESS_SCRIPT = r"""echo $$; cat /etc/passwd
+cd /proc && for p in [0-9]*; do
+  [ -r $p/stat ] || continue
+  printf '\036'; cat $p/stat; grep -e '^Uid:' -e '^VmRSS:' $p/status; tr '\000\n' '\037\035' <$p/cmdline; echo
+done 2>/dev/null
+"""
+
+# holds if a process is named {name} (see Process.matches), {comm} being the name truncated as comm
+PROCESS_NAME_CONDITION = r"""grep -qxF -- {comm} /proc/[0-9]*/comm 2>/dev/null && exit 0
+cd /proc && for p in [0-9]*; do
+  a=$(tr '\000' '\n' <$p/cmdline | head -n 1)
+  [ "${{a##*/}}" = {name} ] && exit 0
+done 2>/dev/null
+exit 1"""
+
+
+class Process(namedtuple('Process', 'pid ppid user uid state rss argv comm start')):
+    """ A process of a snapshot. rss is in kB, start is the start time in clock ticks since boot,
+        comm is the kernel name of the process (truncated to 15 characters)
+    """
+    __slots__ = ()
+
+    @property
+    def name(self):
+        """ The program name: basename of argv[0], or comm for kernel threads and zombies
+        """
+        return os.path.basename(self.argv[0]) if self.argv and self.argv[0] else self.comm
+
+    @property
+    def cmdline(self):
+        return ' '.join(self.argv) or '[{}]'.format(self.comm)
+
+    def matches(self, name):
+        """ Returns True if name is the program name or the kernel name of the process, so that
+            scripts (whose argv[0] is their interpreter) and renamed processes are found by their name
+        """
+        return name in (self.name, self.comm) or self.comm == name[:15]
+
+
+class ProcessSnapshot(object):
+    """
+    The processes of a container at a point in time, read from /proc (see PROCESS_SCRIPT).
+    Snapshots can be filtered, and diffed to find started and ended processes.
+    """
+
+    def __init__(self, processes=(), time=None):
+        self.processes = list(processes)
+        self.time = time
+        self.by_pid = dict((proc.pid, proc) for proc in self.processes)
+
+    @classmethod
+    def parse(cls, output, time=None):
+        """ Parses the output of PROCESS_SCRIPT, without the processes of the script itself
+        """
+        records = output.split('\036')
+        header = records[0].splitlines()
+        if not header:
+            return cls(time=time)
+        script_pid, users = int(header[0]), {}
+        for line in header[1:]:
+            fields = line.split(':')
+            if len(fields) > 2:
+                users.setdefault(int(fields[2]), fields[0])
+        processes = []
+        for record in records[1:]:
+            lines = record.rstrip('\n').split('\n')
+            stat = lines[0]
+            if ')' not in stat:
+                continue
+            comm = stat[stat.index('(') + 1:stat.rindex(')')]
+            fields = stat[stat.rindex(')') + 2:].split()
+            pid, ppid = int(stat.split(' ', 1)[0]), int(fields[1])
+            if script_pid in (pid, ppid):
+                continue
+            uid, rss, argv = None, 0, []
+            for line in lines[1:]:
+                if line.startswith('Uid:'):
+                    uid = int(line.split()[1])
+                elif line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+                else:
+                    argv = line.replace('\035', '\n').rstrip('\037').split('\037') if line else []
+            processes.append(Process(pid, ppid, users.get(uid), uid, fields[0], rss, argv, comm, int(fields[19])))
+        return cls(processes, time)
+
+    def __iter__(self):
+        return iter(self.processes)
+
+    def __len__(self):
+        return len(self.processes)
+
+    def __contains__(self, pid):
+        return pid in self.by_pid
+
+    def __getitem__(self, pid):
+        return self.by_pid[pid]
+
+    def names(self):
+        return [proc.name for proc in self.processes]
+
+    def filter(self, pattern=None, name=None, user=None, pid=None, ppid=None, state=None):
+        """ Returns the snapshot of the processes matching all criteria
+        :param pattern: a regular expression searched in the command line
+        :param name: the program or kernel name, see Process.matches
+        :param user: a user name or uid
+        :param pid: a pid or a list of pids
+        :param ppid: a parent pid
+        :param state: a state letter (R, S, D, Z, ...)
+        """
+        regex = re.compile(pattern) if pattern else None
+        pids = (pid,) if isinstance(pid, (int, long)) else pid
+        return ProcessSnapshot((proc for proc in self.processes
+                                if (regex is None or regex.search(proc.cmdline)) and
+                                (name is None or proc.matches(name)) and
+                                (user is None or user in (proc.user, proc.uid)) and
+                                (pids is None or proc.pid in pids) and
+                                (ppid is None or proc.ppid == ppid) and
+                                (state is None or proc.state == state)), self.time)
+
+    def diff(self, earlier):
+        """ Compares with an earlier snapshot. A process is identified by its pid and start time
+        :return: a tuple of snapshots (started processes, ended processes)
+        """
+        keys = set((proc.pid, proc.start) for proc in self.processes)
+        earlier_keys = set((proc.pid, proc.start) for proc in earlier)
+        return (ProcessSnapshot((proc for proc in self.processes if (proc.pid, proc.start) not in earlier_keys),
+                                self.time),
+                ProcessSnapshot((proc for proc in earlier if (proc.pid, proc.start) not in keys), self.time))
+
+
+# in-container path of the pip cache, shared by all images
+PIP_CACHE = '/var/cache/simply_pip'
 
 
 class UnixFrontend(object):
     user = None
+    # caches of the package manager, mounted from the host per image: (cache name, path in the container)
+    package_caches = ()
 
     def init_frontend(self, conf):
         self.package_installer_init = True
+        self.package_index_ttl = conf.get('package_index_ttl', 3600)
+        self.package_queue = None
+        self.installed = None
+        self.process_ttl = conf.get('process_ttl', 0.2)
+        self.snapshot = None
         self.effective_user = self.user or 'root'
+        self.provisioning_log = []
+
+    def forget_container_state(self):
+        """ Forgets what is known of the container (installed packages, processes, package index),
+            called by backends when the container is deleted or re-created
+        """
+        self.package_installer_init = True
+        self.installed = None
+        self.snapshot = None
+
+    def cache_parameters(self):
+        """ Returns the 'docker run' flags mounting the host package caches (in conf 'package_cache' directory):
+            package manager caches per image, and a pip cache shared by all images
+        """
+        volumes = [(self.package_cache_dir(name), path) for name, path in self.package_caches]
+        volumes.append((self.package_cache_dir('pip', shared=True), PIP_CACHE))
+        for host_path, _ in volumes:
+            if not os.path.isdir(host_path):
+                os.makedirs(host_path)
+        return ' '.join(['-v {}:{}'.format(host_path, path) for host_path, path in volumes] +
+                        ['-e PIP_CACHE_DIR={}'.format(PIP_CACHE)])
+
+    def package_cache_dir(self, name, shared=False):
+        """ Returns the host directory of a package cache. Provisioned images use the caches of their base image
+        """
+        if shared:
+            return os.path.join(self.package_cache, name)
+        image = getattr(self, 'base_image', None) or self.image
+        return os.path.join(self.package_cache, image.replace('/', '_').replace(':', '_'), name)
+
+    @contextmanager
+    def package_lock(self):
+        """ Serializes the writes of platforms to the package caches of an image, across threads and processes
+        """
+        if not self.package_cache:
+            yield
+            return
+        with utils.named_lock('package_cache_' + self.package_cache_dir('index')):
+            yield
+
+    def package_index_fresh(self, name):
+        """ Returns True if the package index cache was updated less than conf 'package_index_ttl' seconds ago
+        """
+        if not (self.package_cache and self.package_index_ttl):
+            return False
+        path = self.package_cache_dir(name)
+        try:
+            return time.time() - os.path.getmtime(path + '.updated') < self.package_index_ttl and \
+                any(f not in ('lock', 'partial', 'auxfiles') for f in os.listdir(path))
+        except OSError:
+            return False
+
+    def package_index_updated(self, name):
+        """ Records the update time of a package index cache, if the cache is mounted
+        """
+        path = self.package_cache_dir(name) if self.package_cache else None
+        if path and os.path.isdir(path):
+            with open(path + '.updated', 'a'):
+                pass
+            os.utime(path + '.updated', None)
 
     def setup_frontend(self):
         pass
 
+    @profiling.timed('frontend')
+    @provisioning
+    def install_package(self, *package):
+        """ Installs the packages not installed yet, in a single transaction.
+            Within a package_transaction(), packages are queued and installed when it ends
+        """
+        if self.package_queue is not None:
+            self.package_queue.extend(p for p in package if p not in self.package_queue)
+        else:
+            self.install_packages(package)
+
+    def install_packages(self, packages):
+        packages = [p for p in packages if p not in self.get_installed_packages()]
+        if packages:
+            self.run_package_install(packages)
+            self.installed = None
+
+    @contextmanager
+    def package_transaction(self):
+        """ Queues the install_package calls of the enclosed block, then installs all packages at once.
+            Nothing is installed if the block raises, nested transactions are part of the outer one
+        """
+        if self.package_queue is not None:
+            yield
+            return
+        self.package_queue = []
+        try:
+            yield
+            queue = self.package_queue
+        finally:
+            self.package_queue = None
+        self.install_packages(queue)
+
+    def get_installed_packages(self):
+        """ Returns the installed packages {name: version} of the container, listed once and memoized
+            until the next install
+        """
+        if self.installed is None or self.installed[0] != self.container:
+            self.installed = self.container, self.list_installed_packages()
+        return self.installed[1]
+
+    def get_version(self, app):
+        """ Returns the installed version of a package, or None
+        """
+        return self.get_installed_packages().get(app)
+
+    @profiling.timed('frontend')
+    @provisioning
     def create_user(self, user, groups=(), home=None, shell=None):
-        """ Create a user with optional groups, home and shell
-        """
-        cmd = 'useradd {}{}{}'.\
-            format(user,
-                   ' -d {}'.format(home) if home else '',
-                   ' -s {}'.format(shell) if shell else '')
-        self.execute(cmd)
-        existing_groups = utils.extract_column(self.execute('cat /etc/group'), 0, sep=':')
+        """ Create a user with optional groups, home and shell, in a single exec
+        """
+        cmds = ['useradd {}{}{}'.
+                format(user,
+                       ' -d {}'.format(home) if home else '',
+                       ' -s {}'.format(shell) if shell else '')]
         for group in groups:
-            if group not in existing_groups:
-                self.execute('addgroup {}'.format(group))
-            self.execute('usermod -a -G {} {}'.format(group, user))
+            cmds.append('grep -q "^{0}:" /etc/group || addgroup {0}'.format(group))
+            cmds.append('usermod -a -G {} {}'.format(group, user))
+        self.execute_many(cmds)
 
+    @profiling.timed('frontend')
+    @provisioning
     def path_set_user(self, path, user,  group=None, recursive=False):
-        cmd = 'chown{} {}{} {}'.format(' -R' if recursive else '', user, ':{}'.format(group) if group else '', path)
-        return self.execute(cmd, status_only=True, raises=True)
+        """ Changes owner of a path, or of a list of paths in a single exec
+        """
+        paths = [path] if isinstance(path, basestring) else path
+        cmds = ['chown{} {}{} {}'.format(' -R' if recursive else '', user, ':{}'.format(group) if group else '', p)
+                for p in paths]
+        return bool(self.execute_many(cmds, raises=True))
 
+    @profiling.timed('frontend')
+    @provisioning
     def set_permissions(self, path, perms, recursive=False):
-        cmd = 'chmod{} {} {}'.format(' -R' if recursive else '', perms, path)
-        return self.execute(cmd, status_only=True, raises=True)
+        """ Changes permissions of a path, or of a list of paths in a single exec
+        """
+        paths = [path] if isinstance(path, basestring) else path
+        cmds = ['chmod{} {} {}'.format(' -R' if recursive else '', perms, p) for p in paths]
+        return bool(self.execute_many(cmds, raises=True))
 
+    @profiling.timed('wait')
     def wait_running_process(self, cmd, timeout=1):
-        count, step = timeout, 0.2
-        while count > 0:
-            if cmd in utils.extract_column(self.execute('ps -A', user='root'), -1, 1):
-                return True
-            time.sleep(step)
-            count -= step
+        return self.wait_process(cmd, timeout)
+
+    @profiling.timed('wait')
+    def wait_for(self, condition, timeout=5):
+        """ Waits until a shell condition holds, with a single watcher running in the container
+        :return: True if the condition holds before timeout
+        """
+        return not self.execute_many([watcher_script(condition, timeout)], user='root')[0].returncode
+
+    @profiling.timed('wait')
+    def wait_process(self, cmd, timeout=5):
+        """ Waits for a process named cmd (see Process.matches), with a single watcher running in the container.
+            The snapshot is refreshed once the process is found
+        """
+        found = self.wait_for(PROCESS_NAME_CONDITION.format(name=pipes.quote(cmd), comm=pipes.quote(cmd[:15])),
+                              timeout)
+        if found:
+            self.get_snapshot(max_age=0)
+        return found
+
+    @profiling.timed('wait')
+    def wait_file(self, path, timeout=5):
+        return self.wait_for('test -e {}'.format(pipes.quote(path)), timeout)
+
+    @profiling.timed('wait')
+    def wait_port(self, port, timeout=5, host=False):
+        """ Waits for a TCP port to be listening
+        :param host: if True, connect from the host to the container ip, otherwise, check /proc/net/tcp
+        """
+        if host:
+            address = (self.get_container_ip(), port)
+            return utils.wait_until(lambda: utils.can_connect(address), timeout)
+        return self.wait_for("grep -qE ':{:04X} [0-9A-F]+:[0-9A-F]+ 0A ' /proc/net/tcp /proc/net/tcp6 2>/dev/null".
+                             format(port), timeout)
+
+    @profiling.timed('wait')
+    def wait_log(self, pattern, path=None, timeout=5):
+        """ Waits for a line matching a regular expression in a file, or in the container logs if path is None
+        """
+        if path is None:
+            regex = re.compile(pattern)
+            return utils.wait_until(lambda: regex.search(self.get_logs()), timeout)
+        return self.wait_for('grep -qE -- {} {}'.format(pipes.quote(pattern), pipes.quote(path)), timeout)
+
+    def get_snapshot(self, max_age=None):
+        """ Returns a ProcessSnapshot of the container, cached for conf 'process_ttl' seconds (default 0.2)
+        :param max_age: maximum age of a cached snapshot, defaults to conf 'process_ttl'
+        """
+        max_age = self.process_ttl if max_age is None else max_age
+        now = time.time()
+        if self.snapshot is None or self.snapshot[0] != self.container or now - self.snapshot[1].time > max_age:
+            output = self.execute(shell_script(PROCESS_SCRIPT), user='root')
+            self.snapshot = self.container, ProcessSnapshot.parse(output, now)
+        return self.snapshot[1]
 
     def get_processes(self, filter=None):
-        processes = utils.extract_column(self.execute('ps -A', user='root'), -1, 1)
+        """ Returns the program names of the processes, or of those whose command line contains filter
+        """
+        snapshot = self.get_snapshot()
         if filter is None:
-            return processes
-        return [proc for proc in processes if filter in proc]
+            return snapshot.names()
+        return [proc.name for proc in snapshot if filter in proc.cmdline]
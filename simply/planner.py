@@ -0,0 +1,147 @@
+# encoding: utf-8
+
+"""
+Plans the concurrent run of a matrix of platforms on the host: how many platforms are set up at once,
+given the cores and memory they need, and a disjoint cpuset for each of them while there are enough cores,
+so that running containers don't compete for the same cores. See PlatformPool(planner=...).
+"""
+
+import math
+import multiprocessing
+import os
+import re
+
+from .utils import ConfAttrDict
+
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+
+def parse_size(size):
+    """ Converts a docker memory size (eg 512m, 2g, 1048576) into bytes
+    """
+    if size is None or isinstance(size, (int, long)):
+        return size
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([bkmg]?)b?$', size.strip().lower())
+    if not match:
+        raise RuntimeError("Invalid memory size: {}".format(size))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def parse_cpuset(cpuset):
+    """ Converts a cpu list (eg '0-3,6') into a list of cpu ids
+    """
+    cpus = []
+    for part in cpuset.split(','):
+        first, _, last = part.strip().partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpuset(cpus):
+    """ Converts a list of cpu ids into a cpu list, with ranges (eg '0-3,6')
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in ranges)
+
+
+def host_cpus():
+    """ Returns the ids of the cpus this process may run on
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    return parse_cpuset(line.split(':', 1)[1])
+    except IOError:
+        pass
+    return range(multiprocessing.cpu_count())
+
+
+def host_memory():
+    """ Returns the available memory in bytes, or None if unknown
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+
+def xdist_share():
+    """ Returns (index, count) of the current pytest-xdist worker, (0, 1) when not running under xdist
+    """
+    worker = os.environ.get('PYTEST_XDIST_WORKER', '')
+    count = int(os.environ.get('PYTEST_XDIST_WORKER_COUNT', 1))
+    if worker.startswith('gw') and count > 1:
+        return int(worker[2:]) % count, count
+    return 0, 1
+
+
+class ResourcePlanner(object):
+    """
+    Plans platforms on a set of cpus and an amount of memory.
+    A platform needs ceil(conf 'cpus') cores (default 1) and conf 'memory' bytes (default 0).
+    Under pytest-xdist, each worker plans on its own share of the cpus and memory.
+    """
+
+    def __init__(self, cpus=None, memory=None, share=None):
+        """
+        :param cpus: ids of the cpus to use, default: the cpus this process may run on
+        :param memory: memory to use in bytes, or with a unit suffix, default: the available memory
+        :param share: (index, count) to plan on the index-th of count equal shares of the cpus and memory,
+               default: the share of the current xdist worker
+        """
+        cpus = sorted(host_cpus() if cpus is None else parse_cpuset(cpus) if isinstance(cpus, basestring) else cpus)
+        memory = parse_size(host_memory() if memory is None else memory)
+        index, count = share or xdist_share()
+        if count > 1:
+            size = max(1, len(cpus) // count)
+            cpus = cpus[index * size % len(cpus):][:size]
+            memory = memory // count if memory else memory
+        self.cpus = cpus
+        self.memory = memory
+
+    @staticmethod
+    def needs(conf):
+        """ Returns the (cores, memory bytes) needed by a platform
+        """
+        return int(math.ceil(float(conf.get('cpus') or 1))), parse_size(conf.get('memory')) or 0
+
+    def concurrency(self, confs):
+        """ Returns how many of these platforms can be set up at once without sharing cores or exceeding memory
+        """
+        if not confs:
+            return 1
+        needs = [self.needs(conf) for conf in confs]
+        slots = len(self.cpus) // max(cores for cores, _ in needs)
+        memory = max(mem for _, mem in needs)
+        if memory and self.memory:
+            slots = min(slots, self.memory // memory)
+        return max(1, min(slots, len(confs)))
+
+    def plan(self, confs):
+        """ Splits the cpus into disjoint cpusets for the platforms. Containers keep running after their setup,
+            so cpusets are sized from the number of platforms, not from the concurrency of the setup:
+            there are as many cpusets as platforms fit on the cpus, with the cores they need. Platform i is
+            pinned to cpuset i modulo this number, platforms share cpusets only when there are not enough cores.
+            A conf 'cpuset' already set is kept.
+        :return: (concurrency, a list of confs with their 'cpuset')
+        """
+        concurrency = self.concurrency(confs)
+        cores = max([self.needs(conf)[0] for conf in confs] or [1])
+        slots = max(1, min(len(confs), len(self.cpus) // cores))
+        size = max(1, len(self.cpus) // slots)
+        planned = []
+        for i, conf in enumerate(confs):
+            if conf.get('cpuset') is None:
+                slot = i % slots
+                conf = ConfAttrDict(conf, cpuset=format_cpuset(self.cpus[slot * size:][:size]))
+            planned.append(conf)
+        return concurrency, planned
@@ -1,12 +1,18 @@
 # encoding: utf-8
 
+from collections import OrderedDict
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
 
 import pytest
 
-from utils import mixin_factory
+from utils import ConfAttrDict, mixin_factory, random_id
 import backends
+from backends.docker import BuildScheduler
 import frontends
+from planner import ResourcePlanner
 
 
 def get_class(conf):
@@ -28,6 +34,17 @@ class Platform(object):
         self.init_backend(conf)
         self.init_frontend(conf)
 
+    def provision(self, steps):
+        """ Replays provisioning steps, then commits them with the backend (to a provisioned image for docker)
+        :param steps: a list of tuples (method name, args..., optional kwargs dict),
+               eg [('install_package', 'curl'), ('create_user', 'bob', {'groups': ['staff']})]
+        :return: the provisioned image name
+        """
+        for step in steps:
+            kwargs = step[-1] if isinstance(step[-1], dict) else {}
+            getattr(self, step[0])(*step[1:len(step) - bool(kwargs)], **kwargs)
+        return self.commit_provisioning(steps)
+
     def __enter__(self):
         self.setup_backend()
         self.setup_frontend()
@@ -44,3 +61,115 @@ def platform_setup(conf):
     yield platform
     if not pytest.config.getoption('--keep-running'):
         platform.reset()
+
+
+def xdist_worker():
+    """ Returns the pytest-xdist worker id (eg 'gw0'), or None when not running under xdist
+    """
+    return os.environ.get('PYTEST_XDIST_WORKER')
+
+
+class PlatformPool(object):
+    """
+    A matrix of platforms set up concurrently with a bounded pool of workers.
+    Images shared by several platforms are built only once, then all containers are started.
+    Under pytest-xdist, each worker runs its own containers, named after the worker id.
+    """
+
+    def __init__(self, confs, workers=4, xdist=None, planner=None):
+        """
+        :param confs: a list of platform configurations. Platforms are keyed by conf 'name' or 'image'
+        :param workers: maximum number of concurrent builds or container starts
+        :param xdist: the xdist worker id, autodetected if None
+        :param planner: a planner.ResourcePlanner, or True for one planning on the host resources.
+               It then decides the number of workers, and pins platforms to disjoint cpusets
+        """
+        if planner:
+            planner = ResourcePlanner() if planner is True else planner
+            workers, confs = planner.plan(confs)
+        self.workers = workers
+        self.xdist = xdist_worker() if xdist is None else xdist
+        self.platforms = OrderedDict()
+        for conf in confs:
+            if self.xdist and not conf.get('container'):
+                conf = ConfAttrDict(conf, container='{}_{}_{}'.format(conf['image'], self.xdist, random_id()))
+            self.platforms[conf.get('name') or conf['image']] = factory(conf)
+        self.leases = {}
+        for key, platform in self.platforms.items():
+            self.leases[key] = Queue.Queue()
+            self.leases[key].put(platform)
+
+    def __getitem__(self, key):
+        return self.platforms[key]
+
+    def __iter__(self):
+        return iter(self.platforms.values())
+
+    def __len__(self):
+        return len(self.platforms)
+
+    def __enter__(self):
+        return self.setup()
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def map(self, func, items):
+        """ Applies func to items concurrently, and returns the list of results
+        """
+        items = list(items)
+        if not items:
+            return []
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def images(self):
+        """ Returns one platform per distinct image
+        """
+        images = OrderedDict()
+        for platform in self:
+            images.setdefault((platform.image, platform.image_spec), platform)
+        return images.values()
+
+    def setup(self, reset='all_containers'):
+        """ Builds the images concurrently in dependency order, then sets up the containers like
+            Platform.setup does after its build: provisioning, exec agent, ...
+        :param reset: see Platform.reset, applied by the builds. Under xdist, image wide resets
+               ('all_containers', 'uproot') are skipped because other workers share the images.
+        """
+        if self.xdist and reset in ('all_containers', 'uproot'):
+            reset = None
+        scheduler = BuildScheduler(self.workers)
+        for platform in self.images():
+            scheduler.add_platform(platform, reset)
+        scheduler.run()
+        # no image wide reset here: platforms of the same provisioned image would remove each other's containers
+        self.map(lambda platform: platform.setup_container(), self)
+        return self
+
+    def reset(self, reset='rm_container'):
+        self.map(lambda platform: platform.reset(reset), self)
+        return self
+
+    @contextmanager
+    def lease(self, key, timeout=None):
+        """ Leases a platform for exclusive use, blocks until it is available
+        """
+        platform = self.leases[key].get(timeout=timeout)
+        try:
+            yield platform
+        finally:
+            self.leases[key].put(platform)
+
+
+@contextmanager
+def platform_matrix(confs, workers=4, planner=None):
+    pool = PlatformPool(confs, workers, planner=planner)
+    pool.setup('uproot' if pytest.config.getoption('--reset') else 'all_containers')
+    yield pool
+    if not pytest.config.getoption('--keep-running'):
+        pool.reset()
@@ -0,0 +1,187 @@
+# encoding: utf-8
+
+"""
+Timing instrumentation: records wall time, bytes in/out and counts of simply operations
+(shell commands, platform setup phases, frontend methods) per platform and phase.
+Recording is off by default, see Profiler.enable() or pytest option --timings.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Span(object):
+    """ A timed operation. bytes_in and bytes_out are the bytes sent to and received from a command
+    """
+    __slots__ = ('phase', 'name', 'platform', 'context', 'start', 'duration', 'bytes_in', 'bytes_out', 'thread')
+
+    def __init__(self, phase, name, platform=None, context=None):
+        self.phase = phase
+        self.name = name
+        self.platform = platform
+        self.context = context
+        self.start = time.time()
+        self.duration = 0.0
+        self.bytes_in = self.bytes_out = 0
+        self.thread = threading.current_thread().ident
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+
+class Profiler(object):
+    """
+    Collects spans from all threads. Spans nested in a platform span (eg a command executed
+    during a build) are attributed to that platform, with the enclosing phase as context.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = []
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        return self
+
+    def clear(self):
+        with self.lock:
+            self.spans = []
+
+    def current(self):
+        stack = getattr(self.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, phase, name, platform=None):
+        """ Times the enclosed block. Yields a Span (or None if disabled) whose byte counts can be set
+        """
+        if not self.enabled:
+            yield None
+            return
+        parent = self.current()
+        if parent is not None:
+            platform = platform or parent.platform
+        span = Span(phase, name, platform, parent.phase if parent else None)
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+            span.duration = time.time() - span.start
+            with self.lock:
+                self.spans.append(span)
+
+    def summary(self):
+        """ Aggregates spans by (platform, phase)
+        :return: an OrderedDict {(platform, phase): dict(count, seconds, bytes_in, bytes_out)}, by decreasing time
+        """
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault((span.platform, span.phase), dict(count=0, seconds=0.0, bytes_in=0, bytes_out=0))
+            total['count'] += 1
+            total['seconds'] += span.duration
+            total['bytes_in'] += span.bytes_in
+            total['bytes_out'] += span.bytes_out
+        return OrderedDict(sorted(totals.items(), key=lambda item: -item[1]['seconds']))
+
+    def slowest(self, phase=None, count=10):
+        spans = [span for span in self.spans if phase is None or span.phase == phase]
+        return sorted(spans, key=lambda span: -span.duration)[:count]
+
+    def report(self, count=10):
+        """ Returns a text report: time per platform and phase, then the slowest commands
+        """
+        lines = ['{:<30} {:<16} {:>6} {:>10} {:>12} {:>12}'.format(
+            'platform', 'phase', 'count', 'seconds', 'bytes in', 'bytes out')]
+        for (platform, phase), total in self.summary().items():
+            lines.append('{:<30} {:<16} {count:>6} {seconds:>10.3f} {bytes_in:>12} {bytes_out:>12}'.format(
+                platform or '-', phase, **total))
+        lines.append('')
+        lines.append('slowest commands:')
+        for span in self.slowest('command', count):
+            lines.append('{:>10.3f}s {} [{}] {}'.format(span.duration, span.platform or '-', span.context or '-',
+                                                        span.name[:100]))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return dict(spans=[span.as_dict() for span in self.spans],
+                    summary=[dict(platform=key[0], phase=key[1], **total) for key, total in self.summary().items()])
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, indent=1)
+
+    def to_trace(self):
+        """ Returns the spans in Chrome trace event format (chrome://tracing, Perfetto)
+        """
+        pid = os.getpid()
+        return dict(traceEvents=[dict(name=span.name[:100], cat=span.phase, ph='X', pid=pid, tid=span.thread,
+                                      ts=int(span.start * 1e6), dur=int(span.duration * 1e6),
+                                      args=dict(platform=span.platform, bytes_in=span.bytes_in,
+                                                bytes_out=span.bytes_out))
+                                 for span in self.spans])
+
+    def dump_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_trace(), f)
+
+
+profiler = Profiler()
+
+
+def platform_name(obj):
+    return getattr(obj, 'name', None) or getattr(obj, 'image', None)
+
+
+def timed(phase):
+    """ Decorator timing a platform method in profiler
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not profiler.enabled:
+                return func(self, *args, **kwargs)
+            with profiler.span(phase, func.__name__, platform_name(self)):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ======================= PYTEST HOOKS =======================
+
+def pytest_addoption(parser):
+    parser.addoption('--timings', action='store_true',
+                     help="record timings of simply operations and report them")
+    parser.addoption('--timings-json', metavar='PATH',
+                     help="save timings of simply operations as JSON (implies --timings)")
+    parser.addoption('--timings-trace', metavar='PATH',
+                     help="save timings of simply operations in Chrome trace format (implies --timings)")
+
+
+def pytest_configure(config):
+    if config.getoption('--timings') or config.getoption('--timings-json') or config.getoption('--timings-trace'):
+        profiler.enable()
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not profiler.enabled:
+        return
+    config = terminalreporter.config
+    # each pytest-xdist worker saves its own files
+    suffix = '.' + os.environ['PYTEST_XDIST_WORKER'] if os.environ.get('PYTEST_XDIST_WORKER') else ''
+    if config.getoption('--timings-json'):
+        profiler.dump_json(config.getoption('--timings-json') + suffix)
+    if config.getoption('--timings-trace'):
+        profiler.dump_trace(config.getoption('--timings-trace') + suffix)
+    terminalreporter.write_sep('=', 'simply timings')
+    terminalreporter.write_line(profiler.report())
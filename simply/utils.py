@@ -1,18 +1,33 @@
 # encoding: utf-8
 
+import collections
 from contextlib import contextmanager
 import cStringIO
+import errno
+import fcntl
+import functools
+import operator
 import os
 import random
+import re
+import select
+import signal
+import socket
 from subprocess import Popen, PIPE, call
 import sys
+import tarfile
+import tempfile
 import threading
+import time
+import traceback
+
+from .profiling import profiler
 
 
 # ======================= GENERAL UTILILITIES =======================
 
 def extract_column(text, column, start=0, sep=None):
-    """ Extracts columns from a formatted text
+    """ Extracts columns from a formatted text, see Table to extract several columns
     :param text:
     :param column: the column number: from 0, -1 = last column
     :param start: the line number to start with (headers removal)
@@ -22,16 +37,13 @@ def extract_column(text, column, start=0, sep=None):
     lines = text.splitlines() if isinstance(text, basestring) else text
     if start:
         lines = lines[start:]
-    values = []
-    for line in lines:
-        elts = line.split(sep) if sep else line.split()
-        if elts and column < len(elts):
-            values.append(elts[column].strip())
-    return values
+    size = column + 1 if column >= 0 else -column
+    return [elts[column].strip() for elts in (line.split(sep) for line in lines) if len(elts) >= size]
 
 
 def filter_column(text, column, start=0, sep=None, **kwargs):
-    """ Filters (like grep) lines of text according to a specified column and operator/value
+    """ Filters (like grep) lines of text according to a specified column and operator/value,
+        see Table for compound filters
     :param text: a string
     :param column: integer >=0
     :param sep: optional separator between words  (default is arbitrary number of blanks)
@@ -41,25 +53,183 @@ def filter_column(text, column, start=0, sep=None, **kwargs):
     if len(kwargs) != 1:
         raise TypeError("Missing or too many keyword parameter in filter_column")
     op, value = kwargs.items()[0]
-    if op in ('eq', 'equals'):
-        op = '__eq__'
-    elif op in ('contains', 'includes'):
-        op = '__contains__'
-    elif not op in ('startswith', 'endswith'):
+    if op not in ('eq', 'equals', 'contains', 'includes', 'startswith', 'endswith'):
         raise ValueError("Unknown filter_column operator: {}".format(op))
     lines = text.splitlines() if isinstance(text, basestring) else text
     if start:
         lines = lines[start:]
+    size = column + 1 if column >= 0 else -column
+    func = TABLE_OPERATORS[op]
     values = []
     for line in lines:
-        elts = line.split(sep) if sep else line.split()
-        if elts and column < len(elts):
-            elt = elts[column]
-            if getattr(elt, op)(value):
-                values.append(line.strip())
+        elts = line.split(sep)
+        if len(elts) >= size and func(elts[column], value):
+            values.append(line.strip())
     return values
 
 
+def _match(value, pattern):
+    return pattern.search(value) is not None
+
+
+# filter operators of Table: function(column value, operand)
+TABLE_OPERATORS = {
+    'eq': operator.eq,
+    'equals': operator.eq,
+    'ne': operator.ne,
+    'contains': operator.contains,
+    'includes': operator.contains,
+    'startswith': lambda value, prefix: value.startswith(prefix),
+    'endswith': lambda value, suffix: value.endswith(suffix),
+    'in': lambda value, values: value in values,
+    'match': _match,
+}
+
+
+class Table(object):
+    """
+    A formatted text (eg a command output) parsed once, lazily, to extract columns and filter rows.
+    Rows are split on blanks (or sep), or, with a header, cut at the offsets of the header column names,
+    so that fixed-width columns with spaces work (eg 'docker ps' STATUS 'Up 2 minutes'). With a header,
+    columns can also be designated by name. Extracted columns are cached.
+    """
+    # header column names: single words (eg 'ps'), or words separated by single blanks (eg 'docker ps')
+    WORDS = r'\S+'
+    PHRASES = r'\S+(?: \S+)*'
+
+    def __init__(self, text, start=0, sep=None, header=False):
+        """
+        :param text: a string or a list of lines
+        :param start: the line number to start with, the header line if header is set
+        :param sep: optional separator between words (default is arbitrary number of blanks)
+        :param header: if set, the first line is a header giving column names and offsets:
+               True or Table.WORDS for single word names, Table.PHRASES or a regular expression of a name
+        """
+        self.text = text
+        self.start = start
+        self.sep = sep
+        self.header = header
+        self._names = []
+        self.offsets = []
+        self._lines = self._rows = None
+        self._columns = {}
+
+    @property
+    def rows(self):
+        """ The list of the values of each row
+        """
+        if self._rows is None:
+            self._parse()
+        return self._rows
+
+    @property
+    def names(self):
+        """ The column names of the header
+        """
+        self.rows
+        return self._names
+
+    def _parse(self):
+        lines = self.text.splitlines() if isinstance(self.text, basestring) else self.text
+        if self.start:
+            lines = lines[self.start:]
+        if self.header and lines:
+            self._set_header(lines[0])
+            lines = [line for line in lines[1:] if line.strip()]
+            rows = [self._cut(line) for line in lines]
+        else:
+            sep = self.sep
+            rows = [line.split(sep) for line in lines]
+            if not all(rows):
+                lines = [line for line, values in zip(lines, rows) if values]
+                rows = [values for values in rows if values]
+        self._lines, self._rows = lines, rows
+
+    def _set_header(self, line):
+        for match in re.finditer(self.WORDS if self.header is True else self.header, line):
+            self._names.append(match.group())
+            self.offsets.append(match.start())
+
+    def _cut(self, line):
+        """ Cuts a line at the header offsets. A value overflowing its column on the left (eg a right-aligned
+            number) moves the cut to the preceding blank
+        """
+        values, begin = [], 0
+        for offset in self.offsets[1:]:
+            cut = offset
+            while begin < cut < len(line) and not line[cut - 1].isspace() and not line[cut].isspace():
+                cut -= 1
+            values.append(line[begin:cut].strip())
+            begin = cut
+        values.append(line[begin:].strip())
+        return values
+
+    def index(self, column):
+        """ Returns the index of a column given by index or by name
+        """
+        if isinstance(column, basestring):
+            try:
+                return self.names.index(column)
+            except ValueError:
+                raise KeyError("Unknown column: {}".format(column))
+        return column
+
+    def column(self, column):
+        """ Returns the values of a column, rows too short for this column are skipped
+        """
+        index = self.index(column)
+        if index not in self._columns:
+            size = index + 1 if index >= 0 else -index
+            self._columns[index] = [values[index].strip() for values in self.rows if len(values) >= size]
+        return self._columns[index]
+
+    def columns(self, *columns):
+        """ Returns the values of several columns in a single pass, as a list of tuples
+        """
+        indexes = [self.index(column) for column in columns]
+        size = max([i + 1 if i >= 0 else -i for i in indexes] or [0])
+        return [tuple(values[i].strip() for i in indexes) for values in self.rows if len(values) >= size]
+
+    def filter(self, *conditions, **kwargs):
+        """ Returns a Table of the rows matching all conditions. Each condition is evaluated on the rows
+            matching the previous ones
+        :param conditions: tuples (column, operator, value), eg (2, 'eq', 'image_3'), ('STATUS', 'startswith', 'Up')
+        :param kwargs: conditions on named columns, NAME=value or NAME__operator=value
+        :return: a Table sharing the header of this table
+        """
+        rows = self.rows
+        keep = xrange(len(rows))
+        for column, op, value in conditions + tuple(
+                tuple(key.split('__', 1)) + (value,) if '__' in key else (key, 'eq', value)
+                for key, value in sorted(kwargs.items())):
+            if op not in TABLE_OPERATORS:
+                raise ValueError("Unknown Table operator: {}".format(op))
+            index = self.index(column)
+            size = index + 1 if index >= 0 else -index
+            if op in ('eq', 'equals'):
+                keep = [i for i in keep if len(rows[i]) >= size and rows[i][index] == value]
+            else:
+                func = TABLE_OPERATORS[op]
+                value = re.compile(value) if op == 'match' else value
+                keep = [i for i in keep if len(rows[i]) >= size and func(rows[i][index], value)]
+        table = Table(self.text, self.start, self.sep, self.header)
+        table._names, table.offsets = self._names, self.offsets
+        table._lines, table._rows = [self._lines[i] for i in keep], [rows[i] for i in keep]
+        return table
+
+    def lines(self):
+        """ Returns the stripped lines of the rows
+        """
+        self.rows
+        return [line.strip() for line in self._lines]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
 class ConfAttrDict(dict):
     """
     A configuration attribute dictionary with a context manager that allows to push and pull items,
@@ -168,61 +338,648 @@ COMMAND_DEBUG = None
 # COMMAND_DEBUG = 'Debug: '
 
 
-class Command(object):
-    """ Use this class if you want to wait and get shell command output
+# size of reads and writes on pipes
+PIPE_CHUNK = 1 << 16
+
+
+class StdoutTable(object):
+    """ Parses the stdout of a command as a Table, once
     """
-    def __init__(self, cmd, show=COMMAND_DEBUG):
-        self.show = show
-        self.p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
-        self.out_buf = cStringIO.StringIO()
-        self.err_buff = cStringIO.StringIO()
-        t_out = threading.Thread(target=self.out_handler)
-        t_err = threading.Thread(target=self.err_handler)
-        t_out.start()
-        t_err.start()
-        self.p.wait()
-        t_out.join()
-        t_err.join()
-        self.p.stdout.close()
-        self.p.stderr.close()
-        self.stdout = self.out_buf.getvalue()
-        self.stderr = self.err_buff.getvalue()
-        self.returncode = self.p.returncode
-
-    def out_handler(self):
-        for line in iter(self.p.stdout.readline, ''):
-            if self.show is not None:
-                sys.stdout.write(self.show + line)
-            self.out_buf.write(line)
-
-    def err_handler(self):
-        for line in iter(self.p.stderr.readline, ''):
-            if self.show is not None:
-                sys.stderr.write(self.show + 'Error: ' + line)
-            self.err_buff.write(line)
+
+    def stdout_table(self, start=0, sep=None, header=False):
+        tables = self.__dict__.setdefault('_tables', {})
+        if (start, sep, header) not in tables:
+            tables[start, sep, header] = Table(self.stdout, start, sep, header)
+        return tables[start, sep, header]
 
     def stdout_column(self, column, start=0):
-        return extract_column(self.stdout, column, start)
+        return self.stdout_table(start).column(column)
+
+
+class Command(StdoutTable):
+    """ Use this class if you want to wait and get shell command output.
+        Pipes are read by large chunks, multiplexed with poll() in the calling thread.
+    """
+    def __init__(self, cmd, show=COMMAND_DEBUG, datain=None, timeout=None, max_output=None, spill=None,
+                 callback=None):
+        """
+        :param show: if not None, output lines are echoed with this prefix
+        :param datain: optional data sent to stdin
+        :param timeout: optional timeout in seconds, after which the command and its children are killed
+               and attribute 'timed_out' is set
+        :param max_output: optional maximum number of bytes kept of each of stdout and stderr,
+               attribute 'truncated' is set if more was received
+        :param spill: optional size in bytes beyond which output is kept in temporary files
+               instead of memory. Read attributes stdout_file and stderr_file rather than
+               stdout and stderr to avoid loading it in memory
+        :param callback: optional function called with ('stdout' or 'stderr', chunk) as output arrives
+        """
+        self.show = show
+        self.max_output = max_output
+        self.callback = callback
+        self.timed_out = self.truncated = False
+        # a process group allows to kill the children of the shell on timeout
+        self.p = Popen(cmd, shell=True, stdin=None if datain is None else PIPE, stdout=PIPE, stderr=PIPE,
+                       preexec_fn=os.setsid if timeout else None)
+        self.stdout_file = tempfile.SpooledTemporaryFile(spill) if spill else cStringIO.StringIO()
+        self.stderr_file = tempfile.SpooledTemporaryFile(spill) if spill else cStringIO.StringIO()
+        self.streams = {self.p.stdout.fileno(): ['stdout', self.stdout_file, 0, ''],
+                        self.p.stderr.fileno(): ['stderr', self.stderr_file, 0, '']}
+        with profiler.span('command', cmd) as span:
+            self.run(datain, timeout)
+            self.p.stdout.close()
+            self.p.stderr.close()
+            self.returncode = self.p.wait()
+            if span:
+                span.bytes_in = len(datain or '')
+                span.bytes_out = sum(stream[2] for stream in self.streams.values())
+        self.stdout_file.seek(0)
+        self.stderr_file.seek(0)
+        self._stdout = self._stderr = None
+
+    def run(self, datain, timeout):
+        poller = select.poll()
+        for fd in self.streams:
+            poller.register(fd, select.POLLIN)
+        in_fd = None
+        if datain:
+            in_fd = self.p.stdin.fileno()
+            set_non_blocking(in_fd)
+            poller.register(in_fd, select.POLLOUT)
+        elif self.p.stdin:
+            self.p.stdin.close()
+        deadline = time.time() + timeout if timeout else None
+        opened = len(self.streams)
+        # datain is written from an offset, slicing off the written part would copy the rest on each write
+        offset = 0
+        while opened:
+            wait = None if deadline is None else max(0, deadline - time.time()) * 1000
+            try:
+                events = poller.poll(wait)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if deadline is not None and time.time() >= deadline:
+                self.kill()
+                deadline = None
+            for fd, event in events:
+                if fd == in_fd:
+                    try:
+                        offset += os.write(fd, buffer(datain, offset, PIPE_CHUNK))
+                    except OSError as e:
+                        if e.errno == errno.EAGAIN:
+                            continue
+                        # the command closed its stdin
+                        offset = len(datain)
+                    if offset >= len(datain):
+                        poller.unregister(fd)
+                        self.p.stdin.close()
+                        in_fd = None
+                    continue
+                data = os.read(fd, PIPE_CHUNK)
+                if data:
+                    self.received(fd, data)
+                else:
+                    poller.unregister(fd)
+                    self.received(fd, '', eof=True)
+                    opened -= 1
+        if in_fd is not None:
+            self.p.stdin.close()
+
+    def received(self, fd, data, eof=False):
+        stream = self.streams[fd]
+        name, buf, size = stream[:3]
+        if self.callback and data:
+            self.callback(name, data)
+        if self.show is not None:
+            lines = (stream[3] + data).split('\n')
+            stream[3] = '' if eof else lines.pop()
+            prefix = self.show if name == 'stdout' else self.show + 'Error: '
+            for line in lines:
+                if line or not eof:
+                    (sys.stdout if name == 'stdout' else sys.stderr).write(prefix + line + ('' if eof else '\n'))
+        if self.max_output is not None and size + len(data) > self.max_output:
+            self.truncated = True
+            data = data[:max(0, self.max_output - size)]
+        buf.write(data)
+        stream[2] += len(data)
 
+    def kill(self):
+        """ Kills the command and its children
+        """
+        self.timed_out = True
+        kill_group(self.p)
 
-def command(cmd, raises=False):
+    @property
+    def stdout(self):
+        if self._stdout is None:
+            self._stdout = self.stdout_file.read()
+        return self._stdout
+
+    @property
+    def stderr(self):
+        if self._stderr is None:
+            self._stderr = self.stderr_file.read()
+        return self._stderr
+
+
+def kill_group(p):
+    """ Kills a process started with preexec_fn=os.setsid, and its children
+    """
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def command(cmd, raises=False, timeout=None):
     """ Use this function if you only want the return code.
-        You can't retrieve stdout nor stderr and it never raises
+        You can't retrieve stdout nor stderr
+    :param timeout: optional timeout in seconds, after which the command and its children are killed
     """
-    ret = call(cmd, shell=True)
+    with profiler.span('command', cmd):
+        if timeout is None:
+            ret = call(cmd, shell=True)
+        else:
+            p = Popen(cmd, shell=True, preexec_fn=os.setsid)
+            if not wait_until(lambda: p.poll() is not None, timeout, max_interval=0.1):
+                kill_group(p)
+                if raises:
+                    p.wait()
+                    raise RuntimeError("Timeout ({}s) while executing <{}>".format(timeout, cmd))
+            ret = p.wait()
     if ret and raises:
         raise RuntimeError("Error while executing <{}>".format(cmd))
     return ret
 
 
-def command_input(cmd, datain, raises=False):
+def command_input(cmd, datain, raises=False, timeout=None):
     """ Use this if you want to send data to stdin
     """
-    p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-    p.communicate(datain)
-    if p.returncode and raises:
-        raise RuntimeError("Error while executing <{}>".format(cmd))
-    return p.returncode
+    com = Command(cmd, datain=datain, timeout=timeout)
+    if com.returncode and raises:
+        raise RuntimeError("{} while executing <{}>".format(
+            'Timeout ({}s)'.format(timeout) if com.timed_out else 'Error', cmd))
+    return com.returncode
+
+
+_named_locks = {}
+_named_locks_lock = threading.Lock()
+
+
+@contextmanager
+def named_lock(name):
+    """ Use this to serialize a task across the threads of this process and across processes
+        (e.g. pytest-xdist workers), by means of a lock file in the temporary directory
+    :param name: the lock name, any string
+    """
+    with _named_locks_lock:
+        lock = _named_locks.setdefault(name, threading.Lock())
+    filename = 'simply_{}.lock'.format(''.join(c if c.isalnum() or c in '-_.' else '_' for c in name))
+    with lock:
+        with open(os.path.join(tempfile.gettempdir(), filename), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def wait_until(predicate, timeout=5, interval=0.01, max_interval=0.5):
+    """ Waits until predicate() is true, polling with exponential backoff
+    :return: True if predicate() became true before timeout
+    """
+    end = time.time() + timeout
+    while True:
+        if predicate():
+            return True
+        now = time.time()
+        if now >= end:
+            return False
+        time.sleep(min(interval, end - now))
+        interval = min(interval * 2, max_interval)
+
+
+def can_connect(address, timeout=0.5):
+    """ Returns True if a TCP connection to address (host, port) succeeds
+    """
+    try:
+        socket.create_connection(address, timeout).close()
+        return True
+    except socket.error:
+        return False
+
+
+# ======================= ASYNCHRONOUS COMMANDS =======================
+
+class Future(object):
+    """ The result of an asynchronous operation
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks = []
+        self.value = self.error = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def set_result(self, value):
+        self.value = value
+        self._resolve()
+
+    def set_exception(self, error):
+        self.error = error
+        self._resolve()
+
+    def _resolve(self):
+        self.event.set()
+        for callback in self.callbacks:
+            try:
+                callback(self)
+            except Exception:
+                # like asyncio, a failing callback must not break the loop that resolves futures
+                traceback.print_exc()
+
+    def add_done_callback(self, callback):
+        if self.done():
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def result(self, timeout=None):
+        """ Waits for the result, raises the operation exception if it failed
+        """
+        if not self.event.wait(timeout):
+            raise RuntimeError("Timeout while waiting for a result")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def then(self, func):
+        """ Returns a future of func(result)
+        """
+        future = Future()
+
+        def callback(this):
+            if this.error is not None:
+                return future.set_exception(this.error)
+            try:
+                future.set_result(func(this.value))
+            except Exception as e:
+                future.set_exception(e)
+        self.add_done_callback(callback)
+        return future
+
+
+def gather(*futures):
+    """ Returns a future of the list of results of futures
+    """
+    future, pending = Future(), set(futures)
+
+    def callback(this):
+        pending.discard(this)
+        if future.done():
+            return
+        if this.error is not None:
+            future.set_exception(this.error)
+        elif not pending:
+            future.set_result([f.value for f in futures])
+    if not futures:
+        future.set_result([])
+    for f in futures:
+        f.add_done_callback(callback)
+    return future
+
+
+class Return(Exception):
+    """ Raise this to return a value from a coroutine (python 2 generators can't return values)
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+def coroutine(func):
+    """ Turns a generator yielding futures (or lists of futures) into a function returning a future.
+        The generator is resumed with each result when it is available, in the reactor thread,
+        so it must not call blocking functions.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        future, gen = Future(), func(*args, **kwargs)
+
+        def step(value=None, error=None):
+            try:
+                yielded = gen.throw(error) if error is not None else gen.send(value)
+            except Return as e:
+                return future.set_result(e.value)
+            except StopIteration:
+                return future.set_result(None)
+            except Exception as e:
+                return future.set_exception(e)
+            if isinstance(yielded, (list, tuple)):
+                yielded = gather(*yielded)
+            yielded.add_done_callback(lambda this: step(this.value, this.error))
+        step()
+        return future
+    return wrapper
+
+
+class AsyncCommand(StdoutTable):
+    """ A shell command driven by the reactor, has the same attributes as Command
+    """
+    def __init__(self, cmd, datain=None):
+        self.cmd = cmd
+        self.datain = datain or ''
+        # position of the next write of datain, see Reactor.run
+        self.offset = 0
+        self.p = Popen(cmd, shell=True, stdin=PIPE if datain else None, stdout=PIPE, stderr=PIPE)
+        self.in_fd = self.p.stdin.fileno() if datain else None
+        self.out_fd, self.err_fd = self.p.stdout.fileno(), self.p.stderr.fileno()
+        self.buffers = {self.out_fd: [], self.err_fd: []}
+        self.future = Future()
+        self.stdout = self.stderr = self.returncode = None
+
+
+def set_non_blocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class Reactor(object):
+    """
+    A single thread multiplexing the pipes of any number of commands with poll(),
+    instead of one thread per pipe.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.poller = select.poll()
+        self.fds = {}
+        self.pending = []
+        self.wakeup = os.pipe()
+        set_non_blocking(self.wakeup[0])
+        self.poller.register(self.wakeup[0], select.POLLIN)
+        self.thread = None
+
+    def submit(self, cmd, datain=None):
+        """ Starts a shell command
+        :return: a future of the terminated AsyncCommand
+        """
+        command = AsyncCommand(cmd, datain)
+        with self.lock:
+            self.pending.append(command)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        os.write(self.wakeup[1], 'x')
+        return command.future
+
+    def register(self, command):
+        for fd in command.buffers:
+            set_non_blocking(fd)
+            self.fds[fd] = command
+            self.poller.register(fd, select.POLLIN)
+        if command.in_fd is not None:
+            set_non_blocking(command.in_fd)
+            self.fds[command.in_fd] = command
+            self.poller.register(command.in_fd, select.POLLOUT)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+        command = self.fds.pop(fd)
+        if fd == command.in_fd:
+            command.p.stdin.close()
+        elif command.out_fd not in self.fds and command.err_fd not in self.fds:
+            command.p.stdout.close()
+            command.p.stderr.close()
+            command.returncode = command.p.wait()
+            command.stdout = ''.join(command.buffers[command.out_fd])
+            command.stderr = ''.join(command.buffers[command.err_fd])
+            command.future.set_result(command)
+
+    def run(self):
+        while True:
+            for fd, event in self.poller.poll():
+                if fd == self.wakeup[0]:
+                    os.read(fd, 4096)
+                    with self.lock:
+                        pending, self.pending = self.pending, []
+                    for command in pending:
+                        self.register(command)
+                    continue
+                command = self.fds[fd]
+                try:
+                    if event & select.POLLOUT:
+                        command.offset += os.write(fd, buffer(command.datain, command.offset, PIPE_CHUNK))
+                        if command.offset >= len(command.datain):
+                            self.unregister(fd)
+                        continue
+                    data = os.read(fd, PIPE_CHUNK)
+                except OSError as e:
+                    if e.errno == errno.EAGAIN:
+                        continue
+                    data = ''
+                if data:
+                    command.buffers[fd].append(data)
+                else:
+                    self.unregister(fd)
+
+_reactor = Reactor()
+
+
+def async_command(cmd, datain=None):
+    """ Use this function to run a shell command without blocking the caller
+    :return: a future of an object with stdout, stderr and returncode attributes, see Command
+    """
+    return _reactor.submit(cmd, datain)
+
+
+CHUNK_SIZE = 1 << 20
+
+
+class TransferStats(object):
+    """ Bytes count and duration of a data transfer
+    """
+    def __init__(self, bytes=0, seconds=0.0):
+        self.bytes = bytes
+        self.seconds = seconds
+
+    @property
+    def rate(self):
+        """ Bytes per second
+        """
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return '<TransferStats {} bytes in {:.3f}s, {:.1f} MB/s>'.format(self.bytes, self.seconds, self.rate / 1e6)
+
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    """ Iterates over a string, a file-like object or an iterable of strings, by chunks
+    """
+    if isinstance(data, basestring):
+        for pos in xrange(0, len(data), chunk_size):
+            yield data[pos:pos + chunk_size]
+    elif hasattr(data, 'read'):
+        for chunk in iter(lambda: data.read(chunk_size), ''):
+            yield chunk
+    else:
+        for chunk in data:
+            yield chunk
+
+
+class CountingWriter(object):
+    """ A write-only file object that counts bytes written to a wrapped file object
+    """
+    def __init__(self, fileobj, stats):
+        self.fileobj = fileobj
+        self.stats = stats
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.stats.bytes += len(data)
+
+
+def stream_to_command(cmd, data, chunk_size=CHUNK_SIZE, raises=False):
+    """ Use this to send data to stdin of a command, without loading it in memory
+    :param data: a string, a file-like object, an iterable of strings or a callable
+           that is passed a write-only file object (e.g. to write a tar stream)
+    :return: a TransferStats, with the command return code as attribute 'returncode'
+    """
+    stats, start = TransferStats(), time.time()
+    with profiler.span('transfer', cmd) as span, tempfile.TemporaryFile() as errors:
+        # stderr goes to a file: a pipe nobody reads while stdin is written blocks the command once full
+        p = Popen(cmd, shell=True, stdin=PIPE, stderr=errors)
+        writer = CountingWriter(p.stdin, stats)
+        try:
+            if callable(data):
+                data(writer)
+            else:
+                for chunk in iter_chunks(data, chunk_size):
+                    writer.write(chunk)
+        except IOError:
+            # the command exited early, its return code tells why
+            pass
+        finally:
+            try:
+                p.stdin.close()
+            except IOError:
+                pass
+        stats.returncode = p.wait()
+        errors.seek(0)
+        stderr = errors.read()
+        stats.seconds = time.time() - start
+        if span:
+            span.bytes_in = stats.bytes
+    if stats.returncode and raises:
+        raise RuntimeError("Error while executing <{}>: [{}]".format(cmd, stderr.strip() or stats.returncode))
+    return stats
+
+
+def iter_command(cmd, chunk_size=CHUNK_SIZE):
+    """ Use this to iterate over stdout of a command by chunks, without loading it in memory.
+        Raises a RuntimeError at the end if the command fails.
+    """
+    with tempfile.TemporaryFile() as errors:
+        # stderr goes to a file, see stream_to_command
+        p = Popen(cmd, shell=True, stdout=PIPE, stderr=errors, preexec_fn=os.setsid)
+        try:
+            for chunk in iter(lambda: p.stdout.read(chunk_size), ''):
+                yield chunk
+            if p.wait():
+                errors.seek(0)
+                stderr = errors.read().strip()
+                raise RuntimeError("Error while executing <{}>: [{}]".format(cmd, stderr or p.returncode))
+        finally:
+            # the iteration was left early (break, exception or garbage collection): don't leave a zombie behind
+            if p.poll() is None:
+                kill_group(p)
+                p.wait()
+            p.stdout.close()
+
+
+def stream_from_command(cmd, fileobj, chunk_size=CHUNK_SIZE):
+    """ Use this to copy stdout of a command to a file-like object, without loading it in memory
+    :return: a TransferStats
+    """
+    stats, start = TransferStats(), time.time()
+    with profiler.span('transfer', cmd) as span:
+        for chunk in iter_command(cmd, chunk_size):
+            fileobj.write(chunk)
+            stats.bytes += len(chunk)
+        stats.seconds = time.time() - start
+        if span:
+            span.bytes_out = stats.bytes
+    return stats
+
+
+# archives up to this size are kept in memory, larger ones spill to a temporary file
+SPOOL_SIZE = 16 * CHUNK_SIZE
+
+
+class TarStore(collections.Mapping):
+    """ A read-only dict-like view of the regular files of a tar archive, {path: content}.
+        The archive is indexed on first access and files are read on demand.
+    """
+    def __init__(self, fileobj, prefix=''):
+        """
+        :param fileobj: a seekable file-like object holding the archive
+        :param prefix: prepended to normalized member names to make the keys
+        """
+        self.fileobj = fileobj
+        self.prefix = prefix
+        self.tar = None
+        self._members = None
+
+    @property
+    def members(self):
+        if self._members is None:
+            self.fileobj.seek(0)
+            self.tar = tarfile.open(fileobj=self.fileobj)
+            self._members = dict((self.prefix + os.path.normpath(member.name), member)
+                                 for member in self.tar.getmembers() if member.isfile())
+        return self._members
+
+    def open(self, path):
+        """ Returns a file-like object on the content of a file, for large files
+        """
+        member = self.members[path]
+        return self.tar.extractfile(member)
+
+    def __getitem__(self, path):
+        return self.open(path).read()
+
+    def __iter__(self):
+        return iter(sorted(self.members))
+
+    def __len__(self):
+        return len(self.members)
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def tar_from_command(cmd, prefix=''):
+    """ Use this to get a tar archive from stdout of a command into a TarStore,
+        spooled to a temporary file if large
+    :return: a TarStore, with the transfer TransferStats as attribute 'stats'
+    """
+    spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    try:
+        stats = stream_from_command(cmd, spool)
+    except Exception:
+        spool.close()
+        raise
+    store = TarStore(spool, prefix)
+    store.stats = stats
+    return store
 
 
 def find_file(file, path):
@@ -0,0 +1,33 @@
+# encoding: utf-8
+
+import os.path
+import subprocess
+import sys
+
+from simply import ROOTDIR
+
+RUN = os.path.join(os.path.dirname(ROOTDIR), 'benchmarks', 'run.py')
+FAKE_DOCKER = os.path.join(os.path.dirname(ROOTDIR), 'benchmarks', 'fake_docker.py')
+
+
+def test_benchmarks_fake_docker():
+    output = subprocess.check_output([sys.executable, RUN, '--repeat', '1', '-k',
+                                      'exec_latency|get_containers|put_data|put_directory_unchanged|column'])
+    names = [line.split()[0] for line in output.splitlines() if line and not line.startswith(('\x1b', 'benchmark'))]
+    assert 'exec_latency' in names
+    assert 'get_containers[1000]' in names
+    assert 'put_data[33554432]' in names
+    assert 'put_directory_unchanged[10]' in names
+    assert 'filter_column[100000]' in names
+
+
+def test_fake_docker_exec(tmpdir):
+    env = dict(os.environ, FAKE_DOCKER_ROOT=str(tmpdir))
+
+    def docker(*args):
+        return subprocess.check_output([sys.executable, FAKE_DOCKER] + list(args), env=env)
+
+    docker('run', '-di', '--name', 'box', 'busybox')
+    # the user 'daemon' does not detach the command
+    assert docker('exec', '-i', '-u', 'daemon', 'box', 'echo', 'ok') == 'ok\n'
+    assert docker('exec', '-di', 'box', 'echo', 'ok') == ''
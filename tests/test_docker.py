@@ -1,10 +1,17 @@
 # encoding: utf-8
 
+import cStringIO
+import hashlib
 import os.path
+import pipes
+import time
+from subprocess import Popen, PIPE
 
-from simply import ROOTDIR
+import pytest
+
+from simply import ROOTDIR, utils
 from simply.backends import docker, get_class
-from simply.utils import ConfAttrDict
+from simply.utils import Command, ConfAttrDict
 
 
 def test_version():
@@ -179,3 +186,427 @@ CMD ["/bin/cat"]
     assert db.init_backend(conf)
     assert db.build_image('uproot')
     assert db.image_exist()
+
+
+@pytest.fixture
+def fake_run(monkeypatch):
+    running = set()
+
+    def fake_run(image, container=None, parameters=None, cmd=None):
+        running.add(container)
+        return True
+
+    def fake_delete(*container, **kwargs):
+        running.difference_update(container)
+        return True
+
+    monkeypatch.setattr(docker, 'docker_run', fake_run)
+    monkeypatch.setattr(docker, 'container_delete', fake_delete)
+    monkeypatch.setattr(docker, 'docker_commit', lambda container, image: True)
+    return running
+
+
+def test_container_pool(fake_run):
+    pool = docker.ContainerPool('busybox', 2)
+    first = pool.lease(timeout=1)
+    second = pool.lease(timeout=1)
+    assert first != second and first.startswith('busybox_pool_')
+    pool.release(first, clean=True)
+    assert pool.lease(timeout=1) == first
+    pool.release(second)
+    third = pool.lease(timeout=1)
+    assert third not in (first, second)
+    assert second not in fake_run
+    assert pool.snapshot(third, 'busybox_snap') == 'busybox_snap'
+    assert pool.image == 'busybox_snap'
+    pool.release(first)
+    pool.release(third)
+    pool.close()
+    assert not fake_run
+
+
+def test_docker_pool_conf(fake_run, monkeypatch):
+    pool = docker.ContainerPool('busybox', 1)
+    monkeypatch.setattr(docker, 'get_pool', lambda image, size, parameters: pool)
+    db = docker.this_class()
+    db.image = 'busybox'
+    assert db.init_backend(ConfAttrDict(pool_size=1))
+    assert db.run_container('all_containers')
+    assert db.leased and db.container in fake_run
+    leased = db.container
+    db.container_delete()
+    assert not db.leased
+    assert pool.lease(timeout=1) != leased
+    pool.close()
+    assert leased not in fake_run
+
+
+def test_batch_script():
+    cmds = ['echo hello', 'echo error >&2; exit 3', 'printf "no newline"', 'cat']
+    com = Command('/bin/sh -c {}'.format(pipes.quote(docker.batch_script(cmds))))
+    assert com.returncode == 0
+    results = docker.parse_batch(com.stdout, len(cmds))
+    assert [(r.stdout, r.stderr, r.returncode) for r in results] == [
+        ('hello\n', '', 0), ('', 'error\n', 3), ('no newline', '', 0), ('', '', 0)]
+    with pytest.raises(RuntimeError):
+        docker.check_batch(cmds, 'local', com, raises=True)
+
+
+def test_exec_many():
+    docker.container_delete(image='busybox')
+    try:
+        assert docker.docker_run('busybox', 'busybox', cmd='/bin/cat')
+        results = docker.docker_exec_many(['ls /', 'test -e /toto', 'whoami'], 'busybox')
+        assert 'etc' in results[0].stdout.split()
+        assert results[1].returncode == 1
+        assert results[2].stdout.strip() == 'root'
+    finally:
+        docker.container_delete(image='busybox')
+
+
+def test_exec_agent():
+    agent = docker.ExecAgent(['/bin/sh'], 'local')
+    try:
+        res = agent.execute('echo hello; echo error >&2; exit 2')
+        assert (res.stdout, res.stderr, res.returncode) == ('hello\n', 'error\n', 2)
+        res = agent.execute('printf "SIMPLY_ no newline"')
+        assert (res.stdout, res.stderr, res.returncode) == ('SIMPLY_ no newline', '', 0)
+        # commands run in a subshell, they can't alter the agent
+        assert agent.execute('cd /tmp; exit 0').returncode == 0
+        assert agent.execute('pwd').stdout.strip() == os.getcwd()
+        results = agent.execute_many(['echo 1', 'false'])
+        assert [(r.stdout, r.returncode) for r in results] == [('1\n', 0), ('', 1)]
+        data = 'x' * 200000
+        assert agent.execute('printf {}'.format(data)).stdout == data
+        # syntax errors and unbalanced quotes fail the command, not the agent
+        assert agent.execute('if true; echo x').returncode
+        assert agent.execute('echo "x').returncode
+        assert agent.execute('echo ok').stdout == 'ok\n'
+    finally:
+        agent.close()
+    assert agent.p.returncode == 0
+
+
+def test_exec_agent_restart(monkeypatch):
+    monkeypatch.setattr(docker, 'start_agent', lambda container, user, timeout: docker.ExecAgent(
+        ['/bin/sh'], container, user, timeout))
+    db = docker.this_class()
+    db.image = 'busybox'
+    db.user = None
+    db.init_backend(ConfAttrDict(container='local', agent=True, agent_timeout=0.5))
+    try:
+        agent = db.get_agent()
+        with pytest.raises(RuntimeError) as e:
+            db.execute('sleep 5')
+        assert 'Timeout' in str(e.value) and not agent.alive()
+        assert db.execute('echo ok') == 'ok\n'
+        assert db.get_agent() is not agent
+        agent = db.get_agent()
+        agent.p.stdin.write('exit\n')
+        agent.p.wait()
+        assert db.execute('echo ok') == 'ok\n'
+    finally:
+        db.stop_agents()
+
+
+def test_docker_agent():
+    docker.container_delete(image='busybox')
+    db = docker.this_class()
+    db.image = 'busybox'
+    db.user = None
+    db.init_backend(ConfAttrDict(container='busybox', agent=True, image_spec='.pull'))
+    try:
+        assert db.setup()
+        assert db.agents
+        assert 'etc' in db.execute('ls /').split()
+        assert db.execute('whoami', user='nobody').strip() == 'nobody'
+        assert not db.path_exists('/toto')
+    finally:
+        db.reset()
+    assert not db.agents
+
+
+def test_docker_async():
+    docker.container_delete(image='busybox')
+    db = docker.this_class()
+    db.image = 'busybox'
+    db.user = None
+    db.init_backend(ConfAttrDict(image_spec='.pull'))
+    try:
+        assert db.asetup().result(60) is db
+        assert db.container in docker.aget_containers(image='busybox').result(10)
+        assert 'busybox' in docker.aget_images('busybox').result(10)
+        assert 'etc' in db.aexecute('ls /').result(10).split()
+    finally:
+        db.reset()
+
+
+DOCKER_IMAGES = """\
+{"ID":"0f6b4b1ae16e","Repository":"debian8","Tag":"latest","Size":"386.4 MB"}
+{"ID":"0f6b4b1ae16e","Repository":"debian8","Tag":"v1","Size":"386.4 MB"}
+{"ID":"2b8fd9751c4c","Repository":"busybox","Tag":"latest","Size":"1.093 MB"}
+"""
+DOCKER_PS = """\
+{"ID":"8c2f8a2c8a2f","Image":"busybox","Names":"busybox_1","Status":"Up 2 hours"}
+{"ID":"5a3b5a3b5a3b","Image":"debian8","Names":"debian8_1","Status":"Exited (0) 3 hours ago"}
+{"ID":"7d4e7d4e7d4e","Image":"debian8:v1","Names":"debian8_2","Status":"Up 3 hours (Paused)"}
+"""
+
+
+def test_parse_listings():
+    images = docker.parse_images(DOCKER_IMAGES)
+    assert len(images) == 3
+    assert [r.tag for r in images.select(repository='debian8')] == ['latest', 'v1']
+    assert images.select(repository='debian8', tag='v1') == [docker.ImageRecord('0f6b4b1ae16e', 'debian8', 'v1')]
+    containers = docker.parse_containers(DOCKER_PS)
+    assert [r.state for r in containers] == ['running', 'exited', 'paused']
+    assert [r.name for r in containers.select(image='debian8')] == ['debian8_1']
+    assert containers.select(state='running', image='debian8') == []
+    assert docker.container_names(containers, image='debian8:v1') == ['debian8_2']
+    assert docker.container_names(containers, 'debian', all=False) == []
+    assert docker.container_state('Created') == 'created'
+
+
+def test_inventory(monkeypatch):
+    calls = []
+
+    class FakeCommand(object):
+        def __init__(self, cmd, show=None):
+            calls.append(cmd)
+            self.stdout = DOCKER_IMAGES if cmd == docker.IMAGES_CMD else DOCKER_PS
+            self.returncode = 0
+
+    monkeypatch.setattr(utils, 'Command', FakeCommand)
+    monkeypatch.setattr(utils, 'command', lambda cmd, raises=False, timeout=None: calls.append(cmd) or 0)
+    docker.use_inventory()
+    try:
+        assert docker.get_images() == ['debian8', 'debian8', 'busybox']
+        assert docker.has_image('busybox') and not docker.has_image('busy')
+        assert docker.get_images('busy') == ['busybox']
+        assert calls == [docker.IMAGES_CMD]
+        assert docker.get_containers() == ['busybox_1', 'debian8_1', 'debian8_2']
+        assert docker.get_containers(all=False) == ['busybox_1']
+        assert docker.get_containers(image='debian8') == ['debian8_1']
+        assert docker.has_container('debian8_1') and not docker.has_container('debian8_1', all=False)
+        assert docker.query_containers(state='paused')[0].name == 'debian8_2'
+        assert calls == [docker.IMAGES_CMD, docker.CONTAINERS_CMD]
+        assert docker.docker_pull('busybox')
+        assert docker.has_image('busybox')
+        assert calls[-2:] == ['docker pull busybox', docker.IMAGES_CMD]
+        assert docker.has_container('busybox_1')
+        assert len(calls) == 4
+        docker.inventory.read_events(
+            Popen(['echo', '2016-09-30T12:00:00 container destroy 8c2f (image=busybox, name=busybox_1)'],
+                  stdout=PIPE))
+        assert docker.has_container('busybox_1')
+        assert calls[-1] == docker.CONTAINERS_CMD
+    finally:
+        docker.use_inventory(False)
+
+
+def test_stream_data():
+    docker.container_delete(image='busybox')
+    try:
+        assert docker.docker_run('busybox', 'busybox', cmd='/bin/cat')
+        data = os.urandom(5 * 1000 * 1000)
+        stats = docker.put_stream(iter([data[:1000], data[1000:]]), '/data', 'busybox')
+        assert stats.bytes == len(data)
+        assert docker.put_data('end', '/data', 'busybox', append=True)
+        buf = cStringIO.StringIO()
+        assert docker.get_stream('/data', 'busybox', buf).bytes == len(data) + 3
+        assert buf.getvalue() == data + 'end'
+        assert ''.join(docker.iter_data('/data', 'busybox')) == data + 'end'
+    finally:
+        docker.container_delete(image='busybox')
+
+
+def test_directory_manifest(tmpdir):
+    tmpdir.join('.hidden').write('hidden')
+    tmpdir.mkdir('sub').join('file').write('file')
+    tmpdir.mkdir('empty')
+    tmpdir.join('link').mksymlinkto('sub')
+    manifest = docker.directory_manifest(str(tmpdir))
+    assert sorted(manifest) == ['.hidden', 'empty', 'link', 'sub', 'sub/file']
+    assert manifest['sub/file'][0] == hashlib.sha1('file').hexdigest()
+    assert (manifest['empty'][0], manifest['link'][0]) == ('dir', 'link:sub')
+    remote = dict(manifest, link=['dir', 0o755], gone=['dir', 0o755])
+    assert docker.sync_removals(manifest, remote, ['link']) == ['gone', 'link']
+    tmpdir.join('sub', 'file').write('changed')
+    assert docker.directory_manifest(str(tmpdir))['sub/file'][0] == hashlib.sha1('changed').hexdigest()
+
+
+def test_sync_directory(tmpdir):
+    docker.container_delete(image='busybox')
+    try:
+        assert docker.docker_run('busybox', 'busybox', cmd='/bin/cat')
+        tmpdir.join('.hidden').write('hidden')
+        tmpdir.mkdir('sub').join('file').write('file')
+        tmpdir.mkdir('empty')
+        tmpdir.join('link').mksymlinkto('sub')
+        stats = docker.sync_directory(str(tmpdir), '/sync', 'busybox')
+        assert stats.changed == ['.hidden', 'empty', 'link', 'sub', 'sub/file']
+        assert docker.get_data('/sync/.hidden', 'busybox') == 'hidden'
+        assert docker.docker_exec('test -d /sync/empty && readlink /sync/link', 'busybox') == 'sub\n'
+        assert docker.sync_directory(str(tmpdir), '/sync', 'busybox').bytes == 0
+        tmpdir.join('sub', 'file').write('changed')
+        tmpdir.join('.hidden').remove()
+        stats = docker.sync_directory(str(tmpdir), '/sync', 'busybox')
+        assert (stats.changed, stats.removed) == (['sub/file'], ['.hidden'])
+        assert docker.get_data('/sync/sub/file', 'busybox') == 'changed'
+        assert not docker.path_exists('/sync/.hidden', 'busybox')
+        tmpdir.join('empty').remove()
+        stats = docker.sync_directory(str(tmpdir), '/sync', 'busybox')
+        assert stats.removed == ['empty'] and not docker.path_exists('/sync/empty', 'busybox')
+    finally:
+        docker.container_delete(image='busybox')
+
+
+def test_get_files():
+    docker.container_delete(image='busybox')
+    try:
+        assert docker.docker_run('busybox', 'busybox', cmd='/bin/cat')
+        docker.docker_exec('mkdir -p /data/sub && echo a > /data/a && echo b > /data/sub/b', 'busybox', raises=True)
+        store = docker.get_files(['/etc/passwd', '/data'], 'busybox')
+        assert sorted(store) == ['/data/a', '/data/sub/b', '/etc/passwd']
+        assert store['/etc/passwd'] == docker.get_data('/etc/passwd', 'busybox')
+        assert dict(docker.get_directory('/data', 'busybox')) == {'a': 'a\n', 'sub/b': 'b\n'}
+    finally:
+        docker.container_delete(image='busybox')
+
+
+def test_build_command(tmpdir):
+    inline = 'FROM scratch\nCMD ["/bin/cat"]\n'
+    cmd, datain = docker.build_command(inline, 'scratch')
+    assert cmd == 'docker build -t scratch --label simply.context={} -'.format(hashlib.sha1(inline).hexdigest())
+    assert datain == inline
+    tmpdir.join('Dockerfile').write(inline)
+    cmd, datain = docker.build_command(str(tmpdir), 'toto', cache_from=['toto', 'base'], buildkit=True)
+    assert cmd.startswith('DOCKER_BUILDKIT=1 docker build --build-arg BUILDKIT_INLINE_CACHE=1 -t toto --label ')
+    assert cmd.endswith(' --cache-from toto --cache-from base {}'.format(tmpdir))
+    assert datain is None
+    before = docker.context_hash(str(tmpdir), 'toto')
+    tmpdir.join('conf').write('conf')
+    assert docker.context_hash(str(tmpdir), 'toto') != before
+    with pytest.raises(RuntimeError):
+        docker.build_command(str(tmpdir))
+
+
+def test_image_outdated_without_context(tmpdir, monkeypatch):
+    monkeypatch.setattr(docker, 'get_image_label', lambda image, label: '')
+    # an image without label nor local context (eg pulled or built elsewhere) is reused
+    assert docker.context_hash('no_such_context') is None
+    assert not docker.image_outdated('no_such_context')
+    assert docker.build_command('no_such_context')[0] == 'docker build -t no_such_context {}'.format(
+        os.path.join(ROOTDIR, 'images', 'no_such_context'))
+    tmpdir.join('Dockerfile').write('FROM scratch\n')
+    assert docker.image_outdated(str(tmpdir), 'toto')
+
+
+def test_resource_parameters():
+    assert docker.resource_parameters() == ''
+    assert docker.resource_parameters(memory='512m', cpuset=[0, 1], cpus=1.5, pids_limit=100) == \
+        '--cpus 1.5 --cpuset-cpus 0,1 --memory 512m --pids-limit 100'
+    db = docker.this_class()
+    db.image = 'busybox'
+    db.init_backend(ConfAttrDict(cpus=2, memory='1g', parameters='-p 80:80'))
+    assert db.parameters == '--cpus 2 --memory 1g -p 80:80'
+    assert docker.run_command(db.image, 'box', db.parameters) == \
+        'docker run -di --name box --cpus 2 --memory 1g -p 80:80 busybox'
+
+
+def test_watched_script(tmpdir):
+    pidfile = str(tmpdir.join('pid'))
+
+    def sh(script):
+        return Popen(['/bin/sh', '-c', script])
+
+    kill = docker.KILL_SCRIPT % (pidfile, pidfile)
+    assert sh(kill).wait() == 1
+    assert sh(docker.watched_script('true', pidfile, daemon=True)).wait() == 0
+    assert sh(docker.PIDFILE_WAIT_SCRIPT.format(pidfile)).wait() == 0
+    assert sh(kill).wait() == 1 and not os.path.exists(pidfile)
+    proc = sh(docker.watched_script('sleep 30', pidfile))
+    assert sh(docker.PIDFILE_WAIT_SCRIPT.format(pidfile)).wait() == 0
+    assert sh(kill).wait() == 0
+    assert proc.wait() and not os.path.exists(pidfile)
+
+
+def test_docker_build_outdated(tmpdir):
+    tmpdir.join('scratch').mkdir().join('Dockerfile').write('FROM scratch\nCMD ["/bin/cat"]\n')
+    db = docker.this_class()
+    db.image = 'scratch'
+    assert db.init_backend(ConfAttrDict(image_spec=str(tmpdir)))
+    try:
+        assert db.build_image('uproot')
+        image_id = docker.get_image_id('scratch')
+        assert not docker.image_outdated(*db.build_args())
+        assert db.build_image() and docker.get_image_id('scratch') == image_id
+        tmpdir.join('scratch', 'Dockerfile').write('FROM scratch\nCMD ["/bin/sh"]\n')
+        assert docker.image_outdated(*db.build_args())
+        assert db.build_image() and docker.get_image_id('scratch') != image_id
+    finally:
+        docker.image_delete('scratch')
+
+
+def test_dockerfile_parents():
+    assert docker.dockerfile_parents(docker.dockerfile('debian8')) == ['debian:8']
+    assert docker.dockerfile_parents(docker.dockerfile('scratch')) == []
+    assert docker.dockerfile_parents("""
+FROM --platform=linux/amd64 debian8:latest AS build
+RUN make
+from build
+FROM conda2
+COPY --from=build /app /app
+""") == ['debian8', 'conda2']
+
+
+def test_build_scheduler():
+    events = []
+
+    def build(image, result=True):
+        def func():
+            events.append(('start', image))
+            time.sleep(0.01)
+            events.append(('end', image))
+            return result
+        return func
+    scheduler = docker.BuildScheduler(workers=4)
+    scheduler.add('app', build('app'), ['base', 'debian:8'])
+    scheduler.add('base', build('base'), ['debian:8'])
+    scheduler.add('other', build('other'))
+    scheduler.run()
+    assert events.index(('end', 'base')) < events.index(('start', 'app'))
+    assert events.index(('start', 'other')) < events.index(('end', 'base'))
+
+    del events[:]
+    scheduler = docker.BuildScheduler(workers=2)
+    scheduler.add('app', build('app'), ['base'])
+    scheduler.add('base', build('base', False))
+    scheduler.add('other', build('other'))
+    with pytest.raises(RuntimeError) as exc:
+        scheduler.run()
+    assert 'app (parent image failed), base (build failed)' in str(exc.value)
+    assert ('start', 'app') not in events and ('end', 'other') in events
+
+    scheduler = docker.BuildScheduler()
+    scheduler.add('a', build('a'), ['b']).add('b', build('b'), ['a'])
+    with pytest.raises(RuntimeError):
+        scheduler.run()
+
+
+def test_exec_timeout():
+    docker.container_delete(image='busybox')
+    try:
+        assert docker.docker_run('busybox', 'busybox', cmd='/bin/cat', timeout=60)
+        start = time.time()
+        with pytest.raises(RuntimeError):
+            docker.docker_exec('sleep 30', 'busybox', raises=True, timeout=0.5)
+        assert time.time() - start < 10
+        assert 'sleep 30' not in docker.docker_exec('ps', 'busybox')
+        handle = docker.docker_exec('sleep 30', 'busybox', daemon=True)
+        assert docker.utils.wait_until(handle.running)
+        assert handle.cancel()
+        assert not handle.running()
+        assert 'sleep 30' not in docker.docker_exec('ps', 'busybox')
+    finally:
+        docker.container_delete(image='busybox')
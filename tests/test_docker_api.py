@@ -0,0 +1,227 @@
+# encoding: utf-8
+
+import BaseHTTPServer
+import json
+import os
+import pipes
+import SocketServer
+import struct
+import tempfile
+import threading
+import time
+
+import pytest
+
+from simply.backends import docker, docker_api
+from simply.utils import ConfAttrDict
+
+
+class FakeEngineHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    images = [{'Id': 'sha256:2b8f', 'RepoTags': ['busybox:latest']},
+              {'Id': 'sha256:0f6b', 'RepoTags': ['debian8:latest', 'debian8:v1']},
+              {'Id': 'sha256:4a1c', 'RepoTags': None}]
+    containers = [{'Id': '8c2f', 'Names': ['/busybox_1'], 'Image': 'busybox', 'State': 'running',
+                   'Status': 'Up 2 hours'},
+                  {'Id': '5a3b', 'Names': ['/debian8_1'], 'Image': 'debian8', 'State': 'exited',
+                   'Status': 'Exited (0) 3 hours ago'}]
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=None, raw=False):
+        data = body if raw else json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        if raw:
+            # exec streams are hijacked: no content length, connection closed afterwards
+            self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        else:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.connections.add(self.connection)
+
+    def do_GET(self):
+        if self.path == '/version':
+            return self.send(200, {'Version': '1.12.1'})
+        if self.path == '/images/json':
+            return self.send(200, self.images)
+        if self.path.startswith('/containers/json'):
+            if 'all=1' in self.path:
+                return self.send(200, self.containers)
+            return self.send(200, [x for x in self.containers if x['State'] == 'running'])
+        if self.path == '/images/busybox/json':
+            return self.send(200, {'Id': 'sha256:2b8f', 'Config': {'Labels': {'simply.context': 'abcd'}}})
+        if self.path == '/containers/busybox_1/json':
+            return self.send(200, {'NetworkSettings': {'IPAddress': '172.17.0.2'}})
+        if self.path.startswith('/exec/'):
+            return self.send(200, {'ExitCode': self.server.execs[self.path.split('/')[2]]['code']})
+        self.send(404, {'message': 'not found'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        if self.path == '/containers/busybox_1/exec':
+            exec_id = str(len(self.server.execs))
+            self.server.execs[exec_id] = json.loads(body)
+            return self.send(201, {'Id': exec_id})
+        if self.path.startswith('/exec/'):
+            config = self.server.execs[self.path.split('/')[2]]
+            cmd = config['Cmd']
+            if 'sleep' in cmd[-1]:
+                time.sleep(0.5)
+            if 'tick' in cmd[-1]:
+                # a command printing a frame every 0.2s for 3s
+                config['code'] = 0
+                self.send_response(200)
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                for _ in range(15):
+                    self.wfile.write(struct.pack('>BxxxL', 1, 5) + 'tick\n')
+                    self.wfile.flush()
+                    time.sleep(0.2)
+                return
+            config['code'] = 0 if cmd[0] in ('ls', '/bin/sh') else 1
+            if cmd[0] == 'ls':
+                data = struct.pack('>BxxxL', 1, 8) + 'bin\netc\n'
+            else:
+                data = struct.pack('>BxxxL', 2, 6) + 'error\n'
+            return self.send(200, data, raw=True)
+        if self.path.endswith('/stop'):
+            return self.send(304 if 'debian8' in self.path else 204)
+        self.send(404, {'message': 'not found'})
+
+    def do_DELETE(self):
+        self.send(204)
+
+
+class FakeEngine(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        SocketServer.UnixStreamServer.__init__(self, path, FakeEngineHandler)
+        self.execs = {}
+        self.connections = set()
+
+
+@pytest.fixture
+def engine():
+    path = os.path.join(tempfile.mkdtemp(), 'docker.sock')
+    server = FakeEngine(path)
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,))
+    thread.daemon = True
+    thread.start()
+    docker_api.configure(path)
+    yield server
+    docker_api.get_client().close()
+    server.shutdown()
+    server.server_close()
+    os.remove(path)
+
+
+def test_demux():
+    data = struct.pack('>BxxxL', 1, 3) + 'out' + struct.pack('>BxxxL', 2, 3) + 'err' + \
+           struct.pack('>BxxxL', 1, 1) + '!'
+    assert docker_api.demux(data) == ('out!', 'err')
+
+
+def test_version(engine):
+    assert docker_api.docker_version() == '1.12.1'
+
+
+def test_keep_alive(engine):
+    docker_api.get_images()
+    docker_api.get_containers()
+    docker_api.docker_version()
+    assert len(engine.connections) == 1
+
+
+def test_get_image_label(engine):
+    assert docker_api.get_image_label('busybox', 'simply.context') == 'abcd'
+    assert docker_api.get_image_label('busybox', 'toto') == ''
+    assert docker_api.get_image_label('toto', 'simply.context') == ''
+    assert docker_api.image_outdated('debian8')
+
+
+def test_get_images(engine):
+    assert docker_api.get_images() == ['busybox', 'debian8', 'debian8', '<none>']
+    assert docker_api.get_images('busy') == ['busybox']
+    assert docker_api.get_images(('debian8',)) == ['debian8', 'debian8']
+
+
+def test_get_containers(engine):
+    assert docker_api.get_containers() == ['busybox_1', 'debian8_1']
+    assert docker_api.get_containers(all=False) == ['busybox_1']
+    assert docker_api.get_containers('debian') == ['debian8_1']
+    assert docker_api.get_containers(image='busybox') == ['busybox_1']
+
+
+def test_query(engine):
+    assert [r.tag for r in docker_api.query_images(repository='debian8')] == ['latest', 'v1']
+    assert docker_api.query_images(repository='debian8', tag='v1')[0].id == 'sha256:0f6b'
+    assert [r.name for r in docker_api.query_containers(state='running')] == ['busybox_1']
+    assert docker_api.has_container('debian8_1') and not docker_api.has_container('debian8_1', all=False)
+    assert docker_api.has_image('busybox') and not docker_api.has_image('busy')
+
+
+def test_container_stop_delete(engine):
+    assert docker_api.container_stop('busybox_1', 'debian8_1')
+    assert docker_api.container_delete(image='busybox')
+
+
+def test_get_container_ip(engine):
+    assert docker_api.get_container_ip('busybox_1') == '172.17.0.2'
+    assert docker_api.get_container_ip('toto', raises=False) == ''
+    with pytest.raises(RuntimeError):
+        docker_api.get_container_ip('toto')
+
+
+def test_exec(engine):
+    assert docker_api.docker_exec('ls', 'busybox_1').split() == ['bin', 'etc']
+    assert engine.execs['0']['Cmd'] == ['ls']
+    res = docker_api.docker_exec('cat /toto', 'busybox_1', user='bob', stdout_only=False)
+    assert (res.stdout, res.stderr, res.returncode) == ('', 'error\n', 1)
+    assert engine.execs['1']['User'] == 'bob'
+    assert not docker_api.path_exists('/toto', 'busybox_1')
+    with pytest.raises(RuntimeError):
+        docker_api.docker_exec('cat /toto', 'busybox_1', raises=True)
+    assert docker_api.docker_exec('ls | wc -l', 'busybox_1', status_only=True)
+    assert engine.execs['4']['Cmd'] == ['/bin/sh', '-c', 'ls | wc -l']
+
+
+def test_backend_transport(engine):
+    db = docker.this_class()
+    db.image = 'busybox'
+    db.user = None
+    assert db.init_backend(ConfAttrDict(transport='api', container='busybox_1'))
+    assert db.engine is docker_api
+    assert db.get_real_containers() == ['busybox_1']
+    assert db.execute('ls').split() == ['bin', 'etc']
+    db.init_backend(ConfAttrDict())
+    assert db.engine is docker
+    with pytest.raises(ValueError):
+        db.init_backend(ConfAttrDict(transport='toto'))
+
+
+def test_exec_timeout(engine):
+    with pytest.raises(RuntimeError) as exc:
+        docker_api.docker_exec('sleep 5', 'busybox_1', raises=True, timeout=0.05)
+    assert 'Timeout' in str(exc.value)
+    assert 'sleep 5' in engine.execs['0']['Cmd'][2]
+    assert 'kill_tree' in engine.execs['1']['Cmd'][2]
+    assert docker_api.docker_exec('ls', 'busybox_1').split() == ['bin', 'etc']
+    handle = docker_api.docker_exec('ls', 'busybox_1', daemon=True)
+    assert handle.pidfile in engine.execs['3']['Cmd'][2]
+    # the handle is returned once the pid file exists
+    assert pipes.quote(docker.PIDFILE_WAIT_SCRIPT.format(handle.pidfile)) in engine.execs['4']['Cmd'][2]
+    assert handle.cancel()
+    assert handle.pidfile in engine.execs['5']['Cmd'][2]
+    # the timeout applies to the whole exec, not to each read of its output
+    start = time.time()
+    with pytest.raises(RuntimeError) as exc:
+        docker_api.docker_exec('tick', 'busybox_1', raises=True, timeout=0.5)
+    assert 'Timeout' in str(exc.value) and time.time() - start < 1.5
+    assert 'kill_tree' in engine.execs['7']['Cmd'][2]
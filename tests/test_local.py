@@ -0,0 +1,147 @@
+# encoding: utf-8
+
+import os
+import time
+
+import pytest
+
+from simply.backends import fake, local
+from simply.platform import factory, PlatformPool
+from simply.utils import ConfAttrDict
+
+
+def local_conf(tmpdir, backend='local', **kwargs):
+    return ConfAttrDict(backend=backend, frontend='debian', image='debian8', local_root=str(tmpdir), **kwargs)
+
+
+def test_local_platform(tmpdir):
+    platform = factory(local_conf(tmpdir, container='deb'))
+    assert isinstance(platform, local.LocalBackend)
+    assert platform.workdir == str(tmpdir.join('debian8', 'deb'))
+    assert platform.get_real_containers() == []
+    platform.setup()
+    try:
+        assert platform.get_real_containers() == ['deb']
+        assert platform.execute('pwd; echo $HOME').split() == [platform.workdir] * 2
+        assert platform.execute('false', status_only=True) is False
+        with pytest.raises(RuntimeError) as e:
+            platform.execute('echo oops >&2; exit 3', raises=True)
+        assert 'oops' in str(e.value)
+        with pytest.raises(RuntimeError) as e:
+            platform.execute('sleep 5', raises=True, timeout=0.2)
+        assert 'Timeout' in str(e.value)
+        results = platform.execute_many(['echo a', 'mkdir -p etc && touch etc/x', 'exit 2'])
+        assert [(r.stdout, r.returncode) for r in results] == [('a\n', 0), ('', 0), ('', 2)]
+        assert platform.path_exists('/etc/x')
+        assert platform.aexecute('echo async').result(5) == 'async\n'
+        handle = platform.execute('sleep 10', daemon=True)
+        assert handle.running()
+        assert handle.cancel() and not handle.running()
+    finally:
+        platform.reset()
+    assert platform.get_real_containers() == []
+
+
+def test_local_files(tmpdir):
+    source = tmpdir.mkdir('source')
+    source.join('a').write('A')
+    source.mkdir('sub').join('b').write('B')
+    source.mkdir('empty')
+    source.join('link').mksymlinkto('sub')
+    platform = factory(local_conf(tmpdir.join('root'))).setup()
+    stats = platform.sync_directory(str(source), '/opt/app')
+    assert (stats.changed, stats.removed, stats.bytes) == (['a', 'empty', 'link', 'sub', 'sub/b'], [], 2)
+    assert platform.execute('cat opt/app/sub/b opt/app/link/b') == 'BB'
+    assert platform.execute('test -d opt/app/empty && readlink opt/app/link') == 'sub\n'
+    source.join('a').remove()
+    source.join('sub', 'b').write('BB')
+    source.join('empty').remove()
+    source.join('empty').write('')
+    stats = platform.sync_directory(str(source), '/opt/app')
+    assert (stats.changed, stats.removed) == (['empty', 'sub/b'], ['a'])
+    assert not platform.path_exists('/opt/app/a')
+    assert platform.execute('test -f opt/app/empty', status_only=True)
+    with platform.get_files(['/opt/app/sub/b']) as files:
+        assert files['/opt/app/sub/b'] == 'BB'
+    with platform.get_directory('/opt/app') as files:
+        assert files['sub/b'] == 'BB'
+    platform.reset('rm_image')
+    assert not tmpdir.join('root', 'debian8').check()
+
+
+def test_local_pool(tmpdir):
+    confs = [local_conf(tmpdir, name='deb{}'.format(i)) for i in range(4)]
+    pool = PlatformPool(confs, workers=4, xdist='')
+    start = time.time()
+    pool.setup()
+    assert all(os.path.isdir(platform.workdir) for platform in pool)
+    with pool.lease('deb2') as platform:
+        assert platform.execute('echo ok') == 'ok\n'
+    assert time.time() - start < 5
+
+
+def test_pool_provisioning(tmpdir):
+    confs = [local_conf(tmpdir, backend='fake', name='deb{}'.format(i), provisioning=[('create_user', 'bob')])
+             for i in range(2)]
+    pool = PlatformPool(confs, workers=2, xdist='').setup()
+    for platform in pool:
+        assert platform.executed() == ['useradd bob']
+        assert platform.provisioning_log == [('create_user', 'bob')]
+
+
+def test_fake_platform(tmpdir):
+    dpkg = 'install ok installed\tcurl\t1.2-3\ndeinstall ok config-files\tvim\t2:7.4\n'
+    conf = local_conf(tmpdir, backend='fake', responses=[('dpkg-query', dpkg)],
+                      provisioning=[('install_package', 'curl'), ('create_user', 'bob', {'groups': ['staff']})])
+    platform = factory(conf)
+    assert isinstance(platform, fake.FakeBackend)
+    platform.setup()
+    # curl is installed already
+    assert platform.executed() == ["dpkg-query -W -f '${Status}\\t${Package}\\t${Version}\\n'", 'useradd bob',
+                                   'grep -q "^staff:" /etc/group || addgroup staff', 'usermod -a -G staff bob']
+    assert platform.provisioning_log == conf.provisioning
+    assert platform.commit_provisioning().startswith('debian8_prov_')
+    assert (platform.get_version('curl'), platform.get_version('vim')) == ('1.2-3', None)
+    with platform.package_transaction():
+        platform.install_package('git')
+        with platform.package_transaction():
+            platform.install_package('vim', 'curl', 'git')
+        assert platform.executed('apt-get') == []
+    assert platform.executed('apt-get') == ["/bin/sh -c 'apt-get update && apt-get upgrade -y'",
+                                            'apt-get install -y git vim']
+    assert len(platform.executed('dpkg-query')) == 1
+    platform.get_version('git')
+    assert len(platform.executed('dpkg-query')) == 2
+    with pytest.raises(ZeroDivisionError):
+        with platform.package_transaction():
+            platform.install_package('emacs')
+            1 / 0
+    assert not platform.executed('emacs')
+    platform.respond('chown', returncode=1, stderr='no such user')
+    with pytest.raises(RuntimeError) as e:
+        platform.path_set_user('/opt', 'alice')
+    assert 'no such user' in str(e.value)
+    assert platform.wait_file('/tmp/ready')
+    platform.respond('test -e', returncode=1)
+    assert not platform.wait_file('/tmp/ready', timeout=10)
+    assert platform.commands[-1][1] == 'root'
+
+
+def test_container_state_reset(tmpdir):
+    platform = factory(local_conf(tmpdir, backend='fake')).setup()
+    platform.install_package('git')
+    platform.respond('dpkg-query', 'install ok installed\tgit\t1\n')
+    assert platform.get_version('git') == '1'
+    platform.setup('all_containers')
+    platform.respond('dpkg-query', '')
+    assert platform.get_version('git') is None
+    platform.install_package('git')
+    assert platform.executed('apt-get') == ["/bin/sh -c 'apt-get update && apt-get upgrade -y'",
+                                            'apt-get install -y git'] * 2
+
+
+def test_fake_busybox_packages(tmpdir):
+    opkg = 'busybox - 1.24.1-r1\ncurl - 7.47.0-r0 - a url retrieval utility\n\n'
+    platform = factory(ConfAttrDict(backend='fake', frontend='busybox', image='busybox', local_root=str(tmpdir),
+                                    responses=[('opkg list-installed', opkg)]))
+    assert platform.get_installed_packages() == {'busybox': '1.24.1-r1', 'curl': '7.47.0-r0'}
@@ -0,0 +1,60 @@
+# encoding: utf-8
+
+import pytest
+
+from simply import planner
+from simply.planner import ResourcePlanner
+from simply.platform import PlatformPool
+from simply.utils import ConfAttrDict
+
+
+def test_sizes_and_cpusets():
+    assert planner.parse_size('512m') == 512 << 20
+    assert planner.parse_size('1.5g') == 3 << 29
+    assert planner.parse_size(1000) == planner.parse_size('1000') == 1000
+    with pytest.raises(RuntimeError):
+        planner.parse_size('lots')
+    assert planner.parse_cpuset('0-3,6, 8-9') == [0, 1, 2, 3, 6, 8, 9]
+    assert planner.format_cpuset([9, 0, 1, 2, 3, 6, 8]) == '0-3,6,8-9'
+    assert planner.host_cpus()
+    assert planner.host_memory() > 0
+
+
+def test_planner():
+    confs = [ConfAttrDict(image='image{}'.format(i)) for i in range(6)]
+    rp = ResourcePlanner(cpus='0-7', memory='4g', share=(0, 1))
+    assert rp.concurrency(confs) == 6
+    # 2 cores each: 4 at once
+    confs[0]['cpus'] = 1.5
+    workers, planned = rp.plan(confs)
+    assert workers == 4
+    assert [conf.cpuset for conf in planned] == ['0-1', '2-3', '4-5', '6-7', '0-1', '2-3']
+    assert planned[0].image == 'image0' and 'cpuset' not in confs[0]
+    # memory bound: 3 at once
+    confs[1]['memory'] = '1200m'
+    assert rp.concurrency(confs) == 3
+    # cpusets are not reused by platforms set up later, as containers keep running
+    workers, planned = rp.plan(confs[1:])
+    assert workers == 3
+    assert [conf.cpuset for conf in planned] == ['0', '1', '2', '3', '4']
+    # a configured cpuset is kept
+    confs[2]['cpuset'] = '7'
+    assert rp.plan(confs)[1][2].cpuset == '7'
+    # not enough cores: one at a time, on all cores
+    assert ResourcePlanner(cpus=[0], share=(0, 1)).plan(confs[:2]) == (1, [ConfAttrDict(confs[0], cpuset='0'),
+                                                                          ConfAttrDict(confs[1], cpuset='0')])
+
+
+def test_planner_xdist_share():
+    rp = ResourcePlanner(cpus='0-7', memory='4g', share=(1, 3))
+    assert (rp.cpus, rp.memory) == ([2, 3], (4 << 30) // 3)
+    assert ResourcePlanner(cpus='0-1', share=(2, 3)).cpus == [0]
+
+
+def test_pool_planner():
+    confs = [ConfAttrDict(backend='docker', frontend='debian', image='busybox', name='box{}'.format(i), cpus=1)
+             for i in range(3)]
+    pool = PlatformPool(confs, xdist='', planner=ResourcePlanner(cpus='0-3', share=(0, 1)))
+    assert pool.workers == 3
+    assert [platform.parameters for platform in pool] == ['--cpus 1 --cpuset-cpus {}'.format(cpu)
+                                                          for cpu in ('0', '1', '2')]
@@ -1,8 +1,18 @@
 # encoding: utf-8
 
+import os
+import Queue
+import socket
+from subprocess import Popen
+import threading
+import time
+
 import pytest
 
-from simply.platform import factory
+from simply import utils
+from simply.backends import docker
+from simply.frontends.linux import ProcessSnapshot
+from simply.platform import factory, PlatformPool
 from simply.utils import ConfAttrDict
 
 
@@ -92,3 +102,210 @@ def test_platform_execute():
         assert platform.path_exists('/root/test_dir')
     finally:
         platform.reset()
+
+
+def test_platform_pool():
+    confs = [ConfAttrDict(backend='docker', frontend='debian', image=image)
+             for image in ('busybox', 'scratch')]
+    confs.append(ConfAttrDict(backend='docker', frontend='debian', image='busybox', name='busybox2'))
+    pool = PlatformPool(confs, workers=2, xdist='')
+    assert len(pool) == 3
+    assert [p.image for p in pool.images()] == ['busybox', 'scratch']
+    calls = []
+    for platform in pool:
+        platform.build_image = lambda reset, p=platform: calls.append(('build', p.image, reset))
+        platform.run_container = lambda p=platform: calls.append(('run', p.container))
+    assert pool.setup() is pool
+    assert sorted(calls[:2]) == [('build', 'busybox', 'all_containers'), ('build', 'scratch', 'all_containers')]
+    assert sorted(calls[2:]) == sorted(('run', p.container) for p in pool)
+    with pool.lease('busybox2') as platform:
+        assert platform is pool['busybox2']
+        with pytest.raises(Queue.Empty):
+            with pool.lease('busybox2', timeout=0.01):
+                pass
+    with pool.lease('busybox2', timeout=0.01) as platform:
+        assert platform is pool['busybox2']
+
+
+def test_platform_pool_xdist():
+    confs = [ConfAttrDict(backend='docker', frontend='debian', image='busybox')]
+    pool = PlatformPool(confs, xdist='gw1')
+    assert pool['busybox'].container.startswith('busybox_gw1_')
+    calls = []
+    pool['busybox'].build_image = lambda reset: calls.append(reset)
+    pool['busybox'].run_container = lambda: None
+    pool.setup('all_containers')
+    assert calls == [None]
+
+
+def test_platform_provisioning(monkeypatch):
+    conf = ConfAttrDict(
+        backend='docker',
+        frontend='debian',
+        image='debian8',
+        provisioning=[('install_package', 'curl', 'git'), ('create_user', 'bob', {'groups': ['staff']})],
+    )
+    platform = factory(conf)
+    commands, commits = [], []
+    monkeypatch.setattr(platform, 'execute', lambda cmd, **kwargs: commands.append(cmd) or '')
+    monkeypatch.setattr(platform, 'execute_many', lambda cmds, **kwargs: commands.extend(cmds) or [])
+    monkeypatch.setattr(docker, 'get_image_id', lambda image: 'sha256:0123')
+    monkeypatch.setattr(docker, 'docker_commit', lambda container, image: commits.append(image) or True)
+    image = platform.provision(conf.provisioning)
+    assert image.startswith('debian8_prov_')
+    assert commits == [image]
+    assert 'apt-get -o Debug::NoLocking=1 install -y curl git' in commands
+    assert 'useradd bob' in commands
+    assert 'usermod -a -G staff bob' in commands
+    # recorded calls hash like the configured steps, tuples or lists
+    assert platform.provisioning_log == conf.provisioning
+    assert platform.commit_provisioning() == image
+    assert platform.provisioned_image([['install_package', 'curl', 'git'],
+                                       ['create_user', 'bob', {'groups': ('staff',)}]]) == image
+    assert platform.provisioned_image(conf.provisioning[:1]) != image
+    monkeypatch.setattr(docker, 'get_image_id', lambda image: 'sha256:4567')
+    assert platform.provisioned_image(conf.provisioning) != image
+    cached = platform.provisioned_image(conf.provisioning)
+    monkeypatch.setattr(docker, 'get_images', lambda filter=None: [filter])
+    assert platform.use_provisioned_image()
+    assert (platform.base_image, platform.image) == ('debian8', cached)
+
+
+def test_package_cache(tmpdir, monkeypatch):
+    conf = ConfAttrDict(backend='docker', frontend='debian', image='debian:8', package_cache=str(tmpdir))
+    platform = factory(conf)
+    assert platform.parameters is None
+    apt = tmpdir.join('debian_8')
+    assert platform.run_parameters() == \
+        '-v {0}/apt-archives:/var/cache/apt/archives -v {0}/apt-lists:/var/cache/simply_apt_lists ' \
+        '-v {1}/pip:/var/cache/simply_pip -e PIP_CACHE_DIR=/var/cache/simply_pip'.format(apt, tmpdir)
+    assert apt.join('apt-lists').check(dir=1)
+    commands = []
+    lock = 'package_cache_' + platform.package_cache_dir('index')
+
+    def execute(cmd, **kwargs):
+        # commands are recorded with whether they hold the package lock
+        commands.append((cmd, utils._named_locks[lock].locked() if lock in utils._named_locks else False))
+        return ''
+    monkeypatch.setattr(platform, 'execute', execute)
+    platform.install_package('curl')
+    platform.install_package('git')
+    assert commands[0][0].startswith('dpkg-query -W')
+    assert commands[1:] == [
+        ("/bin/sh -c 'rm -f /etc/apt/apt.conf.d/docker-clean && mkdir -p /var/cache/simply_apt_lists/partial && "
+         "apt-get -o Dir::State::Lists=/var/cache/simply_apt_lists update && "
+         "cp -a /var/cache/simply_apt_lists/. /var/lib/apt/lists/ && apt-get upgrade -y --download-only'", True),
+        ('apt-get -o Debug::NoLocking=1 upgrade -y', False),
+        ("/bin/sh -c 'apt-get install -y curl --download-only'", True),
+        ('apt-get -o Debug::NoLocking=1 install -y curl', False), commands[0],
+        ("/bin/sh -c 'apt-get install -y git --download-only'", True),
+        ('apt-get -o Debug::NoLocking=1 install -y git', False)]
+    # a fresh index cache is not updated again
+    apt.join('apt-lists', 'deb.debian.org_debian_dists_jessie_InRelease').write('')
+    platform = factory(conf)
+    monkeypatch.setattr(platform, 'execute', execute)
+    platform.install_package('curl')
+    assert [cmd for cmd, _ in commands[-4:-2]] == [
+        "/bin/sh -c 'rm -f /etc/apt/apt.conf.d/docker-clean && cp -a /var/cache/simply_apt_lists/. /var/lib/apt/lists/ "
+        "&& apt-get upgrade -y --download-only'",
+        'apt-get -o Debug::NoLocking=1 upgrade -y']
+    platform.package_index_ttl = 0
+    assert not platform.package_index_fresh('apt-lists')
+    conf['package_cache'] = False
+    assert factory(conf).run_parameters() is None
+
+
+@pytest.fixture
+def local_platform(tmpdir):
+    """ A platform whose commands run on the local host instead of a container
+    """
+    platform = factory(ConfAttrDict(backend='local', frontend='debian', image='busybox', local_root=str(tmpdir)))
+    yield platform.setup()
+    platform.reset()
+
+
+def test_wait_file(local_platform, tmpdir):
+    path = str(tmpdir.join('ready'))
+    threading.Timer(0.3, lambda: open(path, 'w').write('server started\n')).start()
+    start = time.time()
+    assert local_platform.wait_file(path, timeout=3)
+    assert time.time() - start < 1.5
+    assert local_platform.wait_log('^server start', path, timeout=1)
+    assert not local_platform.wait_log('stopped', path, timeout=0.2)
+    assert not local_platform.wait_file(path + '_not', timeout=0.2)
+
+
+def test_wait_port_process(local_platform, monkeypatch, tmpdir):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    port = server.getsockname()[1]
+    assert not local_platform.wait_port(port, timeout=0.2)
+    threading.Timer(0.3, server.listen, (1,)).start()
+    try:
+        assert local_platform.wait_port(port, timeout=3)
+        monkeypatch.setattr(local_platform, 'get_container_ip', lambda: '127.0.0.1')
+        assert local_platform.wait_port(port, timeout=1, host=True)
+    finally:
+        server.close()
+    proc = Popen(['sleep', '3'])
+    try:
+        assert local_platform.wait_running_process('sleep')
+    finally:
+        proc.kill()
+    assert not local_platform.wait_process('no_such_process', timeout=0.2)
+    # a script is found by its name, which is only its comm
+    script = tmpdir.join('my_long_named_service')
+    script.write('#!/bin/sh\nsleep 3\n')
+    script.chmod(0o755)
+    proc = Popen([str(script)])
+    try:
+        assert local_platform.wait_process('my_long_named_service', timeout=2)
+        assert local_platform.get_snapshot().filter(name='my_long_named_service')[proc.pid].name == 'sh'
+    finally:
+        proc.kill()
+
+
+def test_process_snapshot_parse():
+    output = '42\nroot:x:0:0:root:/root:/bin/sh\nbob:x:1000:1000::/home/bob:/bin/sh\n' \
+             '\0361 (my init) S 0 1 1 0 -1 4194560 0 0 0 0 0 0 0 0 20 0 1 0 5 0 0\n' \
+             'Uid:\t0\t0\t0\t0\nVmRSS:\t  1024 kB\n/sbin/init\037--debug\037\n' \
+             '\03612 (python) R 1 1 1 0 -1 4194560 0 0 0 0 0 0 0 0 20 0 1 0 900 0 0\n' \
+             'Uid:\t1000\t1000\t1000\t1000\nVmRSS:\t  20480 kB\npython\037-c\037print(1)\035print(2)\037\n' \
+             '\0363 (kthreadd) S 0 0 0 0 -1 0 0 0 0 0 0 0 0 0 20 0 1 0 2 0 0\nUid:\t0\t0\t0\t0\n\n' \
+             '\03643 (cat) R 42 1 1 0 -1 4194560 0 0 0 0 0 0 0 0 20 0 1 0 999 0 0\nUid:\t0\t0\t0\t0\ncat\n'
+    snapshot = ProcessSnapshot.parse(output, time=10)
+    assert [proc.pid for proc in snapshot] == [1, 12, 3]
+    init, python, kthreadd = snapshot
+    assert (init.comm, init.name, init.argv, init.user, init.rss, init.start) == \
+        ('my init', 'init', ['/sbin/init', '--debug'], 'root', 1024, 5)
+    assert (python.ppid, python.state, python.user, python.uid) == (1, 'R', 'bob', 1000)
+    assert python.cmdline == 'python -c print(1)\nprint(2)'
+    assert (kthreadd.name, kthreadd.cmdline, kthreadd.rss) == ('kthreadd', '[kthreadd]', 0)
+    assert snapshot.filter(user='bob').names() == ['python']
+    assert snapshot.filter(pattern=r'print\(\d\)', state='R')[12] is python
+    assert snapshot.filter(pid=[1, 3], ppid=0).names() == ['init', 'kthreadd']
+    assert 12 not in snapshot.filter(name='init')
+    assert snapshot.filter(name='my init').names() == ['init']
+    assert kthreadd._replace(comm='kthreadd_with_a').matches('kthreadd_with_a_long_name') and not init.matches('my')
+    assert len(ProcessSnapshot.parse('')) == 0
+    later = ProcessSnapshot([init, python._replace(start=950)])
+    started, ended = later.diff(snapshot)
+    assert ([proc.start for proc in started], ended.names()) == ([950], ['python', 'kthreadd'])
+
+
+def test_process_snapshot(local_platform):
+    before = local_platform.get_snapshot()
+    assert local_platform.get_snapshot() is before
+    assert local_platform.get_snapshot(max_age=0) is not before
+    proc = Popen(['sleep', '3.5'])
+    try:
+        assert local_platform.wait_running_process('sleep')
+        started, ended = local_platform.get_snapshot().diff(before)
+        assert started.filter(pid=proc.pid).names() == ['sleep']
+        assert started[proc.pid].argv == ['sleep', '3.5'] and started[proc.pid].ppid == os.getpid()
+        assert 'sleep' in local_platform.get_processes('3.5')
+    finally:
+        proc.kill()
+        proc.wait()
+    time.sleep(0.2)
+    assert proc.pid in local_platform.get_snapshot().diff(started)[1]
@@ -0,0 +1,84 @@
+# encoding: utf-8
+
+import json
+
+import pytest
+
+from simply.profiling import Profiler, profiler, timed
+from simply.utils import Command, stream_to_command
+
+pytest_plugins = 'pytester'
+
+
+@pytest.fixture
+def recording():
+    profiler.clear()
+    profiler.enable()
+    yield profiler
+    profiler.enable(False)
+    profiler.clear()
+
+
+class FakePlatform(object):
+    name = 'debian8'
+
+    @timed('setup')
+    def setup(self):
+        return Command('echo ok').stdout
+
+
+def test_disabled():
+    prof = Profiler()
+    with prof.span('command', 'ls') as span:
+        assert span is None
+    assert prof.spans == []
+
+
+def test_spans(recording):
+    assert FakePlatform().setup() == 'ok\n'
+    stream_to_command('cat >/dev/null', 'x' * 1000)
+    command, setup, transfer = recording.spans
+    assert (setup.phase, setup.name, setup.platform) == ('setup', 'setup', 'debian8')
+    assert (command.phase, command.name, command.platform, command.context) == \
+           ('command', 'echo ok', 'debian8', 'setup')
+    assert command.bytes_out == 3 and command.duration <= setup.duration
+    assert (transfer.platform, transfer.bytes_in) == (None, 1000)
+    summary = recording.summary()
+    assert summary['debian8', 'command'] == dict(count=1, seconds=command.duration, bytes_in=0, bytes_out=3)
+    assert set(summary) == {('debian8', 'setup'), ('debian8', 'command'), (None, 'transfer')}
+    assert recording.slowest('command') == [command]
+    assert 'echo ok' in recording.report()
+
+
+def test_export(recording, tmpdir):
+    FakePlatform().setup()
+    recording.dump_json(str(tmpdir.join('timings.json')))
+    data = json.loads(tmpdir.join('timings.json').read())
+    assert [span['phase'] for span in data['spans']] == ['command', 'setup']
+    assert len(data['summary']) == 2
+    recording.dump_trace(str(tmpdir.join('trace.json')))
+    events = json.loads(tmpdir.join('trace.json').read())['traceEvents']
+    assert [(e['name'], e['cat'], e['ph']) for e in events] == [('echo ok', 'command', 'X'), ('setup', 'setup', 'X')]
+    assert events[1]['ts'] <= events[0]['ts'] and events[0]['dur'] <= events[1]['dur']
+
+
+def test_pytest_options(testdir):
+    testdir.makeconftest("""
+from simply import profiling
+from simply.profiling import pytest_configure, pytest_terminal_summary
+
+
+def pytest_addoption(parser):
+    profiling.pytest_addoption(parser)
+""")
+    testdir.makepyfile("""
+from simply.utils import command
+
+def test_command():
+    assert command('true') == 0
+""")
+    result = testdir.runpytest('--timings-trace', 'trace.json')
+    result.stdout.fnmatch_lines(['*simply timings*', '-*command*1*', 'slowest commands:', '*s - * true'])
+    assert json.loads(testdir.tmpdir.join('trace.json').read())['traceEvents'][0]['name'] == 'true'
+    profiler.enable(False)
+    profiler.clear()
@@ -1,11 +1,18 @@
 # encoding: utf-8
 
+import cStringIO
 import os
+import tempfile
+import threading
+import time
+
 import pytest
 
 from simply import ROOTDIR
-from simply.utils import (cd, extract_column, filter_column, Command, command, command_input,
-                          ConfAttrDict, read_configuration)
+from simply.utils import (cd, extract_column, filter_column, Table, Command, command, command_input,
+                          ConfAttrDict, read_configuration, async_command, coroutine, gather, Return,
+                          stream_to_command, stream_from_command, iter_command, tar_from_command,
+                          named_lock)
 
 
 def test_extract_column():
@@ -36,6 +43,42 @@ def test_filter_column():
     assert filter_column(text, 2, endswith='ob') == ['toto titi bob', 'tototo xtitito blob', 'aaaa bbbb job']
 
 
+def test_table():
+    text = """\
+CONTAINER ID   IMAGE     COMMAND      STATUS                   NAMES
+0123456789ab   busybox   "/bin/cat"   Up 2 minutes             box_1
+cdef01234567   debian8   "bash"       Exited (0) 3 hours ago   deb_1
+89abcdef0123   busybox   "sleep 10"   Up 5 seconds             box_2
+
+"""
+    table = Table(text, header=Table.PHRASES)
+    assert table.names == ['CONTAINER ID', 'IMAGE', 'COMMAND', 'STATUS', 'NAMES']
+    assert len(table) == 3
+    assert table.column('STATUS') == ['Up 2 minutes', 'Exited (0) 3 hours ago', 'Up 5 seconds']
+    assert table.column(3) is table.column('STATUS')
+    running = table.filter(('STATUS', 'startswith', 'Up'), IMAGE='busybox')
+    assert running.columns('NAMES', 'COMMAND') == [('box_1', '"/bin/cat"'), ('box_2', '"sleep 10"')]
+    assert running.filter(NAMES__match=r'_2$').lines()[0].startswith('89abcdef0123')
+    assert table.filter(IMAGE__in=('debian8', 'ubuntu')).column(-1) == ['deb_1']
+    with pytest.raises(KeyError):
+        table.column('PORTS')
+    with pytest.raises(ValueError):
+        table.filter(IMAGE__like='busy')
+    # right-aligned columns overflowing their header
+    ps = Table("""\
+  PID TTY          TIME CMD
+    1 ?        00:00:02 init
+12345 pts/0    00:00:00 bash -l
+""", header=True)
+    assert ps.columns('PID', 'TIME', 'CMD') == [('1', '00:00:02', 'init'), ('12345', '00:00:00', 'bash -l')]
+    group = Table('root:x:0:\nstaff:x:50:bob,alice\n', sep=':')
+    assert group.filter((2, 'eq', '50')).column(3) == ['bob,alice']
+    assert group.columns(0, -2) == [('root', '0'), ('staff', '50')]
+    com = Command('printf "a 1\\nb 2\\n"')
+    assert com.stdout_column(1) == ['1', '2']
+    assert com.stdout_table() is com.stdout_table()
+
+
 def test_Command(capsys):
     with cd(ROOTDIR):
         com = Command('pwd')
@@ -69,6 +112,36 @@ def test_Command_show(capsys):
     assert (out, err.strip()) == ('', prefix + 'Error: /bin/sh: 1: fancycommand: not found')
 
 
+def test_Command_options(tmpdir):
+    data = os.urandom(1000000)
+    path = tmpdir.join('data')
+    path.write(data, 'wb')
+    com = Command('cat {}'.format(path))
+    assert com.stdout == data
+    chunks = []
+    com = Command('cat; echo error >&2', datain=data, callback=lambda name, chunk: chunks.append((name, chunk)))
+    assert com.stdout == data and com.stderr == 'error\n'
+    assert ''.join(chunk for name, chunk in chunks if name == 'stdout') == data
+    assert ('stderr', 'error\n') in chunks
+    com = Command('cat {}'.format(path), max_output=1000)
+    assert com.truncated and com.stdout == data[:1000]
+    com = Command('cat {}'.format(path), spill=1000)
+    assert com.stdout_file._rolled
+    assert com.stdout == data and not com.truncated
+    start = time.time()
+    com = Command('sleep 5; echo done', timeout=0.1)
+    assert time.time() - start < 2
+    assert com.timed_out and com.returncode and com.stdout == ''
+
+
+def test_Command_large_input():
+    data = 'x' * (64 << 20)
+    start = time.time()
+    assert Command('wc -c', datain=data).stdout.strip() == str(len(data))
+    # stdin is fed in linear time
+    assert time.time() - start < 3
+
+
 def test_command(capsys):
     # you can't retrieve stdout nor stdin
     assert command('pwd') == 0
@@ -86,6 +159,18 @@ def test_command_input(capsys):
     assert (out, err) == ('', '')
 
 
+def test_command_timeout():
+    start = time.time()
+    assert command('sleep 5', timeout=0.1) < 0
+    with pytest.raises(RuntimeError) as exc:
+        command('sleep 5 | cat', raises=True, timeout=0.1)
+    assert 'Timeout' in str(exc.value)
+    with pytest.raises(RuntimeError):
+        command_input('sleep 5; cat', 'data', raises=True, timeout=0.1)
+    assert time.time() - start < 2
+    assert command('exit 0', timeout=1) == 0
+
+
 def test_atr_dict():
     cad = ConfAttrDict(a=1, b=2, c=3)
     assert len(cad) == 3
@@ -172,3 +257,112 @@ toto: yaml
     assert y == 'inline'
     assert x.titi == 2
     assert x.toto == 'yaml'
+
+
+def test_async_command():
+    futures = [async_command('sleep 0.2; echo {}'.format(i)) for i in range(20)]
+    start = time.time()
+    results = gather(*futures).result(5)
+    # commands ran concurrently
+    assert time.time() - start < 2
+    assert [r.stdout for r in results] == ['{}\n'.format(i) for i in range(20)]
+    com = async_command('cat -; echo error >&2; exit 3', 'x' * 200000).result(5)
+    assert (len(com.stdout), com.stderr, com.returncode) == (200000, 'error\n', 3)
+    data = 'x' * (64 << 20)
+    start = time.time()
+    assert async_command('wc -c', data).result(10).stdout.strip() == str(len(data))
+    # stdin is fed in linear time
+    assert time.time() - start < 3
+
+
+def test_future_then():
+    assert async_command('echo 1').then(lambda com: int(com.stdout)).result(5) == 1
+    with pytest.raises(ZeroDivisionError):
+        async_command('echo 0').then(lambda com: 1 / int(com.stdout)).result(5)
+
+
+def test_coroutine():
+    @coroutine
+    def add(*cmds):
+        coms = yield [async_command(cmd) for cmd in cmds]
+        total = sum(int(com.stdout) for com in coms)
+        com = yield async_command('echo {}'.format(total))
+        raise Return(int(com.stdout))
+
+    @coroutine
+    def fail():
+        yield async_command('true')
+        raise ValueError('fail')
+
+    assert add('echo 1', 'echo 2', 'echo 3').result(5) == 6
+    with pytest.raises(ValueError):
+        fail().result(5)
+
+
+def test_stream_commands(tmpdir):
+    path = str(tmpdir.join('data'))
+    data = os.urandom(3 * 1000 * 1000)
+    stats = stream_to_command('cat > {}'.format(path), data, chunk_size=1 << 16)
+    assert (stats.returncode, stats.bytes) == (0, len(data))
+    assert stats.rate > 0
+    stats = stream_to_command('cat >> {}'.format(path), iter(['a', 'b', 'c']))
+    assert stats.bytes == 3
+    with open(path, 'rb') as f:
+        assert stream_to_command('cat > {}.copy'.format(path), f).bytes == len(data) + 3
+    buf = cStringIO.StringIO()
+    stats = stream_from_command('cat {}.copy'.format(path), buf)
+    assert buf.getvalue() == data + 'abc'
+    assert stats.bytes == len(data) + 3
+    assert ''.join(iter_command('cat {}'.format(path), chunk_size=1000)) == data + 'abc'
+    with pytest.raises(RuntimeError):
+        list(iter_command('cat {}.none'.format(path)))
+    with pytest.raises(RuntimeError):
+        stream_to_command('exit 1', data, raises=True)
+    # more stderr than a pipe holds does not block the command
+    noisy = 'head -c 200000 /dev/zero | tr "\\0" x >&2; '
+    assert stream_to_command(noisy + 'cat > {}'.format(path), data).bytes == len(data)
+    assert ''.join(iter_command(noisy + 'cat {}'.format(path))) == data
+    with pytest.raises(RuntimeError) as e:
+        list(iter_command(noisy + 'exit 1'))
+    assert 'xxx' in str(e.value)
+
+
+def test_iter_command_early_exit():
+    chunks = iter_command('echo $$; exec yes', chunk_size=100)
+    pid = int(next(chunks).split()[0])
+    chunks.close()
+    # the command is killed and reaped, not left as a zombie
+    with pytest.raises(OSError):
+        os.kill(pid, 0)
+
+
+def test_tar_from_command(tmpdir):
+    tmpdir.join('.hidden').write('hidden')
+    tmpdir.mkdir('sub').join('file').write('file')
+    with tar_from_command('tar cf - -C {} .'.format(tmpdir)) as store:
+        assert store.tar is None
+        assert list(store) == ['.hidden', 'sub/file']
+        assert store['sub/file'] == 'file'
+        assert store.open('.hidden').read() == 'hidden'
+        assert 'sub' not in store
+        assert store.stats.bytes > 0
+    with pytest.raises(RuntimeError):
+        tar_from_command('tar cf - -C {} toto'.format(tmpdir))
+
+
+def test_named_lock():
+    inside, overlaps = [], []
+
+    def task():
+        with named_lock('test/lock'):
+            inside.append(1)
+            overlaps.append(len(inside))
+            time.sleep(0.01)
+            inside.pop()
+    threads = [threading.Thread(target=task) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == [1, 1, 1, 1]
+    assert os.path.exists(os.path.join(tempfile.gettempdir(), 'simply_test_lock.lock'))